@@ -0,0 +1,93 @@
+import asyncio
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from app.core.security import get_current_admin_user
+from app.db.database import User
+from app.models.schema import DeletionJobResponse
+from app.services.answer_cache import answer_cache
+from app.services.archive import history_archiver
+from app.services.deletion import user_deleter
+from app.services.llm_service import llm_service
+from app.services.related import related_index
+
+router = APIRouter(tags=["admin"])
+
+@router.get("/cache")
+async def get_cache_stats(
+    limit: int = Query(20, ge=0, le=500),
+    admin: User = Depends(get_current_admin_user)
+):
+    """
+    Inspect the answer cache
+    
+    - **limit**: Number of most recently used in-process entries to include
+    """
+    return {
+        "stats": await answer_cache.stats(),
+        "entries": answer_cache.entries(limit)
+    }
+
+@router.delete("/cache")
+async def flush_cache(admin: User = Depends(get_current_admin_user)):
+    """
+    Flush every layer of the answer cache
+    """
+    return {"flushed": await answer_cache.clear()}
+
+@router.get("/llm")
+async def get_llm_stats(admin: User = Depends(get_current_admin_user)):
+    """
+    Upstream LLM call counters, including how many requests were coalesced
+    """
+    return llm_service.stats()
+
+@router.get("/related")
+async def get_related_index_stats(admin: User = Depends(get_current_admin_user)):
+    """
+    Size and layout of the related-questions index
+    """
+    return related_index.stats()
+
+@router.post("/related/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_related_index(admin: User = Depends(get_current_admin_user)):
+    """
+    Re-embed every history question into a fresh related-questions index, in the background
+    
+    Also drops deleted questions, which otherwise stay in the index (they are
+    filtered out of results) until it is rebuilt.
+    """
+    if not related_index.ready:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Related-questions index is not open")
+    if related_index.rebuilding:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A rebuild is already running")
+    related_index.rebuild_in_background(from_database=True)
+    return {"started": True}
+
+@router.get("/archive")
+async def get_archive_stats(admin: User = Depends(get_current_admin_user)):
+    """
+    History compaction settings and the result of its last run
+    """
+    return history_archiver.stats()
+
+@router.post("/archive/run")
+async def run_archive(admin: User = Depends(get_current_admin_user)):
+    """
+    Archive and purge history that is due now, instead of waiting for the next run
+    """
+    if not history_archiver.enabled:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="History compaction is off; set HISTORY_ARCHIVE_AFTER_DAYS or HISTORY_RETENTION_DAYS"
+        )
+    return await asyncio.to_thread(history_archiver.run_once)
+
+@router.get("/deletions", response_model=List[DeletionJobResponse])
+async def list_deletion_jobs(
+    limit: int = Query(50, ge=1, le=500),
+    admin: User = Depends(get_current_admin_user)
+):
+    """
+    Most recent account deletion jobs, newest first
+    """
+    return await user_deleter.recent(limit)
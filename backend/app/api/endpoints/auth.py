@@ -1,22 +1,27 @@
-from datetime import timedelta
-from fastapi import APIRouter, Depends, HTTPException, status
+from datetime import datetime, timedelta
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.api.responses import entity_tag, not_modified, validator_headers
 from app.db.database import User, get_db
-from app.models.schema import UserCreate, UserResponse, Token, UserLogin, UserUpdate
-from app.core.security import get_password_hash, verify_password, create_access_token, get_current_user
+from app.models.schema import UserCreate, UserResponse, Token, UserLogin, UserUpdate, DeletionStatusResponse
+from app.core.security import hash_password_async, verify_password_async, create_access_token, get_current_user, invalidate_user_cache
 from app.core.config import settings
+from app.services.conversations import forget_user_conversations
+from app.services.deletion import user_deleter
 import uuid
 
 router = APIRouter(tags=["auth"])
 
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     """
     Register a new user
     """
     # Check if user with this email already exists
-    db_user = db.query(User).filter(User.email == user.email).first()
+    db_user = (await db.execute(select(User).where(User.email == user.email))).scalars().first()
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -24,44 +29,68 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Check if username is taken
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = (await db.execute(select(User).where(User.username == user.username))).scalars().first()
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already taken"
         )
+    
+    # Return the pooled connection while bcrypt runs so a burst of sign-ups can't exhaust the pool
+    await db.close()
+    hashed_password = await hash_password_async(user.password)
         
     # Create new user
     new_user = User(
         id=str(uuid.uuid4()),
         email=user.email,
         username=user.username,
-        hashed_password=get_password_hash(user.password)
+        hashed_password=hashed_password
     )
     
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Another sign-up took the email or username while the password was being hashed
+        await db.rollback()
+        email_taken = (await db.execute(select(User.id).where(User.email == user.email))).first() is not None
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered" if email_taken else "Username already taken"
+        )
+    await db.refresh(new_user)
     
     return new_user
 
 @router.post("/login", response_model=Token)
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     """
     OAuth2 compatible token login, get an access token for future requests
     """
     # Try to find user by username or email
-    user = db.query(User).filter(
+    user = (await db.execute(select(User).where(
         (User.email == form_data.username) | (User.username == form_data.username)
-    ).first()
+    ))).scalars().first()
     
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    verified, new_hash = False, None
+    if user:
+        # Return the pooled connection while bcrypt runs so a login storm can't exhaust the pool
+        await db.close()
+        verified, new_hash = await verify_password_async(form_data.password, user.hashed_password)
+    
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email/username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Transparently upgrade hashes created with an older bcrypt cost
+    if new_hash:
+        await db.execute(update(User).where(User.id == user.id).values(hashed_password=new_hash))
+        await db.commit()
+    
     # Create access token
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -71,58 +100,120 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.get("/me", response_model=UserResponse)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user)
+):
     """
     Get current user information
+    
+    Send the response's `ETag` back as `If-None-Match` to get a 304 while
+    the account is unchanged.
     """
+    # The row is tiny, so the fields shown are the version; this needs no query at all
+    etag = entity_tag(
+        current_user.id, current_user.email, current_user.username,
+        current_user.is_active, current_user.tier, current_user.created_at
+    )
+    last_modified = current_user.updated_at or current_user.created_at
+    unchanged = not_modified(request, etag, last_modified)
+    if unchanged is not None:
+        return unchanged
+    response.headers.update(validator_headers(etag, last_modified))
     return current_user
 
 @router.put("/me", response_model=UserResponse)
 async def update_user(
     user_update: UserUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Update current user information
     """
+    # Hash first, without holding a pooled connection while bcrypt runs
+    new_password_hash = None
+    if user_update.password:
+        await db.close()
+        new_password_hash = await hash_password_async(user_update.password)
+    
+    # current_user is a cached snapshot; modify the row loaded in this session
+    user = await db.get(User, current_user.id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    
     # Check if email is being updated and not already taken
-    if user_update.email and user_update.email != current_user.email:
-        db_user = db.query(User).filter(User.email == user_update.email).first()
+    if user_update.email and user_update.email != user.email:
+        db_user = (await db.execute(select(User).where(User.email == user_update.email))).scalars().first()
         if db_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email already registered"
             )
-        current_user.email = user_update.email
+        user.email = user_update.email
     
     # Check if username is being updated and not already taken
-    if user_update.username and user_update.username != current_user.username:
-        db_user = db.query(User).filter(User.username == user_update.username).first()
+    if user_update.username and user_update.username != user.username:
+        db_user = (await db.execute(select(User).where(User.username == user_update.username))).scalars().first()
         if db_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Username already taken"
             )
-        current_user.username = user_update.username
+        user.username = user_update.username
     
     # Update password if provided
-    if user_update.password:
-        current_user.hashed_password = get_password_hash(user_update.password)
+    if new_password_hash:
+        user.hashed_password = new_password_hash
     
-    db.commit()
-    db.refresh(current_user)
+    user.updated_at = datetime.utcnow()
+    await db.commit()
+    await db.refresh(user)
+    invalidate_user_cache(user.id)
     
-    return current_user
+    return user
 
-@router.delete("/me", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/me", response_model=DeletionStatusResponse, status_code=status.HTTP_202_ACCEPTED)
 async def delete_user(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Delete current user
+    
+    The account is deactivated at once, so its tokens stop working. Its
+    history and conversations are deleted by a background job; follow it
+    at `/auth/deletions/{id}`.
     """
-    db.delete(current_user)
-    db.commit()
-    return {"detail": "User deleted successfully"}
+    user = await db.get(User, current_user.id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    
+    job = await user_deleter.enqueue(db, user.id)
+    forget_user_conversations(user.id)
+    return job
+
+@router.get("/deletions/{job_id}", response_model=DeletionStatusResponse)
+async def get_deletion_status(job_id: str):
+    """
+    Progress of an account deletion
+    
+    Needs no token, since the account's tokens stop working when it is
+    deleted; the job id returned by `DELETE /auth/me` is the only handle.
+    So it only tells the status and rows deleted: nothing identifies the
+    account, and errors are left to `GET /admin/deletions`.
+    """
+    job = await user_deleter.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Deletion job not found"
+        )
+    return job
@@ -0,0 +1,108 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+
+from app.core.security import get_current_user
+from app.db.database import Conversation, QueryHistory, QueryHistoryArchive, User, get_db
+from app.models.schema import ConversationCreate, ConversationResponse, ConversationDetail, HistoryItem
+from app.services.conversations import forget_conversation, recent_turns
+from app.services.history_writer import history_writer
+
+router = APIRouter(tags=["conversations"])
+
+async def _get_owned_conversation(db: AsyncSession, conversation_id: str, user_id: str) -> Conversation:
+    conversation = await db.get(Conversation, conversation_id)
+    if conversation is None or conversation.user_id != user_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+    return conversation
+
+@router.post("", response_model=ConversationResponse, status_code=status.HTTP_201_CREATED)
+async def create_conversation(
+    conversation: ConversationCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Start a new conversation; pass its id as `conversation_id` to /ask
+    
+    - **title**: Optional title for the conversation
+    """
+    db_conversation = Conversation(user_id=current_user.id, title=conversation.title)
+    db.add(db_conversation)
+    await db.commit()
+    await db.refresh(db_conversation)
+    return db_conversation
+
+@router.get("", response_model=List[ConversationResponse])
+async def list_conversations(
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    List the current user's conversations, newest first
+    
+    - **limit**: Maximum number of conversations to return (1-100)
+    """
+    result = await db.execute(
+        select(Conversation)
+        .where(Conversation.user_id == current_user.id)
+        .order_by(Conversation.created_at.desc())
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+@router.get("/{conversation_id}", response_model=ConversationDetail)
+async def get_conversation(
+    conversation_id: str,
+    limit: int = Query(50, ge=1, le=500),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get a conversation with its most recent turns, oldest first
+    
+    - **limit**: Maximum number of turns to return (1-500)
+    """
+    pending = [row for row in history_writer.pending_for(current_user.id) if row.conversation_id == conversation_id]
+    conversation = await _get_owned_conversation(db, conversation_id, current_user.id)
+    
+    stored = await recent_turns(db, conversation_id, limit)
+    
+    stored_ids = {row.id for row in stored}
+    rows = stored + [row for row in pending if row.id not in stored_ids]
+    rows.sort(key=lambda row: (row.timestamp, row.id))
+    turns = [
+        HistoryItem(
+            id=str(row.id),
+            question=row.question,
+            answer=row.answer,
+            timestamp=row.timestamp,
+            is_partial=bool(row.is_partial)
+        ) for row in rows[-limit:]
+    ]
+    
+    return ConversationDetail(
+        id=conversation.id,
+        title=conversation.title,
+        created_at=conversation.created_at,
+        turns=turns
+    )
+
+@router.delete("/{conversation_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_conversation(
+    conversation_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Delete a conversation; its turns stay in the user's history
+    """
+    await _get_owned_conversation(db, conversation_id, current_user.id)
+    history_writer.detach_conversation(conversation_id)
+    for model in (QueryHistory, QueryHistoryArchive):
+        await db.execute(update(model).where(model.conversation_id == conversation_id).values(conversation_id=None))
+    await db.execute(delete(Conversation).where(Conversation.id == conversation_id))
+    await db.commit()
+    forget_conversation(conversation_id)
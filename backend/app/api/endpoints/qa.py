@@ -1,16 +1,55 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
-from typing import List, Optional
-import uuid
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
+from typing import List, Optional, Union
+import json
+import logging
+import math
 
+from app.api.responses import TimedJSONResponse, entity_tag, not_modified, validator_headers
+from app.core.config import settings
+from app.core.metrics import current_request_id, stage
 from app.core.security import generate_request_id, get_current_user
-from app.models.schema import QuestionRequest, QuestionResponse, HistoryResponse, HistoryItem
-from app.services.llm_service import llm_service
-from app.db.database import get_db, QueryHistory, User
+from app.models.schema import QuestionRequest, QuestionResponse, HistoryResponse, HistoryItem, HistorySearchResponse, HistorySearchItem
+from app.models.schema import HistoryPreviewResponse, RelatedQuestion, RelatedResponse
+from app.models.schema import BatchQuestionRequest, BatchQuestionResponse, BatchItemResult, AskJobRequest, AskJobResponse
+from app.services.ask_jobs import TooManyJobs, get_job, job_view, submit_job
+from app.services.batch import batch_runner
+from app.services.governor import check_user_quota
+from app.services.llm_service import llm_service, LLMServiceError
+from app.services.history import count_history, encode_cursor, fetch_history_page, get_history_version, InvalidCursor
+from app.services.history_export import InvalidImport, export_history, import_history
+from app.services.history_writer import history_writer
+from app.services.related import RELATED_LOOKUPS, find_reusable_answer, related_index
+from app.services.conversations import ConversationNotFound, ConversationWindow, load_window, record_turn
+from app.db.database import get_db, QueryHistory, QueryHistoryArchive, User
+from app.db.search import search_history
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["qa"])
 
+async def _enforce_quota(user_id: str):
+    """Reject the request with 429 if the user has used up their request quota"""
+    wait = await check_user_quota(user_id)
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Request quota exceeded",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+
+async def _conversation_window(conversation_id: Optional[str], user_id: str) -> Optional[ConversationWindow]:
+    """Context window for the request's conversation, or None for a one-off question"""
+    if not conversation_id:
+        return None
+    try:
+        return await load_window(conversation_id, user_id)
+    except ConversationNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+
 @router.get("/", status_code=status.HTTP_200_OK)
 async def health_check():
     """Health check endpoint"""
@@ -19,7 +58,6 @@ async def health_check():
 @router.post("/ask", response_model=QuestionResponse, status_code=status.HTTP_200_OK)
 async def ask_question(
     request: QuestionRequest, 
-    db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -27,37 +65,67 @@ async def ask_question(
     
     - **question**: The user's question (required)
     - **context**: Optional additional context
+    - **conversation_id**: Optional conversation to continue; its earlier turns are sent along
     """
-    # Generate a unique request ID
-    request_id = generate_request_id()
+    # Use the request ID assigned by the middleware (also sent back as X-Request-ID)
+    request_id = current_request_id() or generate_request_id()
     
     try:
-        # Get response from LLM service
-        result = await llm_service.get_response(request.question, request.context)
+        await _enforce_quota(current_user.id)
+        window = await _conversation_window(request.conversation_id, current_user.id)
+        
+        # A close enough past answer (RELATED_ANSWER_THRESHOLD) is returned without calling the LLM
+        reused = None
+        if settings.RELATED_ANSWER_THRESHOLD > 0 and window is None and not request.context:
+            with stage("related"):
+                reused = await find_reusable_answer(request.question, current_user.id)
+        if reused is not None:
+            result = {
+                "success": True,
+                "answer": reused["answer"],
+                "metadata": {"source": "history", "history_id": reused["history_id"], "similarity": round(reused["similarity"], 4)}
+            }
+        else:
+            # Get response from LLM service
+            with stage("llm"):
+                result = await llm_service.get_response(
+                    request.question, request.context, window.contents() if window else None, tier=current_user.tier
+                )
         
         if not result["success"]:
+            if result.get("retry_after") is not None:
+                # Gemini is rate limiting us or down; tell the client when to come back
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=result.get("error", "Failed to get response from LLM"),
+                    headers={"Retry-After": str(math.ceil(result["retry_after"]))}
+                )
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
                 detail=result.get("error", "Failed to get response from LLM")
             )
         
-        # Save to history with user_id
-        history_entry = QueryHistory(
-            id=str(uuid.uuid4()),
-            question=request.question,
-            answer=result["answer"],
-            timestamp=datetime.now(),
-            user_id=current_user.id  # Associate with the current user
-        )
-        db.add(history_entry)
-        db.commit()
+        metadata = result.get("metadata")
+        if window is not None:
+            metadata = {**metadata, "conversation": window.stats()}
+            record_turn(window, request.question, result["answer"])
+        
+        # Queue the history row with user_id; it is bulk-inserted off the request path
+        with stage("history_write"):
+            history_writer.submit(
+                question=request.question,
+                answer=result["answer"],
+                user_id=current_user.id,  # Associate with the current user
+                conversation_id=request.conversation_id
+            )
         
         # Return response
         return QuestionResponse(
             answer=result["answer"],
             success=True,
             request_id=request_id,
-            metadata=result.get("metadata")
+            metadata=metadata,
+            conversation_id=request.conversation_id
         )
         
     except HTTPException as e:
@@ -70,34 +138,443 @@ async def ask_question(
             detail=f"An unexpected error occurred: {str(e)}"
         )
 
-@router.get("/history", response_model=HistoryResponse)
+@router.post("/ask/jobs", response_model=AskJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_ask_job(
+    request: AskJobRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Queue a question and return at once; poll `/ask/jobs/{id}` for the answer
+    
+    Takes the same fields as `/ask`, plus:
+    
+    - **priority**: 0 (default) down to -10, to let your other queued questions go first
+    """
+    await _enforce_quota(current_user.id)
+    # Fail fast on a conversation the user can't use, rather than in the worker
+    await _conversation_window(request.conversation_id, current_user.id)
+    try:
+        job = await submit_job(
+            current_user.id, request.question, request.context, request.conversation_id,
+            current_user.tier, request.priority
+        )
+    except TooManyJobs as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    return TimedJSONResponse(
+        job_view(job),
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={"Location": f"{settings.API_V1_STR}/ask/jobs/{job.id}"}
+    )
+
+@router.get("/ask/jobs/{job_id}", response_model=AskJobResponse)
+async def get_ask_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Status of a queued question, with its answer once `status` is `done`
+    
+    `status` is `queued`, `running`, `done` or `failed` (with `error`).
+    Finished jobs are kept for `ASK_JOB_RETENTION_HOURS`; the answer stays
+    in your history after that.
+    """
+    job = await get_job(job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job_view(job)
+
+def _batch_item_result(index: int, item: QuestionRequest, result: dict, user_id: str, rows: List[dict]) -> BatchItemResult:
+    """Turn one batch answer into its result, adding its history row to `rows` if it succeeded"""
+    if not result["success"]:
+        return BatchItemResult(
+            index=index,
+            success=False,
+            error=result.get("error", "Failed to get response from LLM"),
+            retry_after=result.get("retry_after")
+        )
+    
+    row = history_writer.make_row(item.question, result["answer"], user_id, conversation_id=item.conversation_id)
+    rows.append(row)
+    return BatchItemResult(
+        index=index,
+        success=True,
+        answer=result["answer"],
+        history_id=row["id"],
+        metadata=result.get("metadata"),
+        conversation_id=item.conversation_id
+    )
+
+@router.post("/ask/batch", status_code=status.HTTP_200_OK)
+async def ask_batch(
+    request: BatchQuestionRequest,
+    stream: bool = Query(False, description="Stream results as NDJSON, one line per question as it finishes"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Ask many questions in one request
+    
+    Questions are answered concurrently, under a limit shared by every batch
+    (`BATCH_MAX_CONCURRENCY`). Each question gets its own result, so some can
+    fail while the rest succeed; each counts against the user's request quota. The history rows of all answered questions
+    are written in one bulk insert.
+    
+    - **questions**: List of questions, each shaped like an `/ask` request
+    - **stream**: Return `application/x-ndjson` with one result per line in completion
+      order, then a final summary line
+    """
+    request_id = current_request_id() or generate_request_id()
+    user_id = current_user.id
+    items = request.questions
+    
+    if not stream:
+        rows: List[dict] = []
+        with stage("llm"):
+            results = [
+                _batch_item_result(index, items[index], result, user_id, rows)
+                async for index, result in batch_runner.run(items, user_id, current_user.tier)
+            ]
+        with stage("history_write"):
+            await history_writer.write_now(rows)
+        results.sort(key=lambda result: result.index)
+        succeeded = sum(1 for result in results if result.success)
+        return BatchQuestionResponse(
+            request_id=request_id,
+            results=results,
+            succeeded=succeeded,
+            failed=len(results) - succeeded
+        )
+    
+    async def ndjson_stream():
+        rows: List[dict] = []
+        succeeded = failed = 0
+        completed = False
+        try:
+            async for index, result in batch_runner.run(items, user_id, current_user.tier):
+                item_result = _batch_item_result(index, items[index], result, user_id, rows)
+                if item_result.success:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield item_result.model_dump_json() + "\n"
+            
+            completed = True
+            with stage("history_write"):
+                await history_writer.write_now(rows)
+            yield json.dumps({"request_id": request_id, "succeeded": succeeded, "failed": failed, "done": True}) + "\n"
+        finally:
+            if not completed:
+                # Client went away: keep what was already answered, without awaiting during cancellation
+                for row in rows:
+                    history_writer.enqueue(row)
+    
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+def _sse_event(event: str, data: dict) -> str:
+    """Format a single server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/ask/stream", status_code=status.HTTP_200_OK)
+async def ask_question_stream(
+    request: QuestionRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Ask a question and stream the answer back as server-sent events
+    
+    Events: `start` (request id), `chunk` (incremental text), then either
+    `done` (history id and metadata) or `error`. The history row is written
+    once the stream completes; if the client disconnects or the upstream
+    fails mid-answer, whatever was received is saved with `is_partial` set.
+    
+    - **question**: The user's question (required)
+    - **context**: Optional additional context
+    - **conversation_id**: Optional conversation to continue
+    """
+    request_id = current_request_id() or generate_request_id()
+    user_id = current_user.id
+    tier = current_user.tier
+    conversation_id = request.conversation_id
+    await _enforce_quota(user_id)
+    window = await _conversation_window(conversation_id, user_id)
+    history = window.contents() if window else None
+    
+    async def event_stream():
+        chunks: List[str] = []
+        completed = False
+        try:
+            yield _sse_event("start", {"request_id": request_id})
+            
+            finish_reason = None
+            usage = None
+            model = llm_service.model
+            with stage("llm"):
+                async for chunk in llm_service.stream_response(request.question, request.context, history, tier=tier):
+                    if chunk["text"]:
+                        chunks.append(chunk["text"])
+                        yield _sse_event("chunk", {"text": chunk["text"]})
+                    finish_reason = chunk["finish_reason"] or finish_reason
+                    usage = chunk["usage"] or usage
+                    model = chunk["model"]
+            
+            completed = True
+            answer = "".join(chunks)
+            if window is not None:
+                record_turn(window, request.question, answer)
+            with stage("history_write"):
+                history_id = history_writer.submit(request.question, answer, user_id, conversation_id=conversation_id)
+            metadata = {"model": model, "finish_reason": finish_reason}
+            if usage:
+                metadata["usage"] = usage
+            yield _sse_event("done", {
+                "request_id": request_id,
+                "history_id": history_id,
+                "conversation_id": conversation_id,
+                "metadata": metadata
+            })
+        except LLMServiceError as e:
+            yield _sse_event("error", {"request_id": request_id, "error": str(e), "retry_after": e.retry_after})
+        finally:
+            # Runs on completion, upstream failure and client disconnect (cancellation) alike
+            if not completed:
+                if chunks:
+                    # Queuing doesn't await, so this also works while the stream is being cancelled
+                    answer = "".join(chunks)
+                    if window is not None:
+                        record_turn(window, request.question, answer)
+                    history_writer.submit(
+                        request.question, answer, user_id, is_partial=True, conversation_id=conversation_id
+                    )
+                    logger.warning(f"Stream {request_id} ended early; saved partial answer")
+                else:
+                    logger.warning(f"Stream {request_id} ended before any answer text; nothing saved")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _history_row(item, preview_chars: Optional[int]) -> dict:
+    """One /history item as a plain dict, encoded straight to JSON without building a pydantic model"""
+    row = {"id": str(item.id), "question": item.question}
+    if preview_chars is None:
+        row["answer"] = item.answer
+    elif isinstance(item, (QueryHistory, QueryHistoryArchive)):
+        # Queued rows aren't in the database yet, and archived ones are compressed, so their preview is cut here
+        row["answer_preview"] = item.answer[:preview_chars]
+        row["answer_length"] = len(item.answer)
+    else:
+        row["answer_preview"] = item.answer_preview
+        row["answer_length"] = item.answer_length
+    row["timestamp"] = item.timestamp
+    row["is_partial"] = bool(item.is_partial)
+    return row
+
+@router.get("/history", response_model=Union[HistoryResponse, HistoryPreviewResponse])
 async def get_history(
+    request: Request,
     limit: int = Query(10, ge=1, le=100), 
     skip: int = Query(0, ge=0),
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_total: bool = Query(True),
+    view: str = Query("full", pattern="^(full|preview)$", description="full answers, or previews"),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """
     Get the history of questions and answers for the current user
     
+    Responses carry an `ETag`; send it back as `If-None-Match` to get a 304
+    while your history is unchanged.
+    
     - **limit**: Maximum number of items to return (1-100)
-    - **skip**: Number of items to skip (pagination)
+    - **cursor**: Keyset pagination cursor; pass the previous page's `next_cursor`
+    - **skip**: Number of items to skip (legacy offset pagination, ignored with a cursor)
+    - **include_total**: Include the total count
+    - **view**: `full` (default) or `preview`, which returns the start of each answer as `answer_preview`,
+      with its `answer_length`; fetch a full item from `/history/{id}`
     """
+    preview_chars = settings.HISTORY_PREVIEW_CHARS if view == "preview" else None
+    # Answers still in the write-behind queue belong at the top of the first page.
+    # Snapshot them before querying so a row flushed meanwhile is seen at least once.
+    pending = history_writer.pending_for(current_user.id) if not cursor and not skip else []
+    
+    # Read the version before the page, so a change in between can only make the ETag older than the body
+    with stage("history_query"):
+        version, last_modified = await get_history_version(db, current_user.id)
+    if pending:
+        # Queued rows are only in this process; they are part of the version until they are written
+        last_modified = datetime.utcnow()
+    etag = entity_tag(
+        current_user.id, version, [item.id for item in pending],
+        limit, skip, cursor, include_total, view, preview_chars
+    )
+    unchanged = not_modified(request, etag, last_modified)
+    if unchanged is not None:
+        return unchanged
+    
     # Query the database for history, filtering by user_id
-    query = db.query(QueryHistory).filter(QueryHistory.user_id == current_user.id) \
-              .order_by(QueryHistory.timestamp.desc())
-    
-    total = query.count()
-    items = query.offset(skip).limit(limit).all()
-    
-    # Convert to Pydantic models and ensure id is a string
-    history_items = [
-        HistoryItem(
-            id=str(item.id),  # Convert UUID to string explicitly
-            question=item.question,
-            answer=item.answer,
-            timestamp=item.timestamp
-        ) for item in items
+    try:
+        with stage("history_query"):
+            items, next_cursor = await fetch_history_page(
+                db, current_user.id, limit, cursor=cursor, skip=skip, preview_chars=preview_chars
+            )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    stored_ids = {item.id for item in items}
+    pending = [item for item in pending if item.id not in stored_ids]
+    if pending:
+        items = pending + list(items)
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_cursor(items[-1])
+    
+    with stage("history_query"):
+        total = await count_history(db, current_user.id, version) if include_total else None
+    if total is not None:
+        total += len(pending)
+    
+    # Returned as a response directly: these pages can be large, and validating them against the
+    # response model again would cost several times what encoding them does
+    return TimedJSONResponse({
+        "items": [_history_row(item, preview_chars) for item in items],
+        "count": total,
+        "next_cursor": next_cursor,
+    }, headers=validator_headers(etag, last_modified))
+
+@router.get("/history/search", response_model=HistorySearchResponse)
+async def search_history_items(
+    q: str = Query(..., min_length=1, max_length=200, description="Search terms"),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Full-text search over the current user's questions and answers, best matches first
+    
+    - **q**: Search terms; all must match (the last one as a prefix)
+    - **limit**: Maximum number of results to return (1-100)
+    """
+    try:
+        with stage("history_search"):
+            rows = await search_history(db, current_user.id, q, limit)
+    except NotImplementedError as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    
+    items = [HistorySearchItem(**{**row, "is_partial": bool(row["is_partial"])}) for row in rows]
+    return HistorySearchResponse(items=items, count=len(items))
+
+@router.get("/history/export")
+async def export_history_items(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="ndjson (one JSON object per line) or csv"),
+    since: Optional[datetime] = Query(None, description="Only rows newer than this, for incremental exports"),
+    gzip: bool = Query(False, description="Gzip the file"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Download the current user's whole history as one streamed file, oldest first
+    
+    Rows are read a chunk at a time, so any size of history takes the same
+    memory. For incremental exports, pass the `timestamp` of the last row you
+    have as `since`.
+    
+    - **format**: `ndjson` or `csv`
+    - **since**: Only rows with a later timestamp
+    - **gzip**: Return a `.gz` file
+    """
+    filename = f"history.{format}" + (".gz" if gzip else "")
+    if gzip:
+        media_type = "application/gzip"
+    else:
+        media_type = "application/x-ndjson" if format == "ndjson" else "text/csv; charset=utf-8"
+    return StreamingResponse(
+        export_history(current_user.id, format, since, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@router.post("/history/import")
+async def import_history_items(
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Add rows from an NDJSON export (plain or gzipped) to the current user's history
+    
+    The request body is read as it arrives and inserted in batches. Each line
+    needs a `question` and an `answer`; `id`, `timestamp` and `is_partial`
+    are kept when present. Rows already in your history (same `id`) are
+    skipped, so re-sending a file after an error is safe.
+    """
+    try:
+        with stage("history_write"):
+            return await import_history(current_user.id, request.stream())
+    except InvalidImport as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{e} ({e.imported} rows were imported before it)"
+        )
+
+@router.get("/related", response_model=RelatedResponse)
+async def get_related_questions(
+    q: str = Query(..., min_length=1, max_length=1000, description="Question to find similar ones to"),
+    limit: int = Query(10, ge=1, le=50),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    The current user's past questions most similar to a question, most similar first
+
+    - **q**: The question
+    - **limit**: Maximum number of questions to return (1-50)
+    """
+    with stage("related"):
+        matches = await related_index.related(q, limit, current_user.id)
+    RELATED_LOOKUPS.inc(kind="related", result="hit" if matches else "miss")
+    if not matches:
+        return RelatedResponse(items=[], count=0)
+
+    # The index keeps rows that have since been deleted; only return what is still there,
+    # live or archived
+    rows = {}
+    with stage("history_query"):
+        for model in (QueryHistory, QueryHistoryArchive):
+            missing = [row_id for row_id, _ in matches if row_id not in rows]
+            if not missing:
+                break
+            rows.update((row.id, row) for row in await db.execute(
+                select(model.id, model.question, model.timestamp).where(
+                    model.id.in_(missing), model.user_id == current_user.id
+                )
+            ))
+    items = [
+        RelatedQuestion(id=row_id, question=rows[row_id].question, timestamp=rows[row_id].timestamp, similarity=round(score, 4))
+        for row_id, score in matches if row_id in rows
     ]
+    return RelatedResponse(items=items, count=len(items))
 
-    return HistoryResponse(items=history_items, count=total)
+@router.get("/history/{item_id}", response_model=HistoryItem)
+async def get_history_item(
+    item_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get one of the current user's history items with its full answer
+    """
+    item = next((row for row in history_writer.pending_for(current_user.id) if row.id == item_id), None)
+    if item is None:
+        with stage("history_query"):
+            for model in (QueryHistory, QueryHistoryArchive):
+                item = (await db.execute(
+                    select(model).where(model.id == item_id, model.user_id == current_user.id)
+                )).scalar_one_or_none()
+                if item is not None:
+                    break
+    if item is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="History item not found")
+    return HistoryItem(
+        id=str(item.id),
+        question=item.question,
+        answer=item.answer,
+        timestamp=item.timestamp,
+        is_partial=bool(item.is_partial)
+    )
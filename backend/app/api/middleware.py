@@ -0,0 +1,188 @@
+import asyncio
+import gzip
+import logging
+import re
+import time
+from typing import Dict, Optional
+
+from starlette.datastructures import MutableHeaders
+
+from app.api.responses import encoded_entity_tag
+from app.core.config import settings
+from app.core.metrics import REQUEST_DURATION, REQUESTS_IN_FLIGHT, STAGE_DURATION, end_request, start_request, stage
+from app.core.security import generate_request_id
+
+try:
+    import brotli
+except ImportError:  # optional; without it only gzip is offered
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Accept a caller's X-Request-ID only if it is safe to put in logs and headers
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+def _route_label(scope) -> str:
+    """The matched route's path template (e.g. /api/v1/conversations/{conversation_id})"""
+    if "endpoint" not in scope:
+        # Nothing matched; one label for every unknown path keeps the series count bounded
+        return "unmatched"
+    values = {str(value): name for name, value in scope.get("path_params", {}).items()}
+    return "/".join(f"{{{values[segment]}}}" if segment in values else segment for segment in scope["path"].split("/"))
+
+class RequestMetricsMiddleware:
+    """
+    Gives every HTTP request an id and records its latency.
+
+    The id comes from the X-Request-ID request header, or is generated, and
+    is returned in X-Request-ID along with a Server-Timing header breaking
+    down the stages timed so far. Written as plain ASGI so streamed
+    responses are timed to their last byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        request_id = incoming if _VALID_REQUEST_ID.match(incoming) else generate_request_id()
+        context, token = start_request(request_id)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_with_headers(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = [*message.get("headers", []), (b"x-request-id", request_id.encode())]
+                if context.stages:
+                    timing = ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in context.stages.items())
+                    headers.append((b"server-timing", timing.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            elapsed = time.perf_counter() - started
+            REQUESTS_IN_FLIGHT.dec()
+            # Label by route template, not the raw path, so ids in URLs don't create new series
+            route = _route_label(scope)
+            REQUEST_DURATION.observe(elapsed, method=scope["method"], route=route, status=status_code)
+            for name, seconds in context.stages.items():
+                STAGE_DURATION.observe(seconds, route=route, stage=name)
+            if settings.SLOW_REQUEST_SECONDS and elapsed >= settings.SLOW_REQUEST_SECONDS:
+                breakdown = ", ".join(f"{name}={seconds:.3f}s" for name, seconds in context.stages.items())
+                logger.warning(f"Slow request {scope['method']} {route} ({status_code}) took {elapsed:.3f}s: {breakdown or 'no stages'}")
+            end_request(token)
+
+# Content types worth compressing; anything else (images, archives) is sent as is
+_COMPRESSIBLE_TYPES = ("text/", "application/json", "application/x-ndjson", "application/xml", "application/javascript")
+
+# Bodies larger than this are compressed in a thread (zlib and brotli release the GIL) so the loop isn't held up
+_THREAD_COMPRESS_SIZE = 64 * 1024
+
+def _accepted_encodings(header: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into {coding: q}"""
+    accepted = {}
+    for part in header.lower().split(","):
+        coding, *params = [piece.strip() for piece in part.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+def choose_encoding(header: str) -> Optional[str]:
+    """The coding to use for a response, preferring br over gzip on equal q, or None for identity"""
+    accepted = _accepted_encodings(header)
+    best, best_q = None, 0.0
+    for coding in (("br", "gzip") if brotli is not None else ("gzip",)):
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+class CompressionMiddleware:
+    """
+    Compresses responses with brotli or gzip, as negotiated by Accept-Encoding
+
+    Only complete bodies are compressed. Streamed responses (SSE, NDJSON)
+    are passed through so each event reaches the client as soon as it is
+    sent, and so are small bodies, non-text types and responses that are
+    already encoded. The time spent shows up as the "compress" stage.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 4, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                # Hold the headers until the first body chunk shows whether this is worth compressing
+                start_message = message
+                return
+            if start_message is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            headers = MutableHeaders(raw=list(start_message.get("headers", [])))
+            body = message.get("body", b"")
+            content_type = headers.get("content-type", "")
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+                or not content_type.startswith(_COMPRESSIBLE_TYPES)
+            ):
+                await send(start_message)
+                start_message = None
+                await send(message)
+                return
+
+            with stage("compress"):
+                if len(body) >= _THREAD_COMPRESS_SIZE:
+                    compressed = await asyncio.to_thread(self._compress, body, encoding)
+                else:
+                    compressed = self._compress(body, encoding)
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(compressed))
+            if "etag" in headers:
+                headers["etag"] = encoded_entity_tag(headers["etag"], encoding)
+            headers.add_vary_header("Accept-Encoding")
+            await send({**start_message, "headers": headers.raw})
+            start_message = None
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
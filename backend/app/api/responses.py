@@ -0,0 +1,77 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any, Dict, Optional
+
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+from app.core.metrics import stage
+
+# Content codings CompressionMiddleware names in the ETags of responses it compresses
+_ETAG_CODINGS = ("br", "gzip")
+
+class TimedJSONResponse(JSONResponse):
+    """
+    JSON response encoded with orjson, reporting its encoding time as the
+    request's "serialize" stage
+
+    Besides what JSONResponse accepts, orjson encodes datetimes and UUIDs
+    itself, so endpoints can hand it plain rows without a pydantic pass.
+    """
+
+    def render(self, content: Any) -> bytes:
+        with stage("serialize"):
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def entity_tag(*parts: Any) -> str:
+    """A strong ETag for the representation identified by `parts` (owner, version, query parameters...)"""
+    digest = hashlib.blake2b(orjson.dumps(parts), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+def encoded_entity_tag(etag: str, encoding: str) -> str:
+    """The ETag of a response once compressed with `encoding`; a strong ETag must differ per coding"""
+    if etag.startswith('"') and etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return etag
+
+def _identity_tag(tag: str) -> str:
+    """A tag from If-None-Match without any W/ prefix or content-coding suffix"""
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    for coding in _ETAG_CODINGS:
+        if tag.endswith(f'-{coding}"'):
+            return tag[:-len(coding) - 2] + '"'
+    return tag
+
+def validator_headers(etag: str, last_modified: Optional[datetime]) -> Dict[str, str]:
+    """
+    ETag and Last-Modified for a per-user response, which browsers must
+    revalidate before reusing
+    """
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified is not None:
+        # Stored as naive UTC
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+def not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> Optional[Response]:
+    """
+    A 304 response if the request's If-None-Match has `etag` (in any
+    content coding), else None.
+
+    If-Modified-Since is not used: Last-Modified only has one-second
+    resolution, so two changes within a second would look like one.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    for tag in (tag.strip() for tag in header.split(",")):
+        if tag == "*" or _identity_tag(tag) == etag:
+            # Echo the client's tag, so a compressed copy is named by the tag it was sent with
+            return Response(
+                status_code=304,
+                headers=validator_headers(etag if tag == "*" else tag, last_modified)
+            )
+    return None
@@ -1,6 +1,6 @@
 import os
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Any, Dict, List
 from dotenv import load_dotenv
 import secrets
 
@@ -18,11 +18,155 @@ class Settings(BaseSettings):
     
     # LLM settings
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
+    GEMINI_MODEL: str = "gemini-1.5-flash"
+    GEMINI_BASE_URL: str = "https://generativelanguage.googleapis.com/v1beta"
+    
+    # Model registry: name -> {"model", optional "base_url"/"api_key"}; empty means just GEMINI_MODEL as "default"
+    LLM_MODELS: Dict[str, Dict[str, str]] = {}
+    LLM_DEFAULT_MODEL: str = "default"
+    # Routing rules, first match wins, e.g. [{"tier": "pro", "model": "pro"}, {"min_question_chars": 1000, "model": "pro"}]
+    LLM_ROUTES: List[Dict[str, Any]] = []
+    LLM_FALLBACK_MODELS: List[str] = []  # tried in order when the routed model fails
+    
+    # Prompt templates: name -> {"system_instruction" (or "system_instruction_file"), optional "user_template",
+    # "context_template", "generation_config", "cache_context"}; "default" is built in and can be overridden.
+    # Routing rules pick one with "prompt"; otherwise LLM_PROMPT_TEMPLATE is used
+    LLM_PROMPT_TEMPLATES: Dict[str, Dict[str, Any]] = {}
+    LLM_PROMPT_TEMPLATE: str = "default"
+    # Gemini context caching for templates with "cache_context" (the instruction must reach the model's minimum size)
+    LLM_CONTEXT_CACHE_TTL_SECONDS: int = 3600
+    LLM_CONTEXT_CACHE_RETRY_SECONDS: float = 300.0  # wait before trying to create a cache again after a failure
+    
+    # Hedged requests: re-send a call that has taken longer than the model's observed p95
+    LLM_HEDGE_ENABLED: bool = False
+    LLM_HEDGE_MIN_SAMPLES: int = 20  # latencies to observe before hedging
+    LLM_HEDGE_MIN_DELAY: float = 0.05  # never hedge sooner than this (seconds)
+    
+    # LLM HTTP client settings (connection pool and timeouts in seconds)
+    LLM_MAX_CONNECTIONS: int = 100
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    LLM_KEEPALIVE_EXPIRY: float = 30.0
+    LLM_MAX_CONCURRENCY_PER_HOST: int = 50
+    LLM_CONNECT_TIMEOUT: float = 5.0
+    LLM_READ_TIMEOUT: float = 60.0
+    LLM_WRITE_TIMEOUT: float = 10.0
+    LLM_POOL_TIMEOUT: float = 10.0
+    LLM_COALESCE_REQUESTS: bool = True  # share one upstream call between identical concurrent questions
+    
+    # Upstream governor: token bucket for our Gemini quota, retries with jittered backoff, circuit breaker
+    LLM_RATE_LIMIT_PER_MINUTE: int = 0  # 0 disables; set to the Gemini quota
+    LLM_RATE_LIMIT_BURST: int = 10
+    LLM_RATE_LIMIT_MAX_WAIT: float = 10.0  # seconds a call may wait for a token before failing
+    LLM_MAX_RETRIES: int = 3  # on 429/5xx and transport errors
+    LLM_BACKOFF_BASE: float = 0.5
+    LLM_BACKOFF_MAX: float = 20.0
+    LLM_CIRCUIT_FAILURE_THRESHOLD: int = 5  # consecutive failures before failing fast
+    LLM_CIRCUIT_RESET_SECONDS: float = 30.0
+    
+    # Rate limit state ("memory" is per-process; "database" is shared by all workers)
+    RATE_LIMIT_BACKEND: str = "memory"
+    
+    # Per-user request quotas, checked before calling Gemini (0 disables)
+    USER_QUOTA_PER_MINUTE: int = 120
+    USER_QUOTA_BURST: int = 600  # enough for a full /ask/batch
+    
+    # Batch /ask settings (the concurrency limit is shared by all batches in a process)
+    BATCH_MAX_ITEMS: int = 500
+    BATCH_MAX_CONCURRENCY: int = 20
+    
+    # History settings
+    HISTORY_COUNT_CACHE_TTL_SECONDS: int = 60
+    HISTORY_PREVIEW_CHARS: int = 200  # answer characters in /history?view=preview items
+    HISTORY_EXPORT_CHUNK_SIZE: int = 1000  # rows read per query while streaming /history/export
+    HISTORY_IMPORT_BATCH_SIZE: int = 1000  # rows per bulk insert in /history/import
+    HISTORY_IMPORT_MAX_LINE_BYTES: int = 1048576  # longest NDJSON line /history/import accepts
+    
+    # Related questions: an embedding index of history questions in memory-mapped files shared by all workers
+    RELATED_INDEX_ENABLED: bool = True
+    RELATED_INDEX_PATH: str = "related_index"
+    EMBEDDING_MODEL: str = "hashing"  # or a sentence-transformers model, e.g. "all-MiniLM-L6-v2" (needs that package)
+    EMBEDDING_DIM: int = 256  # hashing embedder only
+    RELATED_INDEX_MIN_TRAIN_ROWS: int = 20000  # below this every search is exact
+    RELATED_INDEX_LISTS: int = 0  # clusters for approximate search; 0 picks ~sqrt(rows)
+    RELATED_INDEX_PROBES: int = 16  # clusters scanned per search; more finds more, slower
+    RELATED_ANSWER_THRESHOLD: float = 0.0  # answer /ask from a past answer at least this similar (0 disables)
+    RELATED_ANSWER_SCOPE: str = "all"  # "all" reuses anyone's past answer, "user" only the asker's own
+    
+    # History archival: rows older than HISTORY_ARCHIVE_AFTER_DAYS move to qa_llm_archive with compressed answers
+    HISTORY_ARCHIVE_AFTER_DAYS: int = 0  # 0 disables archiving
+    HISTORY_RETENTION_DAYS: int = 0  # delete history (live and archived) older than this; 0 keeps it forever
+    HISTORY_ARCHIVE_INTERVAL_SECONDS: float = 3600.0
+    HISTORY_ARCHIVE_BATCH_SIZE: int = 1000  # rows moved or deleted per transaction
+    HISTORY_ARCHIVE_CODEC: str = "zlib"  # or "zstd" (needs the zstandard package)
+    HISTORY_ARCHIVE_LEVEL: int = 6
+    
+    # Queued /ask jobs (POST /ask/jobs): a table-backed queue drained by ASK_JOB_WORKERS concurrent workers per process
+    ASK_JOB_WORKERS: int = 4  # 0 leaves the jobs to dedicated worker processes (python worker.py)
+    ASK_JOB_POLL_SECONDS: float = 1.0  # how often idle workers look for jobs queued by other processes
+    ASK_JOB_VISIBILITY_TIMEOUT_SECONDS: float = 300.0  # a claimed job not finished by then is handed to another worker
+    ASK_JOB_MAX_ATTEMPTS: int = 3
+    ASK_JOB_RETRY_BASE_SECONDS: float = 5.0  # retry delay doubles with each attempt, never below Gemini's Retry-After
+    ASK_JOB_RETRY_MAX_SECONDS: float = 300.0
+    ASK_JOB_MAX_PENDING_PER_USER: int = 100  # queued or running jobs a user may have at once
+    ASK_JOB_TIER_PRIORITY: Dict[str, int] = {}  # e.g. {"pro": 10}; higher priorities are claimed first
+    ASK_JOB_RETENTION_HOURS: float = 24.0  # finished jobs are deleted after this
+    ASK_JOB_SHUTDOWN_GRACE_SECONDS: float = 10.0  # running jobs not done by then go back on the queue
+    
+    # Account deletion: DELETE /auth/me deactivates the user at once and a background job removes their data
+    USER_DELETION_BATCH_SIZE: int = 1000  # rows deleted per transaction
+    USER_DELETION_BATCH_PAUSE_SECONDS: float = 0.05  # between batches, so other writers get the database
+    USER_DELETION_POLL_SECONDS: float = 10.0  # how often workers look for jobs queued by other workers
+    USER_DELETION_STALE_SECONDS: float = 300.0  # a running job with no progress this long is taken over
+    USER_DELETION_MAX_ATTEMPTS: int = 5
+    USER_DELETION_DRAIN_SECONDS: float = 30.0  # longest a job waits for answers its worker still has queued for the user
+    
+    # History write-behind queue (rows are bulk-inserted in batches, spooled to disk if the DB is down)
+    HISTORY_WRITE_BATCH_SIZE: int = 100
+    HISTORY_WRITE_FLUSH_INTERVAL: float = 0.2  # seconds
+    HISTORY_WRITE_MAX_QUEUE: int = 10000
+    HISTORY_SPOOL_PATH: str = "history_spool.jsonl"
+    HISTORY_SPOOL_RETRY_SECONDS: float = 30.0
+    
+    # Conversation settings (token counts are estimated at ~4 characters per token)
+    CONVERSATION_TOKEN_BUDGET: int = 4000  # prior turns sent with each new question
+    CONVERSATION_MAX_TURN_TOKENS: int = 1000  # longer questions/answers are truncated in the window
+    CONVERSATION_MAX_LOAD_TURNS: int = 50  # newest turns read when a thread isn't cached
+    CONVERSATION_CACHE_MAX_ENTRIES: int = 1000
+    CONVERSATION_CACHE_TTL_SECONDS: int = 60 * 30
+    
+    # Answer cache settings ("memory" is per-process; "database" is shared by all workers)
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_BACKEND: str = "memory"
+    ANSWER_CACHE_MAX_ENTRIES: int = 1000
+    ANSWER_CACHE_TTL_SECONDS: int = 60 * 60 * 24  # 1 day
     
     # Security settings
     SECRET_KEY: str = os.getenv("SECRET_KEY", secrets.token_urlsafe(32))
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 7  # 7 days
+    ADMIN_EMAILS: List[str] = []
+    
+    # Password hashing (existing hashes are upgraded on login when BCRYPT_ROUNDS changes)
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_PENDING: int = 64  # hash/verify calls allowed to queue before shedding load
+    PASSWORD_HASH_QUEUE_TIMEOUT: float = 5.0
+    
+    # Authenticated-user cache (token -> user snapshot); kept short since other workers can't invalidate it
+    AUTH_CACHE_ENABLED: bool = True
+    AUTH_CACHE_MAX_ENTRIES: int = 10000
+    AUTH_CACHE_TTL_SECONDS: int = 30
+    
+    # Observability: Prometheus metrics at /metrics, request ids in logs and the X-Request-ID header
+    METRICS_ENABLED: bool = True
+    LOG_LEVEL: str = "INFO"
+    SLOW_REQUEST_SECONDS: float = 5.0  # log a per-stage breakdown of slower requests (0 disables)
+    
+    # Response compression, negotiated from Accept-Encoding (br needs the optional brotli package)
+    COMPRESSION_ENABLED: bool = True
+    COMPRESSION_MIN_SIZE: int = 1024  # bytes; smaller responses aren't worth compressing
+    COMPRESSION_GZIP_LEVEL: int = 4  # above 4 costs much more CPU for little gain on JSON
+    COMPRESSION_BROTLI_QUALITY: int = 4
     
     # Database settings
     POSTGRES_USER: str = os.getenv("POSTGRES_USER", "postgres")
@@ -35,6 +179,14 @@ class Settings(BaseSettings):
         f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
     )
     
+    # Database connection pool settings (applied to both the sync and async engines)
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800  # seconds; -1 disables recycling
+    DB_POOL_PRE_PING: bool = True
+    DB_SCHEMA_LOCK_TIMEOUT: float = 300.0  # seconds a starting worker waits for another one's schema checks
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -0,0 +1,210 @@
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from a cache hit up to a slow Gemini answer
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# (labels, value) pairs produced at scrape time by a metric's `collect` callback
+Samples = Iterable[Tuple[Dict[str, Any], float]]
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), collect: Optional[Callable[[], Samples]] = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.collect = collect
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _lines(self) -> List[str]:
+        if self.collect is not None:
+            try:
+                samples = [(self._key(labels), value) for labels, value in self.collect()]
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Failed to collect metric {self.name}: {str(e)}")
+                samples = []
+        else:
+            with self._lock:
+                samples = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in samples]
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self._lines()])
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+class Gauge(_Metric):
+    """Value that goes up and down, either set directly or read by `collect` at scrape time"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _lines(self) -> List[str]:
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        names = (*self.labelnames, "le")
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(names, (*key, _format_value(bound)))} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Every metric in the process, rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = (), collect: Optional[Callable[[], Samples]] = None) -> Counter:
+        return self._register(Counter(name, help, labels, collect))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect: Optional[Callable[[], Samples]] = None) -> Gauge:
+        return self._register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+registry = MetricsRegistry()
+
+REQUEST_DURATION = registry.histogram(
+    "qa_http_request_duration_seconds", "HTTP request latency, until the last byte is sent", ["method", "route", "status"]
+)
+REQUESTS_IN_FLIGHT = registry.gauge("qa_http_requests_in_flight", "HTTP requests being handled")
+STAGE_DURATION = registry.histogram(
+    "qa_request_stage_duration_seconds", "Time spent in each stage of a request", ["route", "stage"]
+)
+
+class RequestContext:
+    """Per-request state shared by the middleware, the endpoints and the log filter"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        # Seconds spent in each stage, in the order the stages first ran
+        self.stages: Dict[str, float] = {}
+
+_request_context: ContextVar[Optional[RequestContext]] = ContextVar("request_context", default=None)
+
+def start_request(request_id: str):
+    """Bind a new RequestContext to the current task; returns it and the token to end it with"""
+    context = RequestContext(request_id)
+    return context, _request_context.set(context)
+
+def end_request(token):
+    _request_context.reset(token)
+
+def current_request_id() -> Optional[str]:
+    """ID of the request being handled, or None outside of one"""
+    context = _request_context.get()
+    return context.request_id if context else None
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as one stage of the current request
+
+    Durations add up if a stage runs more than once. They are reported per
+    route when the request ends; outside a request they go straight to the
+    histogram with route "background".
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        context = _request_context.get()
+        if context is None:
+            STAGE_DURATION.observe(elapsed, route="background", stage=name)
+        else:
+            context.stages[name] = context.stages.get(name, 0.0) + elapsed
+
+class RequestIdLogFilter(logging.Filter):
+    """Adds `request_id` to every log record ("-" outside a request)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id() or "-"
+        return True
+
+def configure_logging(level: str):
+    """Log to stderr with the request id on every line"""
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, RequestIdLogFilter) for f in handler.filters):
+            handler.addFilter(RequestIdLogFilter())
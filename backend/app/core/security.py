@@ -1,20 +1,34 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 from jose import jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.cache import TTLCache
 from app.core.config import settings
+from app.core.metrics import stage
 from app.db.database import get_db, User
 import secrets
+import time
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# bcrypt is deliberately CPU-heavy, so it runs in a small dedicated pool rather than on the event loop.
+# The semaphore bounds how many calls may wait for the pool; beyond that, requests are shed with a 503.
+_password_executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_password_slots = asyncio.Semaphore(settings.PASSWORD_HASH_MAX_PENDING)
 
 # OAuth2 scheme for token authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/auth/login")
 
+# Decoded token -> detached user snapshot, so repeat requests skip the JWT decode and DB lookup
+_user_cache = TTLCache(maxsize=settings.AUTH_CACHE_MAX_ENTRIES, ttl=settings.AUTH_CACHE_TTL_SECONDS)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against a hash"""
     return pwd_context.verify(plain_password, hashed_password)
@@ -23,6 +37,34 @@ def get_password_hash(password: str) -> str:
     """Hash a password"""
     return pwd_context.hash(password)
 
+async def _run_password_task(func, *args):
+    """Run a hashing call in the password pool, applying backpressure when it is saturated"""
+    try:
+        await asyncio.wait_for(_password_slots.acquire(), timeout=settings.PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication service is busy, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_slots.release()
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password without blocking the event loop"""
+    return await _run_password_task(pwd_context.hash, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verify a password without blocking the event loop
+    
+    Returns (verified, new_hash); new_hash is set when the stored hash uses
+    outdated parameters (e.g. a different BCRYPT_ROUNDS) and should be saved.
+    """
+    return await _run_password_task(pwd_context.verify_and_update, plain_password, hashed_password)
+
 def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
     """Create JWT access token"""
     to_encode = data.copy()
@@ -31,28 +73,64 @@ def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta]
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-def get_current_user(
+async def get_current_user(
     token: str = Depends(oauth2_scheme), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> User:
-    """Get current authenticated user from token"""
+    """
+    Get current authenticated user from token
+    
+    Returns a detached snapshot of the user that may be shared between
+    requests; endpoints that modify the user must load it from their session.
+    """
+    if settings.AUTH_CACHE_ENABLED:
+        cached = _user_cache.get(token)
+        if cached is not None:
+            return cached
+    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        with stage("jwt_decode"):
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
     except jwt.JWTError:
         raise credentials_exception
         
-    user = db.query(User).filter(User.id == user_id).first()
+    with stage("user_lookup"):
+        user = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
     if user is None or not user.is_active:
         raise credentials_exception
-    return user
+    
+    snapshot = _snapshot_user(user)
+    if settings.AUTH_CACHE_ENABLED:
+        # Never cache a token beyond its own expiry
+        ttl = min(settings.AUTH_CACHE_TTL_SECONDS, payload.get("exp", 0) - time.time())
+        if ttl > 0:
+            _user_cache.set(token, snapshot, ttl=ttl)
+    return snapshot
+
+def _snapshot_user(user: User) -> User:
+    """Copy a user's column values into a new, session-less User instance"""
+    return User(**{column.name: getattr(user, column.name) for column in User.__table__.columns})
+
+def invalidate_user_cache(user_id: str) -> int:
+    """Drop cached snapshots for a user after it is updated or deleted"""
+    return _user_cache.remove_if(lambda token, user: user.id == user_id)
+
+async def get_current_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """Require the current user to be listed in ADMIN_EMAILS"""
+    if current_user.email not in settings.ADMIN_EMAILS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required"
+        )
+    return current_user
 
 def generate_request_id() -> str:
     """Generate a unique request ID for tracking"""
@@ -0,0 +1,58 @@
+import zlib
+from typing import Optional
+
+from sqlalchemy import LargeBinary
+from sqlalchemy.types import TypeDecorator
+
+from app.core.config import settings
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; zlib is always there
+    zstandard = None
+
+# First byte of every stored blob, naming how the rest is encoded
+_RAW, _ZLIB, _ZSTD = b"\x00", b"\x01", b"\x02"
+
+# Texts shorter than this gain nothing from compression and are stored as they are
+_MIN_COMPRESS_BYTES = 64
+
+def compress_text(value: str, codec: Optional[str] = None, level: Optional[int] = None) -> bytes:
+    """Encode text as a self-describing blob with HISTORY_ARCHIVE_CODEC (zlib or zstd)"""
+    codec = codec or settings.HISTORY_ARCHIVE_CODEC
+    level = settings.HISTORY_ARCHIVE_LEVEL if level is None else level
+    data = value.encode("utf-8")
+    if len(data) < _MIN_COMPRESS_BYTES:
+        return _RAW + data
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("HISTORY_ARCHIVE_CODEC=zstd needs the zstandard package; install it or use zlib")
+        packed = _ZSTD + zstandard.ZstdCompressor(level=level).compress(data)
+    elif codec == "zlib":
+        packed = _ZLIB + zlib.compress(data, level)
+    else:
+        raise ValueError(f"Unknown HISTORY_ARCHIVE_CODEC {codec!r}")
+    # Incompressible text (already short, or random) is kept raw
+    return packed if len(packed) < len(data) + 1 else _RAW + data
+
+def decompress_text(blob: bytes) -> str:
+    header, body = blob[:1], blob[1:]
+    if header == _ZLIB:
+        return zlib.decompress(body).decode("utf-8")
+    if header == _ZSTD:
+        if zstandard is None:
+            raise RuntimeError("This row was archived with zstd; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(body).decode("utf-8")
+    return body.decode("utf-8")
+
+class CompressedText(TypeDecorator):
+    """Text stored as a compressed blob, compressed on write and decompressed on read"""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else decompress_text(bytes(value))
@@ -1,16 +1,107 @@
-from sqlalchemy import create_engine, Column, String, DateTime, Text, inspect, Boolean, ForeignKey, MetaData, text
+from sqlalchemy import create_engine, Column, String, DateTime, Text, inspect, Boolean, Float, ForeignKey, Index, Integer, MetaData, delete, insert, select, text
+from sqlalchemy.engine import URL, Connection, Engine, make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import StaticPool
 from app.core.config import settings
+from app.core.metrics import registry
+from app.db.compression import CompressedText
+from app.db.search import ensure_search_index
+from typing import Any, Callable, Dict, Optional
 import datetime
 import logging
+import time
 import uuid
 
 logger = logging.getLogger(__name__)
 
-# Create SQLAlchemy engine
-engine = create_engine(settings.DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Drivers used for each backend, whichever driver DATABASE_URL names
+SYNC_DRIVERS = {"postgresql": "psycopg2", "sqlite": "pysqlite"}
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+def _url_with_driver(database_url: str, drivers: Dict[str, str], is_async: bool) -> URL:
+    """Return DATABASE_URL using a sync or async driver for its backend"""
+    url = make_url(database_url)
+    if url.get_dialect().is_async == is_async:
+        return url
+    backend = url.get_backend_name()
+    if backend not in drivers:
+        raise ValueError(f"No {'async' if is_async else 'sync'} driver configured for {backend!r} databases")
+    return url.set(drivername=f"{backend}+{drivers[backend]}")
+
+def _engine_options(url: URL) -> Dict[str, Any]:
+    """Connection pool options from Settings"""
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory SQLite lives in a single connection
+        return {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+# Engines are created on first use, so importing this module (or main.py) doesn't load drivers or build pools
+_engine: Optional[Engine] = None
+_async_engine: Optional[AsyncEngine] = None
+
+def get_engine() -> Engine:
+    """Sync engine, used for schema management and scripts"""
+    global _engine
+    if _engine is None:
+        url = _url_with_driver(settings.DATABASE_URL, SYNC_DRIVERS, is_async=False)
+        _engine = create_engine(url, **_engine_options(url))
+    return _engine
+
+def get_async_engine() -> AsyncEngine:
+    """Async engine, used by the API so queries never block the event loop"""
+    global _async_engine
+    if _async_engine is None:
+        url = _url_with_driver(settings.DATABASE_URL, ASYNC_DRIVERS, is_async=True)
+        _async_engine = create_async_engine(url, **_engine_options(url))
+    return _async_engine
+
+async def dispose_engines():
+    """Close pooled connections of whichever engines were created (called on application shutdown)"""
+    if _async_engine is not None:
+        await _async_engine.dispose()
+    if _engine is not None:
+        _engine.dispose()
+
+class _LazySessionFactory:
+    """Session factory that builds its sessionmaker, and so its engine, on first call"""
+
+    def __init__(self, make: Callable[[], Callable[..., Any]]):
+        self._make = make
+        self._factory = None
+
+    def __call__(self, **kwargs):
+        if self._factory is None:
+            self._factory = self._make()
+        return self._factory(**kwargs)
+
+SessionLocal = _LazySessionFactory(lambda: sessionmaker(autocommit=False, autoflush=False, bind=get_engine()))
+AsyncSessionLocal = _LazySessionFactory(
+    lambda: async_sessionmaker(get_async_engine(), class_=AsyncSession, autoflush=False, expire_on_commit=False)
+)
+
+def _pool_samples():
+    """Connection counts for the metrics endpoint; pools without a fixed size (StaticPool) are skipped"""
+    for name, engine in (("sync", _engine), ("async", _async_engine)):
+        pool = engine.pool if engine is not None else None
+        if not hasattr(pool, "checkedout"):
+            continue
+        yield {"engine": name, "state": "checked_out"}, pool.checkedout()
+        yield {"engine": name, "state": "idle"}, pool.checkedin()
+        yield {"engine": name, "state": "capacity"}, pool.size() + settings.DB_MAX_OVERFLOW
+
+registry.gauge(
+    "qa_db_pool_connections", "Database connections by pool state (utilization is checked_out / capacity)",
+    ["engine", "state"], collect=_pool_samples
+)
 
 Base = declarative_base()
 
@@ -24,10 +115,24 @@ class User(Base):
     hashed_password = Column(String, nullable=False)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    tier = Column(String, default="free")  # matched by LLM_ROUTES to pick a model
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)  # last profile change; Last-Modified of /auth/me
+    # Bumped in every transaction that changes the user's history; the version /history ETags are built from
+    history_version = Column(Integer, nullable=False, default=0, server_default="0")
+    history_updated_at = Column(DateTime, nullable=True)
     
     # Relationship with QueryHistory
     queries = relationship("QueryHistory", back_populates="user")
 
+# A multi-turn thread; its turns are the QueryHistory rows that point at it
+class Conversation(Base):
+    __tablename__ = "conversations"
+
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
+    title = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
 # Define QueryHistory model with user relationship
 class QueryHistory(Base):
     __tablename__ = "qa_llm"  # Use the existing table name
@@ -37,78 +142,202 @@ class QueryHistory(Base):
     answer = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     
+    # Set when a streamed answer was cut short by a client disconnect or upstream error
+    is_partial = Column(Boolean, default=False)
+    
     # Add user relationship
     user_id = Column(String, ForeignKey("users.id", name="fk_user_id"), nullable=True)
     user = relationship("User", back_populates="queries")
+    
+    # Set when the question was asked as a turn in a conversation
+    conversation_id = Column(String, ForeignKey("conversations.id", name="fk_conversation_id"), nullable=True)
+
+# Serves /history: a user's rows newest first, with id as the keyset tie-breaker
+Index("ix_qa_llm_user_id_timestamp", QueryHistory.user_id, QueryHistory.timestamp.desc(), QueryHistory.id.desc())
+
+# Loads a conversation's turns in order
+Index("ix_qa_llm_conversation_id_timestamp", QueryHistory.conversation_id, QueryHistory.timestamp)
+
+# Finds the rows old enough to archive
+Index("ix_qa_llm_timestamp", QueryHistory.timestamp)
+
+# History moved out of qa_llm by the archiver (app/services/archive.py), with answers stored compressed.
+# On Postgres it is partitioned by month, so retention can drop a whole month at once.
+class QueryHistoryArchive(Base):
+    __tablename__ = "qa_llm_archive"
+    __table_args__ = {"postgresql_partition_by": "RANGE (timestamp)"}
+
+    id = Column(String, primary_key=True)
+    # Part of the key because a partitioned table's key must include the partition column
+    timestamp = Column(DateTime, primary_key=True)
+    user_id = Column(String, ForeignKey("users.id", name="fk_archive_user_id"), nullable=True)
+    conversation_id = Column(String, nullable=True)  # no foreign key; deleting a conversation detaches its turns
+    question = Column(Text, nullable=False)
+    answer = Column(CompressedText, nullable=False)
+    answer_length = Column(Integer, nullable=False)  # characters, so previews don't need the answer's length
+    is_partial = Column(Boolean, default=False)
+    archived_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# Continues /history past the live rows, in the same order
+Index(
+    "ix_qa_llm_archive_user_id_timestamp",
+    QueryHistoryArchive.user_id, QueryHistoryArchive.timestamp.desc(), QueryHistoryArchive.id.desc()
+)
+
+# Older turns of a conversation, and detaching them when it is deleted
+Index("ix_qa_llm_archive_conversation_id_timestamp", QueryHistoryArchive.conversation_id, QueryHistoryArchive.timestamp)
+
+# Finds rows past retention
+Index("ix_qa_llm_archive_timestamp", QueryHistoryArchive.timestamp)
+
+# Shared answer cache, used when ANSWER_CACHE_BACKEND is "database"
+class AnswerCacheEntry(Base):
+    __tablename__ = "llm_answer_cache"
+
+    key = Column(String(64), primary_key=True)
+    question = Column(Text, nullable=False)
+    answer = Column(Text, nullable=False)
+    model = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+# Token buckets shared by all workers, used when RATE_LIMIT_BACKEND is "database"
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # epoch seconds
+
+# Background deletion of an account and its history (app/services/deletion.py).
+# user_id has no foreign key since the user row is deleted before the job finishes.
+class UserDeletionJob(Base):
+    __tablename__ = "user_deletion_jobs"
 
-def create_tables_if_needed():
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, nullable=False, index=True)
+    status = Column(String, nullable=False, default="pending", index=True)  # pending, running, done or failed
+    history_deleted = Column(Integer, nullable=False, default=0)
+    archive_deleted = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)  # also the running job's heartbeat
+    finished_at = Column(DateTime, nullable=True)
+
+# A question queued with POST /ask/jobs (app/services/ask_jobs.py)
+class AskJob(Base):
+    __tablename__ = "ask_jobs"
+
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, nullable=False)
+    question = Column(Text, nullable=False)
+    context = Column(Text, nullable=True)
+    conversation_id = Column(String, nullable=True)
+    tier = Column(String, nullable=True)  # the user's tier when the job was submitted, for model routing
+    priority = Column(Integer, nullable=False, default=0)
+    status = Column(String, nullable=False, default="queued")  # queued, running, done or failed
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)  # not claimed before this
+    locked_by = Column(String, nullable=True)  # worker running the job
+    locked_until = Column(DateTime, nullable=True)  # visibility timeout of a running job
+    answer = Column(Text, nullable=True)
+    history_id = Column(String, nullable=True)
+    result_metadata = Column(Text, nullable=True)  # JSON
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+# Workers claim the highest priority, oldest available job
+Index("ix_ask_jobs_claim", AskJob.status, AskJob.priority.desc(), AskJob.available_at)
+
+# Counts a user's pending jobs, and finds them when the user is deleted
+Index("ix_ask_jobs_user_id_status", AskJob.user_id, AskJob.status)
+
+# Tables without a legacy schema to migrate; they are simply created when missing
+AUXILIARY_TABLES = [
+    AnswerCacheEntry.__table__, RateLimitBucket.__table__, QueryHistoryArchive.__table__, UserDeletionJob.__table__,
+    AskJob.__table__,
+]
+
+# Bump whenever a model, index or the search index changes: the next startup then re-runs
+# create_tables_if_needed once, and every startup after that skips it
+SCHEMA_VERSION = 6
+
+# The schema version the database was last brought up to (a single row)
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    applied_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# Any constant works; it just has to be the same for every worker
+SCHEMA_LOCK_KEY = 0x7161_6C6C6D
+
+def _add_missing_columns(connection: Connection, table):
+    """ALTER TABLE ... ADD COLUMN for model columns the existing table lacks"""
+    existing_columns = {col['name'] for col in inspect(connection).get_columns(table.name)}
+    required_columns = {col.name for col in table.columns}
+    
+    missing_columns = required_columns - existing_columns
+    if missing_columns:
+        logger.warning(f"Missing columns in {table.name} table: {missing_columns}")
+        for column_name in missing_columns:
+            column = table.columns[column_name]
+            column_type = column.type.compile(connection.dialect)
+            nullable = "NULL" if column.nullable else "NOT NULL"
+            # Existing rows need a value for a NOT NULL column
+            default = connection.dialect.ddl_compiler(connection.dialect, None).get_column_default_string(column)
+            default = f" DEFAULT {default}" if default is not None else ""
+            
+            sql = f"ALTER TABLE {table.name} ADD COLUMN {column_name} {column_type}{default} {nullable}"
+            logger.info(f"Adding column with: {sql}")
+            try:
+                # A savepoint, so one failed statement doesn't undo the rest of the migration
+                with connection.begin_nested():
+                    connection.execute(text(sql))
+                logger.info(f"Added column {column_name} to {table.name} table")
+            except Exception as e:
+                logger.error(f"Error adding column {column_name}: {str(e)}")
+
+def create_tables_if_needed(connection: Connection):
     """Create tables if they don't exist, and add missing columns."""
     
-    inspector = inspect(engine)
+    inspector = inspect(connection)
+    existing_tables = set(inspector.get_table_names())
     
     # Check if tables exist
-    if not inspector.has_table("users"):
+    if "users" not in existing_tables:
         # Users table doesn't exist, create it
         logger.info("Creating users table")
-        User.__table__.create(engine)
+        User.__table__.create(connection)
     else:
         # Verify all columns exist in users table
-        existing_columns = {col['name'] for col in inspector.get_columns("users")}
-        required_columns = {col.name for col in User.__table__.columns}
-        
-        missing_columns = required_columns - existing_columns
-        if missing_columns:
-            logger.warning(f"Missing columns in users table: {missing_columns}")
-            # Add missing columns if needed
-            with engine.connect() as connection:
-                for column_name in missing_columns:
-                    column = User.__table__.columns[column_name]
-                    column_type = column.type.compile(engine.dialect)
-                    nullable = "NULL" if column.nullable else "NOT NULL"
-                    
-                    sql = f"ALTER TABLE users ADD COLUMN {column_name} {column_type} {nullable}"
-                    logger.info(f"Adding column with: {sql}")
-                    try:
-                        connection.execute(text(sql))
-                        connection.commit()
-                        logger.info(f"Added column {column_name} to users table")
-                    except Exception as e:
-                        logger.error(f"Error adding column {column_name}: {str(e)}")
-                        connection.rollback()
+        _add_missing_columns(connection, User.__table__)
+
+    # Conversations must exist before qa_llm references them
+    if "conversations" not in existing_tables:
+        logger.info("Creating conversations table")
+        Conversation.__table__.create(connection)
 
     # Check qa_llm table
-    if not inspector.has_table("qa_llm"):
+    if "qa_llm" not in existing_tables:
         # qa_llm table doesn't exist, create it
         logger.info("Creating qa_llm table")
-        QueryHistory.__table__.create(engine)
+        QueryHistory.__table__.create(connection)
     else:
         # Verify all columns exist in qa_llm table
-        existing_columns = {col['name'] for col in inspector.get_columns("qa_llm")}
-        required_columns = {col.name for col in QueryHistory.__table__.columns}
+        _add_missing_columns(connection, QueryHistory.__table__)
         
-        missing_columns = required_columns - existing_columns
-        if missing_columns:
-            logger.warning(f"Missing columns in qa_llm table: {missing_columns}")
-            
-            # Add missing columns with appropriate SQL
-            with engine.connect() as connection:
-                for column_name in missing_columns:
-                    column = QueryHistory.__table__.columns[column_name]
-                    column_type = column.type.compile(engine.dialect)
-                    nullable = "NULL" if column.nullable else "NOT NULL"
-                    
-                    sql = f"ALTER TABLE qa_llm ADD COLUMN {column_name} {column_type} {nullable}"
-                    logger.info(f"Adding column with: {sql}")
-                    try:
-                        connection.execute(text(sql))
-                        connection.commit()
-                        logger.info(f"Added column {column_name} to qa_llm table")
-                    except Exception as e:
-                        logger.error(f"Error adding column {column_name}: {str(e)}")
-                        connection.rollback()
-
-    # Check if foreign key exists
-    if inspector.has_table("qa_llm") and "user_id" in {col['name'] for col in inspector.get_columns("qa_llm")}:
+        # Create any missing indexes
+        existing_indexes = {index['name'] for index in inspector.get_indexes("qa_llm")}
+        for index in QueryHistory.__table__.indexes:
+            if index.name not in existing_indexes:
+                logger.info(f"Creating index {index.name}")
+                index.create(connection)
+
         # Check if foreign key constraint exists
         fk_exists = False
         for fk in inspector.get_foreign_keys("qa_llm"):
@@ -119,31 +348,104 @@ def create_tables_if_needed():
         # Add foreign key if it doesn't exist
         if not fk_exists:
             logger.info("Adding foreign key constraint to qa_llm.user_id")
-            with engine.connect() as connection:
-                try:
+            try:
+                with connection.begin_nested():
                     # Use the text() function to make a proper SQL text object
                     sql = text("ALTER TABLE qa_llm ADD CONSTRAINT fk_user_id FOREIGN KEY (user_id) REFERENCES users (id)")
                     connection.execute(sql)
-                    connection.commit()
-                    logger.info("Added foreign key constraint successfully")
-                except Exception as e:
-                    logger.error(f"Error adding foreign key constraint: {str(e)}")
-                    connection.rollback()
+                logger.info("Added foreign key constraint successfully")
+            except Exception as e:
+                logger.error(f"Error adding foreign key constraint: {str(e)}")
+
+    # Create auxiliary tables, or bring existing ones up to their model
+    for table in AUXILIARY_TABLES:
+        if table.name not in existing_tables:
+            logger.info(f"Creating {table.name} table")
+            table.create(connection)
+            continue
+        _add_missing_columns(connection, table)
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info(f"Creating index {index.name}")
+                index.create(connection)
+    
+    # Full-text index over questions and answers (FTS5 on SQLite, tsvector + GIN on Postgres)
+    try:
+        with connection.begin_nested():
+            ensure_search_index(connection)
+    except Exception as e:
+        logger.error(f"Error creating full-text search index: {str(e)}")
+
+def _recorded_schema_version(connection: Connection) -> int:
+    """The version in schema_version, or 0 if the table doesn't exist yet"""
+    try:
+        return connection.execute(select(SchemaVersion.version)).scalar() or 0
+    except DBAPIError:
+        connection.rollback()
+        return 0
+
+def _lock_schema(connection: Connection):
+    """
+    Start the migration transaction, holding a lock only one worker can get
+
+    Postgres uses a transaction-scoped advisory lock. SQLite takes its
+    database write lock with BEGIN IMMEDIATE, retrying while another
+    process holds it.
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        return
+    if connection.dialect.name != "sqlite":
+        return
+    deadline = time.monotonic() + settings.DB_SCHEMA_LOCK_TIMEOUT
+    while True:
+        try:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            return
+        except OperationalError:
+            connection.rollback()
+            if time.monotonic() >= deadline:
+                raise
+            logger.info("Waiting for another process to finish checking the schema")
+            time.sleep(0.5)
 
 # Initialize database
 def init_db():
+    """
+    Bring the database schema up to date
+    
+    Costs one query once SCHEMA_VERSION has been recorded. Otherwise the
+    first worker to get the schema lock runs create_tables_if_needed and
+    records the version in one transaction; workers that waited for it
+    find the version recorded and skip the checks.
+    """
     try:
-        logger.info("Initializing database")
-        create_tables_if_needed()
-        logger.info("Database initialization complete")
+        engine = get_engine()
+        with engine.connect() as connection:
+            if _recorded_schema_version(connection) >= SCHEMA_VERSION:
+                logger.info(f"Database schema is up to date (version {SCHEMA_VERSION})")
+                return
+        
+        with engine.connect() as connection:
+            _lock_schema(connection)
+            SchemaVersion.__table__.create(connection, checkfirst=True)
+            if _recorded_schema_version(connection) >= SCHEMA_VERSION:
+                logger.info("Database schema was brought up to date by another process")
+                return
+            
+            logger.info("Initializing database")
+            create_tables_if_needed(connection)
+            connection.execute(delete(SchemaVersion))
+            connection.execute(insert(SchemaVersion).values(id=1, version=SCHEMA_VERSION))
+            connection.commit()
+            logger.info(f"Database initialization complete (schema version {SCHEMA_VERSION})")
     except Exception as e:
         logger.error(f"Database initialization error: {str(e)}")
         raise
 
+
 # Get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
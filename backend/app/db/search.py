@@ -0,0 +1,146 @@
+import logging
+import re
+from typing import Any, Dict, List
+
+from sqlalchemy import Boolean, DateTime, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# SQLite: an external-content FTS5 index over qa_llm, kept in sync by triggers.
+# user_id is indexed too so a search only intersects the caller's postings, and
+# short prefixes get their own index so the trailing prefix term stays cheap.
+SQLITE_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS qa_llm_fts USING fts5(
+        question, answer, user_id,
+        content='qa_llm', content_rowid='rowid', tokenize='porter unicode61', prefix='2 3 4'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS qa_llm_fts_insert AFTER INSERT ON qa_llm BEGIN
+        INSERT INTO qa_llm_fts(rowid, question, answer, user_id)
+        VALUES (new.rowid, new.question, new.answer, new.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS qa_llm_fts_delete AFTER DELETE ON qa_llm BEGIN
+        INSERT INTO qa_llm_fts(qa_llm_fts, rowid, question, answer, user_id)
+        VALUES ('delete', old.rowid, old.question, old.answer, old.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS qa_llm_fts_update AFTER UPDATE ON qa_llm BEGIN
+        INSERT INTO qa_llm_fts(qa_llm_fts, rowid, question, answer, user_id)
+        VALUES ('delete', old.rowid, old.question, old.answer, old.user_id);
+        INSERT INTO qa_llm_fts(rowid, question, answer, user_id)
+        VALUES (new.rowid, new.question, new.answer, new.user_id);
+    END
+    """,
+]
+
+# Postgres: a stored generated tsvector (question weighted above answer) with a GIN index
+POSTGRES_FTS_DDL = [
+    """
+    ALTER TABLE qa_llm ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(question, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(answer, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_qa_llm_search_vector ON qa_llm USING GIN (search_vector)",
+]
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+def ensure_search_index(connection: Connection):
+    """Create the full-text index for the connection's dialect if it doesn't exist yet (the caller commits)"""
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        existed = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'qa_llm_fts'")
+        ).first() is not None
+        for statement in SQLITE_FTS_DDL:
+            connection.execute(text(statement))
+        if not existed:
+            # Index the rows that were there before the triggers
+            logger.info("Building qa_llm_fts full-text index")
+            connection.execute(text("INSERT INTO qa_llm_fts(qa_llm_fts) VALUES ('rebuild')"))
+    elif dialect == "postgresql":
+        for statement in POSTGRES_FTS_DDL:
+            connection.execute(text(statement))
+    else:
+        logger.warning(f"Full-text search is not supported on {dialect}")
+
+def rebuild_search_index(engine: Engine):
+    """
+    Rebuild the SQLite index from qa_llm
+
+    The FTS5 index is keyed by qa_llm's implicit rowid, which VACUUM may
+    renumber, so run this after vacuuming a SQLite database.
+    """
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as connection:
+            connection.execute(text("INSERT INTO qa_llm_fts(qa_llm_fts) VALUES ('rebuild')"))
+            connection.commit()
+
+def optimize_search_index(connection: Connection):
+    """
+    Merge the SQLite index's segments (the caller commits)
+
+    Deletes only add tombstones to an FTS5 index, so after removing many rows
+    this is what gives their space back.
+    """
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("INSERT INTO qa_llm_fts(qa_llm_fts) VALUES ('optimize')"))
+
+def _fts5_query(query: str, user_id: str) -> str:
+    """Turn free text into a safe FTS5 expression scoped to one user"""
+    terms = [f'"{word}"' for word in _WORD.findall(query)]
+    # Treat the last word as a prefix so results show up while typing
+    terms[-1] += "*"
+    return f'user_id : "{user_id}" AND {{question answer}} : ({" AND ".join(terms)})'
+
+async def search_history(db: AsyncSession, user_id: str, query: str, limit: int) -> List[Dict[str, Any]]:
+    """
+    Ranked full-text search over one user's questions and answers
+
+    Returns dicts with the QueryHistory fields plus `rank` (higher is more
+    relevant) and a short highlighted `snippet` of the answer.
+    """
+    if not _WORD.search(query):
+        return []
+
+    dialect = db.bind.dialect.name
+    if dialect == "sqlite":
+        result = await db.execute(text("""
+            SELECT q.id, q.question, q.answer, q.timestamp, q.is_partial,
+                   -bm25(qa_llm_fts, 2.0, 1.0, 0.0) AS rank,
+                   snippet(qa_llm_fts, 1, '<mark>', '</mark>', '…', 16) AS snippet
+            FROM qa_llm_fts
+            JOIN qa_llm AS q ON q.rowid = qa_llm_fts.rowid
+            WHERE qa_llm_fts MATCH :match
+            ORDER BY bm25(qa_llm_fts, 2.0, 1.0, 0.0)
+            LIMIT :limit
+        """).columns(timestamp=DateTime, is_partial=Boolean), {"match": _fts5_query(query, user_id), "limit": limit})
+    elif dialect == "postgresql":
+        # Rank and limit first so ts_headline only runs on the rows returned
+        result = await db.execute(text("""
+            SELECT hits.id, hits.question, hits.answer, hits.timestamp, hits.is_partial, hits.rank,
+                   ts_headline('english', hits.answer, hits.query,
+                               'StartSel=<mark>, StopSel=</mark>, MaxFragments=1, MaxWords=24, MinWords=8') AS snippet
+            FROM (
+                SELECT q.id, q.question, q.answer, q.timestamp, q.is_partial, query,
+                       ts_rank_cd(q.search_vector, query) AS rank
+                FROM qa_llm AS q, websearch_to_tsquery('english', :query) AS query
+                WHERE q.user_id = :user_id AND q.search_vector @@ query
+                ORDER BY rank DESC
+                LIMIT :limit
+            ) AS hits
+            ORDER BY hits.rank DESC
+        """).columns(timestamp=DateTime, is_partial=Boolean), {"query": query, "user_id": user_id, "limit": limit})
+    else:
+        raise NotImplementedError(f"Full-text search is not supported on {dialect}")
+
+    return [dict(row._mapping) for row in result]
@@ -3,6 +3,8 @@ from typing import Optional, List, Dict, Any
 from datetime import datetime
 import uuid
 
+from app.core.config import settings
+
 # User schemas
 class UserBase(BaseModel):
     email: EmailStr
@@ -31,10 +33,27 @@ class UserResponse(UserBase):
     id: str
     is_active: bool
     created_at: datetime
+    tier: Optional[str] = None
     
     class Config:
         orm_mode = True
 
+# What anyone holding a deletion job's id may see: status and progress, nothing about the account
+class DeletionStatusResponse(BaseModel):
+    id: str
+    status: str
+    history_deleted: int
+    archive_deleted: int
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    
+    class Config:
+        orm_mode = True
+
+# The whole job, for admins
+class DeletionJobResponse(DeletionStatusResponse):
+    error: Optional[str] = None
+
 class UserUpdate(BaseModel):
     email: Optional[EmailStr] = None
     username: Optional[str] = None
@@ -51,6 +70,7 @@ class TokenData(BaseModel):
 class QuestionRequest(BaseModel):
     question: str = Field(..., min_length=1, max_length=2000, description="The user's question")
     context: Optional[str] = Field(None, description="Optional context for the question")
+    conversation_id: Optional[str] = Field(None, description="Ask as the next turn of this conversation")
     
     @validator('question')
     def question_must_be_valid(cls, v):
@@ -58,11 +78,54 @@ class QuestionRequest(BaseModel):
             raise ValueError('Question cannot be empty')
         return v.strip()
 
+class BatchQuestionRequest(BaseModel):
+    questions: List[QuestionRequest] = Field(..., min_length=1, description="Questions to answer concurrently")
+    
+    @validator('questions')
+    def batch_size_limit(cls, v):
+        if len(v) > settings.BATCH_MAX_ITEMS:
+            raise ValueError(f'A batch can hold at most {settings.BATCH_MAX_ITEMS} questions')
+        return v
+
+class BatchItemResult(BaseModel):
+    index: int
+    success: bool
+    answer: Optional[str] = None
+    error: Optional[str] = None
+    history_id: Optional[str] = None
+    metadata: Optional[Dict[str, Any]] = None
+    conversation_id: Optional[str] = None
+    retry_after: Optional[float] = None
+
+class BatchQuestionResponse(BaseModel):
+    request_id: str
+    results: List[BatchItemResult]
+    succeeded: int
+    failed: int
+
+class AskJobRequest(QuestionRequest):
+    priority: int = Field(0, ge=-10, le=0, description="Lower it to let your other queued questions go first")
+
+class AskJobResponse(BaseModel):
+    id: str
+    status: str
+    priority: int
+    attempts: int
+    answer: Optional[str] = None
+    history_id: Optional[str] = None
+    metadata: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    conversation_id: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
 class HistoryItem(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     question: str
     answer: str
     timestamp: datetime = Field(default_factory=datetime.now)
+    is_partial: bool = False
     
     class Config:
         orm_mode = True
@@ -73,7 +136,56 @@ class QuestionResponse(BaseModel):
     request_id: str
     error: Optional[str] = None
     metadata: Optional[Dict[str, Any]] = None
+    conversation_id: Optional[str] = None
+
+class HistorySearchItem(HistoryItem):
+    rank: float
+    snippet: Optional[str] = None
+
+class HistorySearchResponse(BaseModel):
+    items: List[HistorySearchItem]
+    count: int
 
 class HistoryResponse(BaseModel):
     items: List[HistoryItem]
+    count: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class HistoryPreviewItem(BaseModel):
+    id: str
+    question: str
+    answer_preview: str
+    answer_length: int
+    timestamp: datetime
+    is_partial: bool = False
+
+class HistoryPreviewResponse(BaseModel):
+    items: List[HistoryPreviewItem]
+    count: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class RelatedQuestion(BaseModel):
+    id: str
+    question: str
+    timestamp: datetime
+    similarity: float
+
+class RelatedResponse(BaseModel):
+    items: List[RelatedQuestion]
     count: int
+
+
+# Conversation schemas
+class ConversationCreate(BaseModel):
+    title: Optional[str] = Field(None, max_length=200)
+
+class ConversationResponse(BaseModel):
+    id: str
+    title: Optional[str] = None
+    created_at: datetime
+    
+    class Config:
+        orm_mode = True
+
+class ConversationDetail(ConversationResponse):
+    turns: List[HistoryItem]
@@ -0,0 +1,187 @@
+import datetime
+import hashlib
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, func, select
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.metrics import registry
+from app.db.database import AnswerCacheEntry, AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+def _normalize(text: Optional[str]) -> str:
+    """Collapse whitespace and case so trivially different phrasings share an entry"""
+    if not text:
+        return ""
+    return _WHITESPACE.sub(" ", text).strip().casefold()
+
+def make_cache_key(
+    question: str,
+    context: Optional[str],
+    model: str,
+    generation_config: Dict[str, Any],
+    history: Optional[List[Dict[str, Any]]] = None,
+    prompt: Optional[str] = None
+) -> str:
+    """Hash the normalized (question, context, model, generationConfig) tuple, plus any prior turns and the prompt's fingerprint"""
+    parts = [_normalize(question), _normalize(context), model, generation_config]
+    if prompt:
+        parts.append(prompt)
+    if history:
+        # Follow-up questions only share an answer when the conversation so far is the same
+        parts.append(history)
+    raw = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class DatabaseCacheBackend:
+    """Answer cache stored in the llm_answer_cache table so every worker shares it"""
+
+    name = "database"
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            entry = await db.get(AnswerCacheEntry, key)
+            if entry is None:
+                return None
+            if entry.expires_at <= datetime.datetime.utcnow():
+                await db.delete(entry)
+                await db.commit()
+                return None
+            return {"answer": entry.answer, "model": entry.model, "question": entry.question}
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: float):
+        async with AsyncSessionLocal() as db:
+            now = datetime.datetime.utcnow()
+            await db.merge(AnswerCacheEntry(
+                key=key,
+                question=value["question"],
+                answer=value["answer"],
+                model=value["model"],
+                created_at=now,
+                expires_at=now + datetime.timedelta(seconds=ttl),
+            ))
+            await db.commit()
+
+    async def clear(self) -> int:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(delete(AnswerCacheEntry))
+            await db.commit()
+            return result.rowcount
+
+    async def count(self) -> int:
+        async with AsyncSessionLocal() as db:
+            return (await db.execute(select(func.count()).select_from(AnswerCacheEntry))).scalar_one()
+
+class AnswerCache:
+    """
+    Exact-match answer cache in front of the LLM.
+
+    A bounded in-process LRU is always consulted first; when a shared backend
+    is configured it is checked on a local miss and written through on store.
+    """
+
+    def __init__(self, enabled: bool, max_entries: int, ttl: float, backend: Optional[DatabaseCacheBackend] = None):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.backend = backend
+        self.local = TTLCache(maxsize=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+
+        value = self.local.get(key)
+        if value is None and self.backend is not None:
+            try:
+                value = await self.backend.get(key)
+            except Exception as e:
+                logger.error(f"Answer cache backend lookup failed: {str(e)}")
+                value = None
+            if value is not None:
+                self.local.set(key, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, question: str, answer: str, model: str):
+        if not self.enabled:
+            return
+
+        value = {"question": question, "answer": answer, "model": model}
+        self.local.set(key, value)
+        if self.backend is not None:
+            try:
+                await self.backend.set(key, value, self.ttl)
+            except Exception as e:
+                logger.error(f"Answer cache backend store failed: {str(e)}")
+
+    async def clear(self) -> Dict[str, int]:
+        """Flush every layer and return how many entries each held"""
+        flushed = {"memory": len(self.local)}
+        self.local.clear()
+        if self.backend is not None:
+            flushed[self.backend.name] = await self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+        return flushed
+
+    async def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        stats = {
+            "enabled": self.enabled,
+            "backend": self.backend.name if self.backend else "memory",
+            "entries": len(self.local),
+            "max_entries": self.local.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+        if self.backend is not None:
+            stats["backend_entries"] = await self.backend.count()
+        return stats
+
+    def entries(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Most recently used in-process entries, newest first"""
+        snapshot = list(self.local.items())[-limit:] if limit else []
+        return [
+            {
+                "key": key,
+                "question": value["question"],
+                "model": value["model"],
+                "answer_chars": len(value["answer"]),
+                "expires_in": round(expires_in, 1),
+            }
+            for key, value, expires_in in reversed(snapshot)
+        ]
+
+def _create_backend() -> Optional[DatabaseCacheBackend]:
+    if settings.ANSWER_CACHE_BACKEND == "database":
+        return DatabaseCacheBackend()
+    if settings.ANSWER_CACHE_BACKEND != "memory":
+        logger.warning(f"Unknown ANSWER_CACHE_BACKEND {settings.ANSWER_CACHE_BACKEND!r}; using memory only")
+    return None
+
+answer_cache = AnswerCache(
+    enabled=settings.ANSWER_CACHE_ENABLED,
+    max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+    ttl=settings.ANSWER_CACHE_TTL_SECONDS,
+    backend=_create_backend(),
+)
+
+registry.counter(
+    "qa_answer_cache_lookups_total", "Answer cache lookups", ["result"],
+    collect=lambda: [({"result": "hit"}, answer_cache.hits), ({"result": "miss"}, answer_cache.misses)]
+)
@@ -0,0 +1,244 @@
+import asyncio
+import datetime
+import logging
+import re
+import time
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.db.database import QueryHistory, QueryHistoryArchive, get_engine
+from app.db.search import optimize_search_index
+from app.services.history import invalidate_history_count, touch_history
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_ROWS = registry.counter("qa_history_archive_rows_total", "History rows archived or deleted by retention", ["action"])
+
+# Any constant works; it just has to be the same for every worker
+ARCHIVE_LOCK_KEY = 0x7161_6172_6368
+
+_PARTITION_NAME = re.compile(r"^qa_llm_archive_p(\d{4})(\d{2})$")
+
+def _month_start(timestamp: datetime.datetime) -> datetime.date:
+    return datetime.date(timestamp.year, timestamp.month, 1)
+
+def _next_month(month: datetime.date) -> datetime.date:
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+class HistoryArchiver:
+    """
+    Background compaction of QueryHistory.
+
+    Every `interval` seconds, rows older than `archive_after_days` are moved
+    to qa_llm_archive in batches (one transaction each), where answers are
+    stored compressed. That keeps qa_llm, its indexes and its full-text
+    index down to recent history. History older than `retention_days` is
+    deleted from both tables. Every worker runs the loop; a database lock
+    makes sure only one of them compacts at a time.
+
+    Archived rows keep their conversation, and /history, conversation
+    context, /related and answer reuse all read both tables, so archiving
+    doesn't change what they return; only deletions bump the users' history
+    versions. /history/search is the exception: the full-text index covers
+    qa_llm alone, so it only finds recent history.
+    """
+
+    def __init__(self, archive_after_days: int, retention_days: int, interval: float, batch_size: int):
+        self.archive_after_days = archive_after_days
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Optional[Dict[str, float]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.archive_after_days > 0 or self.retention_days > 0
+
+    async def start(self):
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logger.error(f"History compaction failed, will retry: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def run_once(self, now: Optional[datetime.datetime] = None) -> Dict[str, float]:
+        """Archive and purge everything that is due; blocking. Returns what was done."""
+        now = now or datetime.datetime.now()
+        started = time.perf_counter()
+        result = {"archived": 0, "purged": 0, "partitions_dropped": 0, "skipped": False}
+        with get_engine().connect() as connection:
+            if not self._try_lock(connection):
+                logger.info("History compaction is running in another worker; skipping")
+                result["skipped"] = True
+                return result
+            try:
+                if self.retention_days > 0:
+                    cutoff = now - datetime.timedelta(days=self.retention_days)
+                    result["partitions_dropped"] = self._drop_expired_partitions(connection, cutoff)
+                    result["purged"] += self._purge(connection, QueryHistory, cutoff)
+                    result["purged"] += self._purge(connection, QueryHistoryArchive, cutoff)
+                if self.archive_after_days > 0:
+                    result["archived"] = self._archive(connection, now - datetime.timedelta(days=self.archive_after_days))
+                if result["archived"] or result["purged"]:
+                    self._begin(connection)
+                    optimize_search_index(connection)
+                    connection.commit()
+            finally:
+                self._unlock(connection)
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        self.last_run = {**result, "finished_at": now.isoformat()}
+        if result["archived"] or result["purged"] or result["partitions_dropped"]:
+            logger.info(
+                f"History compaction: archived {result['archived']} rows, deleted {result['purged']} rows and "
+                f"{result['partitions_dropped']} partitions in {result['seconds']}s"
+            )
+        return result
+
+    # -- locking ---------------------------------------------------------
+
+    def _try_lock(self, connection: Connection) -> bool:
+        if connection.dialect.name != "postgresql":
+            # SQLite serializes each batch with BEGIN IMMEDIATE instead
+            return True
+        locked = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": ARCHIVE_LOCK_KEY}).scalar()
+        connection.commit()
+        return bool(locked)
+
+    def _unlock(self, connection: Connection):
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ARCHIVE_LOCK_KEY})
+            connection.commit()
+
+    def _begin(self, connection: Connection):
+        """Start a batch's transaction, taking SQLite's write lock up front so concurrent batches queue"""
+        if connection.dialect.name == "sqlite":
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    # -- archiving -------------------------------------------------------
+
+    def _archive(self, connection: Connection, cutoff: datetime.datetime) -> int:
+        live = QueryHistory.__table__
+        archived = 0
+        while True:
+            self._begin(connection)
+            rows = connection.execute(
+                select(
+                    live.c.id, live.c.timestamp, live.c.user_id, live.c.conversation_id,
+                    live.c.question, live.c.answer, live.c.is_partial,
+                )
+                .where(live.c.timestamp < cutoff)
+                .order_by(live.c.timestamp)
+                .limit(self.batch_size)
+            ).all()
+            if not rows:
+                connection.rollback()
+                return archived
+            if connection.dialect.name == "postgresql":
+                self._ensure_partitions(connection, {_month_start(row.timestamp) for row in rows})
+            connection.execute(insert(QueryHistoryArchive), [
+                {
+                    "id": row.id,
+                    "timestamp": row.timestamp,
+                    "user_id": row.user_id,
+                    "conversation_id": row.conversation_id,
+                    "question": row.question,
+                    "answer": row.answer,
+                    "answer_length": len(row.answer),
+                    "is_partial": bool(row.is_partial),
+                }
+                for row in rows
+            ])
+            connection.execute(delete(live).where(live.c.id.in_([row.id for row in rows])))
+            connection.commit()
+            archived += len(rows)
+            ARCHIVE_ROWS.inc(len(rows), action="archived")
+
+    def _ensure_partitions(self, connection: Connection, months: Iterable[datetime.date]):
+        """Create the monthly archive partitions these rows fall in (Postgres)"""
+        for month in sorted(months):
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS qa_llm_archive_p{month:%Y%m} PARTITION OF qa_llm_archive "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+            ))
+
+    # -- retention -------------------------------------------------------
+
+    def _drop_expired_partitions(self, connection: Connection, cutoff: datetime.datetime) -> int:
+        """Drop whole archive months that ended before the cutoff (Postgres); much cheaper than deleting rows"""
+        if connection.dialect.name != "postgresql":
+            return 0
+        partitions = connection.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = 'qa_llm_archive'"
+        )).scalars().all()
+        dropped, users = 0, set()
+        for name in partitions:
+            match = _PARTITION_NAME.match(name)
+            if match and _next_month(datetime.date(int(match[1]), int(match[2]), 1)) <= cutoff.date():
+                users.update(connection.execute(text(f"SELECT DISTINCT user_id FROM {name}")).scalars())
+                connection.execute(text(f"DROP TABLE {name}"))
+                dropped += 1
+        if users:
+            connection.execute(touch_history(users))
+        connection.commit()
+        for user_id in users:
+            invalidate_history_count(user_id)
+        return dropped
+
+    def _purge(self, connection: Connection, model, cutoff: datetime.datetime) -> int:
+        """Delete rows older than the cutoff in batches"""
+        table = model.__table__
+        purged = 0
+        while True:
+            self._begin(connection)
+            batch = select(table.c.id).where(table.c.timestamp < cutoff).limit(self.batch_size).scalar_subquery()
+            users = connection.execute(delete(table).where(table.c.id.in_(batch)).returning(table.c.user_id)).scalars().all()
+            deleted = len(users)
+            if users:
+                connection.execute(touch_history(users))
+            connection.commit()
+            for user_id in set(users):
+                invalidate_history_count(user_id)
+            purged += deleted
+            if deleted:
+                ARCHIVE_ROWS.inc(deleted, action="purged")
+            if deleted < self.batch_size:
+                return purged
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "archive_after_days": self.archive_after_days,
+            "retention_days": self.retention_days,
+            "interval_seconds": self.interval,
+            "last_run": self.last_run,
+        }
+
+history_archiver = HistoryArchiver(
+    archive_after_days=settings.HISTORY_ARCHIVE_AFTER_DAYS,
+    retention_days=settings.HISTORY_RETENTION_DAYS,
+    interval=settings.HISTORY_ARCHIVE_INTERVAL_SECONDS,
+    batch_size=settings.HISTORY_ARCHIVE_BATCH_SIZE,
+)
@@ -0,0 +1,425 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, delete, func, insert, literal, or_, select, update
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.db.database import AsyncSessionLocal, AskJob, QueryHistory, User
+from app.services.conversations import ConversationNotFound, load_window, record_turn
+from app.services.history import invalidate_history_count, touch_history
+from app.services.history_writer import history_writer
+from app.services.llm_service import llm_service
+from app.services.related import find_reusable_answer, related_index
+
+logger = logging.getLogger(__name__)
+
+ASK_JOBS = registry.counter("qa_ask_jobs_total", "Queued /ask jobs by what happened to them", ["result"])
+JOB_WAIT = registry.histogram("qa_ask_job_wait_seconds", "Time from submitting a job to a worker claiming it")
+JOB_DURATION = registry.histogram("qa_ask_job_duration_seconds", "Time a worker spent on each attempt of a job")
+
+# Finished jobs are purged at most this often, by whichever worker gets there
+_PURGE_INTERVAL = 600.0
+
+class TooManyJobs(Exception):
+    """Raised when a user already has ASK_JOB_MAX_PENDING_PER_USER jobs queued or running"""
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+def _insert_within_cap(row: Dict[str, Any]):
+    """INSERT ... SELECT that adds the job only while its user has fewer than ASK_JOB_MAX_PENDING_PER_USER open jobs"""
+    table = AskJob.__table__
+    pending = (
+        select(func.count()).select_from(table)
+        .where(table.c.user_id == row["user_id"], table.c.status.in_(("queued", "running")))
+        .scalar_subquery()
+    )
+    values = select(*[literal(value, table.c[key].type).label(key) for key, value in row.items()])
+    return insert(table).from_select(list(row), values.where(pending < settings.ASK_JOB_MAX_PENDING_PER_USER))
+
+def _retry_delay(attempts: int, retry_after: Optional[float]) -> float:
+    delay = min(settings.ASK_JOB_RETRY_MAX_SECONDS, settings.ASK_JOB_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+    return max(delay, retry_after or 0.0)
+
+class _GroupCommit:
+    """
+    Inserts submitted jobs, all those that arrive while the previous insert
+    is running in one transaction. A lone job is inserted at once; under a
+    burst, jobs share commits instead of queueing for the database's write
+    lock one by one.
+
+    Each job is counted against its user's cap by the statement inserting
+    it, so a burst can't get past the cap by all counting before any of
+    them is committed. On Postgres the users' rows are locked first, so
+    transactions on other workers count after this one; on SQLite the
+    write lock already serializes them.
+    """
+
+    def __init__(self):
+        self._waiting: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._leader: Optional[asyncio.Task] = None
+
+    async def insert(self, row: Dict[str, Any]) -> bool:
+        """Return once the row is committed; False if its user was already at the cap"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((row, future))
+        if self._leader is None or self._leader.done():
+            self._leader = asyncio.create_task(self._drain())
+        return await future
+
+    async def _drain(self):
+        while self._waiting:
+            batch, self._waiting = self._waiting, []
+            try:
+                async with AsyncSessionLocal() as db:
+                    # Sorted, so concurrent transactions lock the user rows in the same order
+                    users = sorted({row["user_id"] for row, _ in batch})
+                    await db.execute(select(User.id).where(User.id.in_(users)).with_for_update())
+                    inserted = [(await db.execute(_insert_within_cap(row))).rowcount == 1 for row, _ in batch]
+                    await db.commit()
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), added in zip(batch, inserted):
+                    if not future.done():
+                        future.set_result(added)
+
+_submissions = _GroupCommit()
+
+async def submit_job(
+    user_id: str,
+    question: str,
+    context: Optional[str],
+    conversation_id: Optional[str],
+    tier: Optional[str],
+    priority: int = 0
+) -> AskJob:
+    """Queue a question for the workers, returning once the job is stored; raises TooManyJobs at the cap"""
+    now = _now()
+    row = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "question": question,
+        "context": context,
+        "conversation_id": conversation_id,
+        "tier": tier,
+        "priority": settings.ASK_JOB_TIER_PRIORITY.get(tier or "", 0) + priority,
+        "status": "queued",
+        "attempts": 0,
+        "created_at": now,
+        "available_at": now,
+    }
+    if not await _submissions.insert(row):
+        raise TooManyJobs(
+            f"You already have {settings.ASK_JOB_MAX_PENDING_PER_USER} questions waiting to be answered"
+        )
+    ASK_JOBS.inc(result="submitted")
+    ask_workers.wake()
+    return AskJob(**row)
+
+async def get_job(job_id: str, user_id: str) -> Optional[AskJob]:
+    async with AsyncSessionLocal() as db:
+        job = await db.get(AskJob, job_id)
+    return job if job is not None and job.user_id == user_id else None
+
+def job_view(job: AskJob) -> Dict[str, Any]:
+    """A job as returned by the API"""
+    return {
+        "id": job.id,
+        "status": job.status,
+        "priority": job.priority,
+        "attempts": job.attempts,
+        "answer": job.answer,
+        "history_id": job.history_id,
+        "metadata": json.loads(job.result_metadata) if job.result_metadata else None,
+        "error": job.error,
+        "conversation_id": job.conversation_id,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+class AskWorkerPool:
+    """
+    Workers draining the ask_jobs table.
+
+    One dispatcher loop claims up to `concurrency` jobs at a time and runs
+    each in its own task. A claim is a single UPDATE ... WHERE id IN
+    (SELECT ... ORDER BY priority DESC, available_at LIMIT n) that marks
+    the jobs running and leases them to this worker until the visibility
+    timeout. On Postgres the SELECT is FOR UPDATE SKIP LOCKED, so workers
+    on other nodes skip rows being claimed instead of waiting for them. On
+    SQLite the UPDATE holds the database write lock, which serializes
+    claims just the same.
+
+    A job whose lease runs out (its worker died or hung) is claimed again.
+    A worker only records a result while it still holds the lease, in the
+    same transaction that inserts the history row, so every job writes its
+    history row exactly once. Failures Gemini asks us to retry later are
+    retried with backoff, up to ASK_JOB_MAX_ATTEMPTS.
+    """
+
+    def __init__(self, concurrency: int, poll_interval: float, visibility_timeout: float, max_attempts: int):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        # Created with the task so it binds to the running event loop
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_purge = 0.0
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.concurrency > 0 and not self.started:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def wake(self):
+        """Look for jobs now instead of at the next poll"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        """Stop claiming, give running jobs ASK_JOB_SHUTDOWN_GRACE_SECONDS to finish, and put the rest back on the queue"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._running:
+            await asyncio.wait(self._running, timeout=settings.ASK_JOB_SHUTDOWN_GRACE_SECONDS)
+        for task in self._running:
+            task.cancel()
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        await self._release()
+
+    async def _run(self):
+        while True:
+            try:
+                free = self.concurrency - len(self._running)
+                jobs = await self._claim(free) if free > 0 else []
+                for job in jobs:
+                    task = asyncio.create_task(self._process(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._finished)
+                if free > 0 and jobs and len(jobs) == free:
+                    continue
+                if time.monotonic() - self._last_purge >= _PURGE_INTERVAL:
+                    await self._purge_finished()
+            except Exception as e:
+                logger.error(f"Ask job dispatcher failed, will retry: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _finished(self, task: asyncio.Task):
+        self._running.discard(task)
+        # A slot came free
+        self.wake()
+
+    async def _claim(self, limit: int) -> List[AskJob]:
+        now = _now()
+        claimable = or_(
+            and_(AskJob.status == "queued", AskJob.available_at <= now),
+            and_(AskJob.status == "running", AskJob.locked_until < now),
+        )
+        batch = (
+            select(AskJob.id).where(claimable)
+            .order_by(AskJob.priority.desc(), AskJob.available_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        async with AsyncSessionLocal() as db:
+            jobs = (await db.execute(
+                update(AskJob)
+                .where(AskJob.id.in_(batch.scalar_subquery()))
+                .values(
+                    status="running",
+                    locked_by=self.worker_id,
+                    locked_until=now + datetime.timedelta(seconds=self.visibility_timeout),
+                    attempts=AskJob.attempts + 1,
+                    started_at=func.coalesce(AskJob.started_at, now),
+                )
+                .returning(AskJob),
+                execution_options={"synchronize_session": False},
+            )).scalars().all()
+            await db.commit()
+        for job in jobs:
+            if job.attempts == 1:
+                JOB_WAIT.observe((now - job.created_at).total_seconds())
+        return list(jobs)
+
+    async def _process(self, job: AskJob):
+        started = time.perf_counter()
+        try:
+            if job.attempts > self.max_attempts:
+                # Only a job whose lease kept running out gets here
+                await self._fail(job, "The job was interrupted too many times")
+                return
+            try:
+                window = await load_window(job.conversation_id, job.user_id) if job.conversation_id else None
+            except ConversationNotFound:
+                await self._fail(job, "Conversation not found")
+                return
+
+            reused = None
+            if settings.RELATED_ANSWER_THRESHOLD > 0 and window is None and not job.context:
+                reused = await find_reusable_answer(job.question, job.user_id)
+            if reused is not None:
+                result = {
+                    "success": True,
+                    "answer": reused["answer"],
+                    "metadata": {"source": "history", "history_id": reused["history_id"], "similarity": round(reused["similarity"], 4)}
+                }
+            else:
+                result = await llm_service.get_response(
+                    job.question, job.context, window.contents() if window else None, tier=job.tier
+                )
+
+            if not result["success"]:
+                error = result.get("error", "Failed to get response from LLM")
+                if result.get("retry_after") is not None and job.attempts < self.max_attempts:
+                    await self._retry(job, error, _retry_delay(job.attempts, result["retry_after"]))
+                else:
+                    await self._fail(job, error)
+                return
+
+            metadata = result.get("metadata") or {}
+            if window is not None:
+                metadata = {**metadata, "conversation": window.stats()}
+            if await self._complete(job, result["answer"], metadata) and window is not None:
+                record_turn(window, job.question, result["answer"])
+        except asyncio.CancelledError:
+            # Shutting down; stop() puts the job back on the queue
+            raise
+        except Exception as e:
+            logger.error(f"Ask job {job.id} failed: {str(e)}")
+            if job.attempts < self.max_attempts:
+                await self._retry(job, f"An unexpected error occurred: {str(e)}", _retry_delay(job.attempts, None))
+            else:
+                await self._fail(job, f"An unexpected error occurred: {str(e)}")
+        finally:
+            JOB_DURATION.observe(time.perf_counter() - started)
+
+    def _leased(self, job: AskJob):
+        """Only while this worker still holds the job's lease"""
+        return and_(AskJob.id == job.id, AskJob.status == "running", AskJob.locked_by == self.worker_id)
+
+    async def _complete(self, job: AskJob, answer: str, metadata: Dict[str, Any]) -> bool:
+        """Record the answer and its history row in one transaction; False if the lease was lost"""
+        row = history_writer.make_row(job.question, answer, job.user_id, conversation_id=job.conversation_id)
+        async with AsyncSessionLocal() as db:
+            updated = await db.execute(
+                update(AskJob).where(self._leased(job)).values(
+                    status="done",
+                    answer=answer,
+                    history_id=row["id"],
+                    result_metadata=json.dumps(metadata),
+                    error=None,
+                    locked_until=None,
+                    finished_at=_now(),
+                )
+            )
+            if not updated.rowcount:
+                # The lease ran out and another worker has (or will have) answered it
+                await db.rollback()
+                logger.warning(f"Ask job {job.id} was taken over by another worker; dropping this answer")
+                ASK_JOBS.inc(result="lease_lost")
+                return False
+            await db.execute(insert(QueryHistory), [row])
+            await db.execute(touch_history([job.user_id]))
+            await db.commit()
+        invalidate_history_count(job.user_id)
+        await related_index.add_rows([row])
+        ASK_JOBS.inc(result="done")
+        return True
+
+    async def _retry(self, job: AskJob, error: str, delay: float):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(AskJob).where(self._leased(job)).values(
+                    status="queued",
+                    error=error,
+                    locked_by=None,
+                    locked_until=None,
+                    available_at=_now() + datetime.timedelta(seconds=delay),
+                )
+            )
+            await db.commit()
+        ASK_JOBS.inc(result="retried")
+        logger.warning(f"Ask job {job.id} will be retried in {delay:.1f}s (attempt {job.attempts}): {error}")
+
+    async def _fail(self, job: AskJob, error: str):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(AskJob).where(self._leased(job)).values(
+                    status="failed", error=error, locked_until=None, finished_at=_now()
+                )
+            )
+            await db.commit()
+        ASK_JOBS.inc(result="failed")
+
+    async def _release(self):
+        """Put the jobs this worker still holds back on the queue, without counting the interrupted attempt"""
+        async with AsyncSessionLocal() as db:
+            released = (await db.execute(
+                update(AskJob)
+                .where(AskJob.status == "running", AskJob.locked_by == self.worker_id)
+                .values(
+                    status="queued",
+                    locked_by=None,
+                    locked_until=None,
+                    available_at=_now(),
+                    attempts=AskJob.attempts - 1,
+                )
+            )).rowcount
+            await db.commit()
+        if released:
+            ASK_JOBS.inc(released, result="released")
+            logger.info(f"Put {released} unfinished ask jobs back on the queue")
+
+    async def _purge_finished(self):
+        self._last_purge = time.monotonic()
+        cutoff = _now() - datetime.timedelta(hours=settings.ASK_JOB_RETENTION_HOURS)
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(AskJob).where(AskJob.status.in_(("done", "failed")), AskJob.finished_at < cutoff)
+            )
+            await db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "concurrency": self.concurrency,
+            "running": len(self._running),
+            "started": self.started,
+        }
+
+ask_workers = AskWorkerPool(
+    concurrency=settings.ASK_JOB_WORKERS,
+    poll_interval=settings.ASK_JOB_POLL_SECONDS,
+    visibility_timeout=settings.ASK_JOB_VISIBILITY_TIMEOUT_SECONDS,
+    max_attempts=settings.ASK_JOB_MAX_ATTEMPTS,
+)
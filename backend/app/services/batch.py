@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.models.schema import QuestionRequest
+from app.services.conversations import ConversationNotFound, load_window, record_turn
+from app.services.governor import check_user_quota
+from app.services.llm_service import llm_service
+
+logger = logging.getLogger(__name__)
+
+class BatchRunner:
+    """
+    Answers many questions concurrently under one process-wide limit.
+
+    Every batch draws from the same semaphore, so a few large batches can't
+    take more than `max_concurrency` upstream slots between them.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        # Created lazily so it binds to the running event loop
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._slots
+
+    async def _answer(
+        self,
+        index: int,
+        item: QuestionRequest,
+        user_id: str,
+        tier: Optional[str]
+    ) -> Tuple[int, Dict[str, Any]]:
+        async with self._get_slots():
+            try:
+                wait = await check_user_quota(user_id)
+                if wait:
+                    return index, {"answer": "", "success": False, "error": "Request quota exceeded", "retry_after": wait}
+                window = await load_window(item.conversation_id, user_id) if item.conversation_id else None
+                result = await llm_service.get_response(
+                    item.question, item.context, window.contents() if window else None, tier=tier
+                )
+                if result["success"] and window is not None:
+                    record_turn(window, item.question, result["answer"])
+            except ConversationNotFound:
+                result = {"answer": "", "success": False, "error": "Conversation not found"}
+            except Exception as e:
+                logger.error(f"Batch item {index} failed: {str(e)}")
+                result = {"answer": "", "success": False, "error": f"An unexpected error occurred: {str(e)}"}
+        return index, result
+
+    async def run(
+        self,
+        items: List[QuestionRequest],
+        user_id: str,
+        tier: Optional[str] = None
+    ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """Yield (index, result) pairs in completion order"""
+        tasks = [asyncio.ensure_future(self._answer(index, item, user_id, tier)) for index, item in enumerate(items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # The consumer went away (e.g. a streaming client disconnected); stop the remaining calls
+            for task in tasks:
+                task.cancel()
+
+batch_runner = BatchRunner(max_concurrency=settings.BATCH_MAX_CONCURRENCY)
@@ -0,0 +1,169 @@
+import logging
+import math
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import func, select
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.database import AsyncSessionLocal, Conversation, QueryHistory, QueryHistoryArchive
+from app.services.history_writer import history_writer
+
+logger = logging.getLogger(__name__)
+
+class ConversationNotFound(LookupError):
+    """Raised when a conversation doesn't exist or belongs to another user"""
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting"""
+    return math.ceil(len(text) / 4)
+
+def _clip(text: str, max_tokens: int) -> str:
+    """Truncate text to about max_tokens, marking the cut"""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + " …[truncated]"
+
+class ConversationWindow:
+    """
+    The Gemini `contents` prefix for one thread.
+
+    Holds the newest turns that fit the token budget, already in request
+    form. A new turn is appended and the oldest turns are dropped from the
+    front until the window fits again, so adding a turn costs O(turn) rather
+    than rebuilding the thread.
+    """
+
+    def __init__(self, conversation_id: str, user_id: str, token_budget: int, max_turn_tokens: int):
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.token_budget = token_budget
+        self.max_turn_tokens = max_turn_tokens
+        self.tokens = 0
+        # Every turn of the thread the window has seen, stored or queued, including ones not loaded
+        self.turns = 0
+        self.dropped_turns = 0
+        # Each entry is one question/answer exchange: ([user content, model content], tokens)
+        self._exchanges: Deque[tuple] = deque()
+
+    def append(self, question: str, answer: str):
+        question = _clip(question, self.max_turn_tokens)
+        answer = _clip(answer, self.max_turn_tokens)
+        tokens = estimate_tokens(question) + estimate_tokens(answer)
+        self._exchanges.append((
+            [
+                {"role": "user", "parts": [{"text": question}]},
+                {"role": "model", "parts": [{"text": answer}]},
+            ],
+            tokens,
+        ))
+        self.tokens += tokens
+        self.turns += 1
+        while self.tokens > self.token_budget and self._exchanges:
+            _, dropped = self._exchanges.popleft()
+            self.tokens -= dropped
+            self.dropped_turns += 1
+
+    def contents(self) -> List[Dict[str, Any]]:
+        """Prior turns, oldest first, ready to prepend to the new question"""
+        return [content for exchange, _ in self._exchanges for content in exchange]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "turns_in_context": len(self._exchanges),
+            "turns_dropped": self.dropped_turns,
+            "context_tokens": self.tokens,
+        }
+
+# Assembled windows per conversation id, so a new turn doesn't re-read the thread
+_windows = TTLCache(maxsize=settings.CONVERSATION_CACHE_MAX_ENTRIES, ttl=settings.CONVERSATION_CACHE_TTL_SECONDS)
+
+async def _count_turns(db, conversation_id: str) -> int:
+    return (await db.execute(
+        select(func.count()).select_from(QueryHistory).where(QueryHistory.conversation_id == conversation_id)
+    )).scalar_one()
+
+async def recent_turns(db, conversation_id: str, limit: int) -> list:
+    """
+    The newest `limit` stored turns of a conversation, newest first
+
+    Reads qa_llm, and goes on into qa_llm_archive only when the thread has
+    fewer live turns than that, since archived turns are the older ones.
+    """
+    turns = list((await db.execute(
+        select(QueryHistory)
+        .where(QueryHistory.conversation_id == conversation_id)
+        .order_by(QueryHistory.timestamp.desc(), QueryHistory.id.desc())
+        .limit(limit)
+    )).scalars().all())
+    if len(turns) < limit:
+        turns += (await db.execute(
+            select(QueryHistoryArchive)
+            .where(QueryHistoryArchive.conversation_id == conversation_id)
+            .order_by(QueryHistoryArchive.timestamp.desc(), QueryHistoryArchive.id.desc())
+            .limit(limit - len(turns))
+        )).scalars().all()
+    return turns
+
+async def load_window(conversation_id: str, user_id: str) -> ConversationWindow:
+    """
+    Return the context window for a conversation owned by user_id
+
+    Served from the per-thread cache while it is current: the thread's
+    stored turns plus those still in this process's write-behind queue
+    must add up to the turns the window has seen. Other workers keep their
+    own windows and write their own turns, so any difference means the
+    thread changed elsewhere, and the newest turns are read again from the
+    database (plus any still queued).
+    """
+    # Snapshot queued turns before querying so a row flushed meanwhile is seen at least once
+    pending = [row for row in history_writer.pending_for(user_id) if row.conversation_id == conversation_id]
+    window = _windows.get(conversation_id)
+    if window is not None:
+        if window.user_id != user_id:
+            raise ConversationNotFound(conversation_id)
+        async with AsyncSessionLocal() as db:
+            current = await _count_turns(db, conversation_id) + len(pending)
+        if current == window.turns:
+            return window
+
+    async with AsyncSessionLocal() as db:
+        conversation = await db.get(Conversation, conversation_id)
+        if conversation is None or conversation.user_id != user_id:
+            raise ConversationNotFound(conversation_id)
+        total = await _count_turns(db, conversation_id)
+        stored = await recent_turns(db, conversation_id, settings.CONVERSATION_MAX_LOAD_TURNS)
+
+    stored_ids = {row.id for row in stored}
+    queued = [row for row in pending if row.id not in stored_ids]
+    rows = stored + queued
+    rows.sort(key=lambda row: (row.timestamp, row.id))
+
+    window = ConversationWindow(
+        conversation_id,
+        user_id,
+        token_budget=settings.CONVERSATION_TOKEN_BUDGET,
+        max_turn_tokens=settings.CONVERSATION_MAX_TURN_TOKENS,
+    )
+    for row in rows:
+        window.append(row.question, row.answer)
+    # Count live turns too old to be loaded as well, as the check above does. Archived
+    # turns are left out of both, so archiving part of the thread makes it reload once.
+    window.turns = total + len(queued)
+    _windows.set(conversation_id, window)
+    return window
+
+def record_turn(window: ConversationWindow, question: str, answer: str):
+    """Extend a cached window with a new turn (the history row is written separately)"""
+    window.append(question, answer)
+    # Re-set to refresh the TTL and bring it back if it was evicted meanwhile
+    _windows.set(window.conversation_id, window)
+
+def forget_conversation(conversation_id: str):
+    _windows.pop(conversation_id)
+
+def forget_user_conversations(user_id: str):
+    """Drop every cached window belonging to a user"""
+    _windows.remove_if(lambda _, window: window.user_id == user_id)
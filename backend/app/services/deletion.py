@@ -0,0 +1,235 @@
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+from typing import List, Optional
+
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.core.security import invalidate_user_cache
+from app.db.database import AskJob, AsyncSessionLocal, Conversation, QueryHistory, QueryHistoryArchive, User, UserDeletionJob
+from app.services.conversations import forget_user_conversations
+from app.services.history import invalidate_history_count
+from app.services.history_writer import history_writer
+
+logger = logging.getLogger(__name__)
+
+ROWS_DELETED = registry.counter("qa_user_deletion_rows_total", "Rows removed by account deletion jobs", ["table"])
+JOBS_FINISHED = registry.counter("qa_user_deletion_jobs_total", "Account deletion jobs by outcome", ["result"])
+
+class UserDeleter:
+    """
+    Background deletion of accounts.
+
+    `enqueue` deactivates the user and queues a job in user_deletion_jobs,
+    in one transaction. A worker then deletes the user's queued questions,
+    history, archived history and conversations in batches of `batch_size`
+    rows, each its own short transaction followed by a pause, so other
+    requests keep getting the tables. Before the user row goes, the job
+    waits until no request can still be adding to the user's history, and
+    it deletes the history once more after the user row is gone; writers
+    drop rows of users that no longer exist from then on.
+
+    Jobs live in the database, so any worker can run one queued by another.
+    A job whose worker died is taken over once it has made no progress for
+    `stale_after` seconds. Every step is idempotent, so redoing part of a
+    job is harmless.
+    """
+
+    def __init__(
+        self, batch_size: int, pause: float, poll_interval: float, stale_after: float, max_attempts: int,
+        drain_timeout: float
+    ):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.drain_timeout = drain_timeout
+        self._task: Optional[asyncio.Task] = None
+        # Created with the task so it binds to the running event loop
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def start(self):
+        """Start working through queued jobs, including any left over from before a restart"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def enqueue(self, db: AsyncSession, user_id: str) -> UserDeletionJob:
+        """Deactivate a user and queue the deletion of their data; commits the caller's session"""
+        job = UserDeletionJob(id=str(uuid.uuid4()), user_id=user_id, status="pending", history_deleted=0, archive_deleted=0)
+        await db.execute(update(User).where(User.id == user_id).values(is_active=False))
+        db.add(job)
+        await db.commit()
+        invalidate_user_cache(user_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[UserDeletionJob]:
+        async with AsyncSessionLocal() as db:
+            return await db.get(UserDeletionJob, job_id)
+
+    async def recent(self, limit: int = 50) -> List[UserDeletionJob]:
+        async with AsyncSessionLocal() as db:
+            return list((await db.execute(
+                select(UserDeletionJob).order_by(UserDeletionJob.created_at.desc()).limit(limit)
+            )).scalars().all())
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.run_next():
+                    pass
+            except Exception as e:
+                logger.error(f"Account deletion loop failed, will retry: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def run_next(self) -> bool:
+        """Claim and run one job; False if there was none to claim"""
+        job = await self._claim()
+        if job is None:
+            return False
+        await self._process(job)
+        return True
+
+    async def _claim(self) -> Optional[UserDeletionJob]:
+        now = datetime.datetime.utcnow()
+        claimable = or_(
+            UserDeletionJob.status == "pending",
+            and_(
+                UserDeletionJob.status == "running",
+                UserDeletionJob.updated_at < now - datetime.timedelta(seconds=self.stale_after)
+            ),
+        )
+        async with AsyncSessionLocal() as db:
+            candidates = (await db.execute(
+                select(UserDeletionJob.id).where(claimable).order_by(UserDeletionJob.created_at).limit(10)
+            )).scalars().all()
+            for job_id in candidates:
+                # Conditional, so when two workers race for a job only one update matches
+                claimed = await db.execute(
+                    update(UserDeletionJob)
+                    .where(UserDeletionJob.id == job_id, claimable)
+                    .values(status="running", attempts=UserDeletionJob.attempts + 1, updated_at=now)
+                )
+                await db.commit()
+                if claimed.rowcount:
+                    return await db.get(UserDeletionJob, job_id)
+        return None
+
+    async def _process(self, job: UserDeletionJob):
+        try:
+            # Queued questions go first, so a worker can't add history rows while the rest is deleted
+            await self._delete_rows(job, AskJob)
+            await self._delete_rows(job, QueryHistory, "history_deleted")
+            await self._delete_rows(job, QueryHistoryArchive, "archive_deleted")
+            await self._wait_for_writers(job)
+            # Whatever requests let in before the account was deactivated added meanwhile
+            await self._delete_rows(job, AskJob)
+            await self._delete_rows(job, QueryHistory, "history_deleted")
+
+            async with AsyncSessionLocal() as db:
+                await db.execute(delete(Conversation).where(Conversation.user_id == job.user_id))
+                await db.execute(delete(User).where(User.id == job.user_id))
+                await db.commit()
+            # Rows committed just before the user row went; any written after it are dropped by their writer
+            await self._delete_rows(job, QueryHistory, "history_deleted")
+
+            now = datetime.datetime.utcnow()
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(UserDeletionJob)
+                    .where(UserDeletionJob.id == job.id)
+                    .values(status="done", error=None, updated_at=now, finished_at=now)
+                )
+                await db.commit()
+        except Exception as e:
+            failed = job.attempts >= self.max_attempts
+            logger.error(f"Deleting user {job.user_id} failed (attempt {job.attempts}): {str(e)}")
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(UserDeletionJob)
+                    .where(UserDeletionJob.id == job.id)
+                    .values(status="failed" if failed else "pending", error=str(e), updated_at=datetime.datetime.utcnow())
+                )
+                await db.commit()
+            if failed:
+                JOBS_FINISHED.inc(result="failed")
+            return
+        invalidate_user_cache(job.user_id)
+        invalidate_history_count(job.user_id)
+        forget_user_conversations(job.user_id)
+        JOBS_FINISHED.inc(result="done")
+        logger.info(f"Deleted user {job.user_id}")
+
+    async def _wait_for_writers(self, job: UserDeletionJob):
+        """
+        Wait until requests can no longer add to the user's history
+
+        Other workers accept the user's token until their cached copy of
+        the account expires, up to AUTH_CACHE_TTL_SECONDS after the job was
+        queued, and an answer they queue then is flushed within a flush
+        interval. Answers this worker has queued for the user are waited
+        for too, but only up to `drain_timeout`, in case its write loop is
+        stuck; the writer drops them once the user row is gone anyway.
+        """
+        auth_ttl = settings.AUTH_CACHE_TTL_SECONDS if settings.AUTH_CACHE_ENABLED else 0
+        settled = job.created_at + datetime.timedelta(seconds=auth_ttl + settings.HISTORY_WRITE_FLUSH_INTERVAL)
+        remaining = (settled - datetime.datetime.utcnow()).total_seconds()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        deadline = time.monotonic() + self.drain_timeout
+        while history_writer.pending_for(job.user_id) and time.monotonic() < deadline:
+            await asyncio.sleep(settings.HISTORY_WRITE_FLUSH_INTERVAL)
+
+    async def _delete_rows(self, job: UserDeletionJob, model, progress: Optional[str] = None):
+        """Delete the user's rows of a table in batches, counting them in the job's `progress` column if given"""
+        table = model.__table__
+        column = getattr(UserDeletionJob, progress) if progress else None
+        while True:
+            async with AsyncSessionLocal() as db:
+                batch = (
+                    select(table.c.id).where(table.c.user_id == job.user_id).limit(self.batch_size).scalar_subquery()
+                )
+                deleted = (await db.execute(
+                    delete(table).where(table.c.user_id == job.user_id, table.c.id.in_(batch))
+                )).rowcount
+                # Progress doubles as the heartbeat that keeps other workers from taking the job over
+                values = {UserDeletionJob.updated_at: datetime.datetime.utcnow()}
+                if column is not None:
+                    values[column] = column + deleted
+                await db.execute(update(UserDeletionJob).where(UserDeletionJob.id == job.id).values(values))
+                await db.commit()
+            if deleted:
+                ROWS_DELETED.inc(deleted, table=table.name)
+            if deleted < self.batch_size:
+                return
+            await asyncio.sleep(self.pause)
+
+user_deleter = UserDeleter(
+    batch_size=settings.USER_DELETION_BATCH_SIZE,
+    pause=settings.USER_DELETION_BATCH_PAUSE_SECONDS,
+    poll_interval=settings.USER_DELETION_POLL_SECONDS,
+    stale_after=settings.USER_DELETION_STALE_SECONDS,
+    max_attempts=settings.USER_DELETION_MAX_ATTEMPTS,
+    drain_timeout=settings.USER_DELETION_DRAIN_SECONDS,
+)
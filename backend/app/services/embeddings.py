@@ -0,0 +1,100 @@
+import re
+import zlib
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+# Words that say little about what a question is about
+STOPWORDS = frozenset(
+    "a an and are as at be by can could do does for from have how i if in is it me my of on or should "
+    "the their there to was we what when where which who why will with would you your".split()
+)
+
+def _stem(word: str) -> str:
+    """Crude plural folding, so "requirements" and "requirement" are the same word"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+class HashingEmbedder:
+    """
+    CPU-only text embeddings by feature hashing, with no model to download or load.
+
+    Words (minus stopwords, plurals folded), adjacent word pairs and
+    character trigrams are hashed (crc32, so every process agrees) into
+    `dim` signed buckets, and each vector is L2-normalized, so a dot
+    product is a cosine similarity. Close vectors
+    share wording rather than meaning: "visa for Kenya" is close to "Kenya
+    visa requirements" but not to "entry permit for Nairobi".
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.fingerprint = f"hashing-v1-{dim}"
+
+    @staticmethod
+    def _features(text: str) -> List[Tuple[int, float]]:
+        words = _WORD.findall(text.lower())
+        words = [_stem(word) for word in ([word for word in words if word not in STOPWORDS] or words)]
+        features = [(zlib.crc32(f"w:{word}".encode()), 1.0) for word in words]
+        features += [(zlib.crc32(f"b:{first} {second}".encode()), 0.5) for first, second in zip(words, words[1:])]
+        for word in words:
+            # Trigrams let near-spellings and typos still match; together they weigh as much as the word
+            padded = f"#{word}#"
+            trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+            weight = 1.0 / len(trigrams) ** 0.5
+            features += [(zlib.crc32(f"t:{trigram}".encode()), weight) for trigram in trigrams]
+        return features
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embed texts as rows of a float32 (len(texts), dim) array with unit norm"""
+        rows, hashes, weights = [], [], []
+        for row, text in enumerate(texts):
+            for value, weight in self._features(text):
+                rows.append(row)
+                hashes.append(value)
+                weights.append(weight)
+        hashes = np.array(hashes, dtype=np.uint32)
+        # The top bit signs the feature, so colliding features tend to cancel instead of adding up
+        signed = np.where(hashes & 0x80000000, -1.0, 1.0) * np.array(weights)
+        slots = np.array(rows, dtype=np.int64) * self.dim + (hashes % self.dim)
+        vectors = np.bincount(slots, weights=signed, minlength=len(texts) * self.dim)
+        vectors = vectors.reshape(len(texts), self.dim).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+class SentenceTransformerEmbedder:
+    """A local sentence-transformers model run on the CPU; matches by meaning, at a few ms per question"""
+
+    def __init__(self, model_name: str):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError(
+                f"EMBEDDING_MODEL={model_name!r} needs the sentence-transformers package; "
+                "install it or use EMBEDDING_MODEL=hashing"
+            ) from e
+        self.name = model_name
+        self._model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self._model.get_sentence_embedding_dimension()
+        self.fingerprint = f"st-{model_name}"
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return self._model.encode(
+            list(texts), normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
+        ).astype(np.float32)
+
+def create_embedder():
+    """The embedder named by EMBEDDING_MODEL (loading a model can take a while, so call this lazily)"""
+    if settings.EMBEDDING_MODEL == "hashing":
+        return HashingEmbedder(settings.EMBEDDING_DIM)
+    return SentenceTransformerEmbedder(settings.EMBEDDING_MODEL)
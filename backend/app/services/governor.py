@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import case, update
+from sqlalchemy.exc import IntegrityError
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.database import AsyncSessionLocal, RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+# Upstream statuses worth retrying; anything else is the request's fault
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class MemoryBucketBackend:
+    """Token buckets held in this process"""
+
+    name = "memory"
+
+    def __init__(self, max_buckets: int = 100000):
+        # An idle bucket is full again once it expires, so forgetting it is harmless
+        self._buckets = TTLCache(maxsize=max_buckets, ttl=3600)
+
+    def _refilled(self, key: str, rate: float, capacity: float, now: float) -> float:
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - updated_at) * rate)
+
+    async def take(self, key: str, rate: float, capacity: float, cost: float) -> float:
+        now = time.monotonic()
+        tokens = self._refilled(key, rate, capacity, now)
+        if tokens >= cost:
+            self._buckets.set(key, (tokens - cost, now))
+            return 0.0
+        self._buckets.set(key, (tokens, now))
+        return (cost - tokens) / rate
+
+    async def penalize(self, key: str, rate: float, capacity: float, seconds: float):
+        now = time.monotonic()
+        tokens = self._refilled(key, rate, capacity, now)
+        self._buckets.set(key, (min(tokens, 1 - rate * seconds), now))
+
+class DatabaseBucketBackend:
+    """
+    Token buckets in the rate_limit_buckets table, shared by every worker.
+
+    Refill and take happen in one conditional UPDATE, so concurrent workers
+    can't both spend the last token.
+    """
+
+    name = "database"
+
+    @staticmethod
+    def _refilled(rate: float, capacity: float, now: float):
+        refilled = RateLimitBucket.tokens + (now - RateLimitBucket.updated_at) * rate
+        return case((refilled > capacity, capacity), else_=refilled)
+
+    async def take(self, key: str, rate: float, capacity: float, cost: float) -> float:
+        now = time.time()
+        refilled = self._refilled(rate, capacity, now)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(RateLimitBucket)
+                .where(RateLimitBucket.key == key, refilled >= cost)
+                .values(tokens=refilled - cost, updated_at=now)
+            )
+            if result.rowcount:
+                await db.commit()
+                return 0.0
+
+            bucket = await db.get(RateLimitBucket, key)
+            if bucket is None:
+                db.add(RateLimitBucket(key=key, tokens=capacity - cost, updated_at=now))
+                try:
+                    await db.commit()
+                except IntegrityError:
+                    # Another worker created it first; go through the UPDATE path again
+                    await db.rollback()
+                    return await self.take(key, rate, capacity, cost)
+                return 0.0
+
+            tokens = min(capacity, bucket.tokens + (now - bucket.updated_at) * rate)
+            return (cost - tokens) / rate
+
+    async def penalize(self, key: str, rate: float, capacity: float, seconds: float):
+        now = time.time()
+        refilled = self._refilled(rate, capacity, now)
+        target = 1 - rate * seconds
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(RateLimitBucket)
+                .where(RateLimitBucket.key == key)
+                .values(tokens=case((refilled > target, target), else_=refilled), updated_at=now)
+            )
+            await db.commit()
+
+class RateLimiter:
+    """Token bucket limiter: `per_minute` sustained rate with bursts of up to `burst`"""
+
+    def __init__(self, backend, per_minute: int, burst: int):
+        self.backend = backend
+        self.enabled = per_minute > 0
+        self.rate = per_minute / 60
+        self.capacity = max(burst, 1)
+
+    async def acquire(self, key: str, cost: float = 1, max_wait: float = 0.0) -> float:
+        """
+        Take `cost` tokens, waiting up to `max_wait` seconds for them
+
+        Returns 0 once taken, or how long the caller would have to wait.
+        Fails open (returns 0) if the backend is unavailable.
+        """
+        if not self.enabled:
+            return 0.0
+        deadline = time.monotonic() + max_wait
+        while True:
+            try:
+                wait = await self.backend.take(key, self.rate, self.capacity, cost)
+            except Exception as e:
+                logger.error(f"Rate limit backend failed, allowing request: {str(e)}")
+                return 0.0
+            if wait <= 0:
+                return 0.0
+            if time.monotonic() + wait > deadline:
+                return wait
+            await asyncio.sleep(wait)
+
+    async def penalize(self, key: str, seconds: float):
+        """Hold off every caller of `key` for about `seconds` (e.g. after an upstream 429)"""
+        if not self.enabled:
+            return
+        try:
+            await self.backend.penalize(key, self.rate, self.capacity, seconds)
+        except Exception as e:
+            logger.error(f"Rate limit backend failed to apply backoff: {str(e)}")
+
+class CircuitBreaker:
+    """
+    Fails fast while the upstream is down.
+
+    Opens after `failure_threshold` consecutive failures. After
+    `reset_timeout` seconds one probe call is let through (half-open); its
+    success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.probe_started_at = now
+            return True
+        if self.state == "half_open" and now - self.probe_started_at >= self.reset_timeout:
+            # The last probe never reported back (e.g. it was cancelled); let another one through
+            self.probe_started_at = now
+            return True
+        if self.state != "closed":
+            self.rejected += 1
+            return False
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Opening Gemini circuit breaker after {self.failures} consecutive failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_after(self) -> float:
+        """Seconds until the next probe is allowed"""
+        if self.state == "closed":
+            return 0.0
+        started = self.opened_at if self.state == "open" else self.probe_started_at
+        return max(0.0, self.reset_timeout - (time.monotonic() - started))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected,
+            "retry_after": round(self.retry_after(), 1),
+        }
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header, which is either delta-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Delay before retry number `attempt` (0-based)
+
+    Full jitter over an exponentially growing window, but never sooner than
+    the upstream's Retry-After; both are capped at LLM_BACKOFF_MAX.
+    """
+    window = min(settings.LLM_BACKOFF_MAX, settings.LLM_BACKOFF_BASE * (2 ** attempt))
+    delay = random.uniform(0, window)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return min(delay, settings.LLM_BACKOFF_MAX)
+
+def _create_backend():
+    if settings.RATE_LIMIT_BACKEND == "database":
+        return DatabaseBucketBackend()
+    if settings.RATE_LIMIT_BACKEND != "memory":
+        logger.warning(f"Unknown RATE_LIMIT_BACKEND {settings.RATE_LIMIT_BACKEND!r}; using memory")
+    return MemoryBucketBackend()
+
+_backend = _create_backend()
+
+# Our Gemini quota, shared by every caller (one bucket per model endpoint)
+upstream_limiter = RateLimiter(_backend, settings.LLM_RATE_LIMIT_PER_MINUTE, settings.LLM_RATE_LIMIT_BURST)
+
+# Per-user request quotas
+user_quota = RateLimiter(_backend, settings.USER_QUOTA_PER_MINUTE, settings.USER_QUOTA_BURST)
+
+async def check_user_quota(user_id: str, cost: int = 1) -> float:
+    """Charge a user's quota; returns 0 if allowed, else seconds until it would be"""
+    return await user_quota.acquire(f"user:{user_id}", cost)
@@ -0,0 +1,143 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Delete, Update, delete, exists, func, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.database import QueryHistory, QueryHistoryArchive, User
+
+# Per-user history totals, with the history version they were counted at, so paging doesn't re-run COUNT(*)
+_count_cache = TTLCache(maxsize=10000, ttl=settings.HISTORY_COUNT_CACHE_TTL_SECONDS)
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded"""
+
+def encode_cursor(item: QueryHistory) -> str:
+    """Opaque cursor pointing just past `item` in (timestamp, id) order"""
+    raw = json.dumps([item.timestamp.isoformat(), item.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, item_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(timestamp), str(item_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid pagination cursor") from e
+
+def invalidate_history_count(user_id: str):
+    """Forget a user's cached total after their history changes"""
+    _count_cache.pop(user_id)
+
+def touch_history(user_ids: Iterable[str]) -> Update:
+    """
+    Statement bumping the history version of these users. Execute it in the
+    transaction that changes their history, so the version never gets ahead
+    of or behind the rows.
+    """
+    # Sorted, so concurrent writers lock the user rows in the same order
+    return update(User).where(User.id.in_(sorted(set(user_ids)))).values(
+        history_version=User.history_version + 1,
+        history_updated_at=datetime.utcnow(),
+    )
+
+def delete_orphaned_history(ids: Iterable[str]) -> Delete:
+    """
+    Statement deleting those of these qa_llm rows whose user no longer
+    exists, returning their ids. Execute it right after inserting them, in
+    the same transaction: the insert holds SQLite's write lock (on Postgres
+    the foreign key does the job), so an account deletion either committed
+    before, and the rows go here, or commits after and deletes them itself.
+    """
+    return delete(QueryHistory).where(
+        QueryHistory.id.in_(list(ids)),
+        QueryHistory.user_id.isnot(None),
+        ~exists().where(User.id == QueryHistory.user_id),
+    ).returning(QueryHistory.id)
+
+async def get_history_version(db: AsyncSession, user_id: str) -> Tuple[int, Optional[datetime]]:
+    """A user's history version and when it last changed; a primary-key lookup, qa_llm isn't touched"""
+    row = (await db.execute(
+        select(User.history_version, User.history_updated_at).where(User.id == user_id)
+    )).first()
+    return (row.history_version or 0, row.history_updated_at) if row else (0, None)
+
+async def _count_rows(db: AsyncSession, model, user_id: str) -> int:
+    return (await db.execute(select(func.count()).select_from(model).where(model.user_id == user_id))).scalar_one()
+
+async def count_history(db: AsyncSession, user_id: str, version: Optional[int] = None) -> int:
+    """A user's history rows, live and archived; recounted when `version` differs from the cached one"""
+    cached = _count_cache.get(user_id)
+    if cached is not None and (version is None or cached[0] == version):
+        return cached[1]
+    total = await _count_rows(db, QueryHistory, user_id) + await _count_rows(db, QueryHistoryArchive, user_id)
+    _count_cache.set(user_id, (version, total))
+    return total
+
+def _page_query(model, user_id: str, position: Optional[Tuple[datetime, str]], preview_chars: Optional[int]):
+    if preview_chars and model is QueryHistory:
+        query = select(
+            QueryHistory.id,
+            QueryHistory.question,
+            QueryHistory.timestamp,
+            QueryHistory.is_partial,
+            func.substr(QueryHistory.answer, 1, preview_chars).label("answer_preview"),
+            func.length(QueryHistory.answer).label("answer_length"),
+        )
+    else:
+        # Archived answers are compressed, so their previews are cut once they are read
+        query = select(model)
+    query = query.where(model.user_id == user_id)
+    if position is not None:
+        query = query.where(tuple_(model.timestamp, model.id) < tuple_(*position))
+    return query.order_by(model.timestamp.desc(), model.id.desc())
+
+async def fetch_history_page(
+    db: AsyncSession,
+    user_id: str,
+    limit: int,
+    cursor: Optional[str] = None,
+    skip: int = 0,
+    preview_chars: Optional[int] = None
+) -> Tuple[List[Any], Optional[str]]:
+    """
+    Return one page of a user's history, newest first, and the cursor for the next page
+
+    With a cursor the page is found by seeking the (user_id, timestamp, id)
+    index, so its cost doesn't depend on how deep the page is. `skip` is the
+    legacy offset pagination and is ignored when a cursor is given.
+
+    With `preview_chars` the items are rows with `answer_preview` (the start
+    of the answer, cut in the database) and `answer_length` instead of the
+    full answer.
+
+    Once the user's rows in qa_llm run out, the page continues with their
+    archived rows (QueryHistoryArchive objects), which are all older.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    query = _page_query(QueryHistory, user_id, position, preview_chars)
+    if position is None and skip:
+        query = query.offset(skip)
+
+    # Fetch one extra row to learn whether another page exists
+    result = await db.execute(query.limit(limit + 1))
+    items = list(result.all() if preview_chars else result.scalars().all())
+
+    if len(items) <= limit:
+        archive_query = _page_query(QueryHistoryArchive, user_id, position, preview_chars)
+        if position is None and skip and not items:
+            # The offset went past every live row; skip the rest of it in the archive
+            archive_skip = skip - await _count_rows(db, QueryHistory, user_id)
+            if archive_skip > 0:
+                archive_query = archive_query.offset(archive_skip)
+        items += (await db.execute(archive_query.limit(limit + 1 - len(items)))).scalars().all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1])
+    return items, next_cursor
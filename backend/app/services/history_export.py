@@ -0,0 +1,216 @@
+import asyncio
+import csv
+import io
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+import orjson
+from sqlalchemy import insert, null, select, tuple_
+
+from app.core.config import settings
+from app.db.database import AsyncSessionLocal, QueryHistory, QueryHistoryArchive
+from app.services.history import delete_orphaned_history, invalidate_history_count, touch_history
+from app.services.related import related_index
+
+EXPORT_COLUMNS = ("id", "question", "answer", "timestamp", "is_partial", "conversation_id")
+
+# Chunks larger than this are gzipped in a thread so the event loop keeps serving other requests
+_THREAD_COMPRESS_SIZE = 64 * 1024
+
+class InvalidImport(ValueError):
+    """Raised when an import line can't be read; `imported` rows were already saved"""
+
+    def __init__(self, message: str, imported: int = 0):
+        super().__init__(message)
+        self.imported = imported
+
+def _naive(timestamp: datetime) -> datetime:
+    """Timestamps are stored as naive local times; convert aware ones to match"""
+    return timestamp.astimezone().replace(tzinfo=None) if timestamp.tzinfo else timestamp
+
+async def iter_history(user_id: str, since: Optional[datetime] = None, chunk_size: Optional[int] = None) -> AsyncIterator[Sequence[Any]]:
+    """
+    Yield all of a user's history, oldest first, in chunks of rows
+
+    Archived rows come first, then the live ones. Each chunk is its own
+    keyset query on the (user_id, timestamp, id) index, with the session
+    closed in between. Memory stays at one chunk however long the history
+    is, and a slow client doesn't keep a pooled connection checked out for
+    the whole download.
+    """
+    chunk_size = chunk_size or settings.HISTORY_EXPORT_CHUNK_SIZE
+    for model in (QueryHistoryArchive, QueryHistory):
+        # Archived rows have left their conversations
+        columns = (getattr(model, column) if hasattr(model, column) else null().label(column) for column in EXPORT_COLUMNS)
+        query = select(*columns).where(model.user_id == user_id)
+        if since is not None:
+            query = query.where(model.timestamp > _naive(since))
+        query = query.order_by(model.timestamp, model.id).limit(chunk_size)
+
+        after = None
+        while True:
+            async with AsyncSessionLocal() as db:
+                chunk_query = query if after is None else query.where(tuple_(model.timestamp, model.id) > after)
+                rows = (await db.execute(chunk_query)).all()
+            if rows:
+                yield rows
+            if len(rows) < chunk_size:
+                break
+            after = tuple_(rows[-1].timestamp, rows[-1].id)
+
+def encode_ndjson(rows: Sequence[Any]) -> bytes:
+    return b"".join(orjson.dumps(row._asdict(), option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+def encode_csv(rows: Sequence[Any], header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(
+        (row.id, row.question, row.answer, row.timestamp.isoformat(), "true" if row.is_partial else "false", row.conversation_id or "")
+        for row in rows
+    )
+    return buffer.getvalue().encode()
+
+async def export_history(user_id: str, format: str = "ndjson", since: Optional[datetime] = None, gzip: bool = False) -> AsyncIterator[bytes]:
+    """Stream a user's history as NDJSON or CSV bytes, gzipped if asked"""
+    compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31) if gzip else None
+
+    async def output(data: bytes) -> bytes:
+        if compressor is None:
+            return data
+        if len(data) > _THREAD_COMPRESS_SIZE:
+            return await asyncio.to_thread(compressor.compress, data)
+        return compressor.compress(data)
+
+    if format == "csv":
+        yield await output(encode_csv([], header=True))
+    async for rows in iter_history(user_id, since):
+        data = await output(encode_ndjson(rows) if format == "ndjson" else encode_csv(rows))
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+def _decompressed(chunk: bytes, decompressor) -> List[bytes]:
+    """Inflate a chunk a bounded piece at a time, so a tiny upload can't expand into one huge buffer"""
+    pieces = [decompressor.decompress(chunk, 1 << 20)]
+    while decompressor.unconsumed_tail:
+        pieces.append(decompressor.decompress(decompressor.unconsumed_tail, 1 << 20))
+    return pieces
+
+def _parse_line(line: bytes, line_number: int, user_id: str) -> Dict[str, Any]:
+    try:
+        data = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        raise InvalidImport(f"Line {line_number}: not valid JSON")
+    if not isinstance(data, dict) or not isinstance(data.get("question"), str) or not isinstance(data.get("answer"), str):
+        raise InvalidImport(f"Line {line_number}: expected an object with string question and answer")
+    timestamp = datetime.now()
+    if data.get("timestamp") is not None:
+        try:
+            timestamp = _naive(datetime.fromisoformat(data["timestamp"]))
+        except (TypeError, ValueError):
+            raise InvalidImport(f"Line {line_number}: timestamp must be an ISO 8601 string")
+    row_id = data.get("id")
+    return {
+        # Keeping exported ids makes re-importing the same file a no-op
+        "id": row_id if isinstance(row_id, str) and 0 < len(row_id) <= 36 else str(uuid.uuid4()),
+        "question": data["question"],
+        "answer": data["answer"],
+        "timestamp": timestamp,
+        "user_id": user_id,
+        "is_partial": bool(data.get("is_partial", False)),
+        # Conversations aren't exported, so imported rows don't belong to one
+        "conversation_id": None,
+    }
+
+async def _insert_batch(user_id: str, rows: List[Dict[str, Any]]) -> int:
+    """Insert rows not already in this user's history; returns how many were inserted"""
+    async def owners(ids: List[str]) -> Dict[str, str]:
+        found = {}
+        for model in (QueryHistory, QueryHistoryArchive):
+            found.update((await db.execute(select(model.id, model.user_id).where(model.id.in_(ids)))).all())
+        return found
+
+    async with AsyncSessionLocal() as db:
+        existing = await owners([row["id"] for row in rows])
+        # Ids taken by another user's rows (e.g. importing someone's export) get an id derived from
+        # the original, so importing the same file twice still skips what the first run added
+        taken = [row for row in rows if row["id"] in existing and existing[row["id"]] != user_id]
+        for row in taken:
+            row["id"] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{user_id}/{row['id']}"))
+        if taken:
+            existing.update(await owners([row["id"] for row in taken]))
+        fresh, seen = [], set()
+        for row in rows:
+            if row["id"] in seen or row["id"] in existing:
+                continue
+            seen.add(row["id"])
+            fresh.append(row)
+        if fresh:
+            await db.execute(insert(QueryHistory), fresh)
+            # An account deleted while its import was running keeps none of it
+            if (await db.execute(delete_orphaned_history(row["id"] for row in fresh))).scalars().all():
+                fresh = []
+            await db.execute(touch_history([user_id]))
+            await db.commit()
+    if fresh:
+        invalidate_history_count(user_id)
+        await related_index.add_rows(fresh)
+    return len(fresh)
+
+async def import_history(user_id: str, body: AsyncIterator[bytes]) -> Dict[str, int]:
+    """
+    Add NDJSON history rows (as written by export_history, optionally
+    gzipped) to a user's history in batched bulk inserts.
+
+    Rows whose id is already in the user's history are skipped, so an
+    interrupted import can simply be sent again. Raises InvalidImport on
+    the first bad line; batches before it stay imported.
+    """
+    batch_size = settings.HISTORY_IMPORT_BATCH_SIZE
+    max_line = settings.HISTORY_IMPORT_MAX_LINE_BYTES
+    decompressor = None
+    started = False
+    pending = b""
+    line_number = imported = read = 0
+    batch: List[Dict[str, Any]] = []
+
+    async def flush():
+        nonlocal imported, batch
+        if batch:
+            imported += await _insert_batch(user_id, batch)
+            batch = []
+
+    async def take(lines: List[bytes]):
+        nonlocal line_number, read
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                try:
+                    batch.append(_parse_line(line, line_number, user_id))
+                except InvalidImport as e:
+                    raise InvalidImport(str(e), imported)
+                read += 1
+                if len(batch) >= batch_size:
+                    await flush()
+
+    async for chunk in body:
+        if not started and chunk:
+            started = True
+            if chunk[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(31)
+        for piece in _decompressed(chunk, decompressor) if decompressor else [chunk]:
+            lines = (pending + piece).split(b"\n")
+            pending = lines.pop()
+            if len(pending) > max_line:
+                raise InvalidImport(f"Line {line_number + len(lines) + 1}: longer than {max_line} bytes", imported)
+            await take(lines)
+    if decompressor is not None:
+        pending += decompressor.flush()
+    await take([pending])
+    await flush()
+    return {"imported": imported, "skipped": read - imported}
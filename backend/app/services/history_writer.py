@@ -0,0 +1,357 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, StatementError
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.db.database import AsyncSessionLocal, QueryHistory, User
+from app.services.history import delete_orphaned_history, invalidate_history_count, touch_history
+from app.services.related import related_index
+
+logger = logging.getLogger(__name__)
+
+# Queued by stop() after the last row, telling the flush loop to exit
+_STOP = object()
+
+FLUSH_DURATION = registry.histogram("qa_history_flush_duration_seconds", "Duration of each history bulk insert")
+ROWS_WRITTEN = registry.counter("qa_history_rows_total", "History rows by where they ended up", ["result"])
+
+# Keys a spooled row must have to be inserted
+_SPOOLED_KEYS = ("id", "question", "answer", "timestamp")
+
+def _rejects_row(error: Exception) -> bool:
+    """Whether an insert failed because of the rows themselves, rather than the database being unavailable"""
+    if isinstance(error, (IntegrityError, DataError)):
+        return True
+    # Raised while converting a value, before anything reaches the database
+    return isinstance(error, StatementError) and not isinstance(error, DBAPIError)
+
+def _parse_spooled(line: str) -> Dict[str, Any]:
+    row = json.loads(line)
+    if not isinstance(row, dict) or any(key not in row for key in _SPOOLED_KEYS):
+        raise ValueError("not a history row")
+    row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+    return row
+
+class HistoryWriter:
+    """
+    Write-behind queue for QueryHistory rows.
+
+    Rows are queued in memory and bulk-inserted in batches, flushed when a
+    batch fills up or the flush interval passes. If the database can't take
+    a batch (or the queue is full), rows are appended to a local JSONL spool
+    file and replayed later, so an answered question is never lost. Rows
+    the database refuses outright, and spool lines that can't be read, are
+    set aside in a `.rejected` file next to the spool instead of blocking
+    the replay of everything after them. Rows of users deleted meanwhile
+    are dropped. Spool files are written in a thread, so a slow disk never
+    blocks the event loop.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int, spool_path: str, spool_retry: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.spool_path = spool_path
+        self.spool_retry = spool_retry
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_spool_replay = 0.0
+        # Queued rows by id, so a user's newest answers are visible before they are flushed
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        # Rows the full queue turned away, waiting for _spool_overflow to write them out
+        self._overflow: List[Dict[str, Any]] = []
+        self._overflow_task: Optional[asyncio.Task] = None
+        # Spool writes run in threads; one at a time, and never while the spool is moved aside for replay
+        self._spool_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._queue is None:
+            # Created once, so a restarted loop picks up whatever the previous one left queued
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def start(self):
+        """Start the flush loop and replay anything left in the spool"""
+        self._ensure_started()
+        await self._replay_spool()
+
+    def submit(
+        self,
+        question: str,
+        answer: str,
+        user_id: Optional[str],
+        is_partial: bool = False,
+        timestamp: Optional[datetime] = None,
+        conversation_id: Optional[str] = None
+    ) -> str:
+        """Queue a history row without waiting for the database; returns its id"""
+        return self.enqueue(self.make_row(question, answer, user_id, is_partial, timestamp, conversation_id))
+
+    def enqueue(self, row: Dict[str, Any]) -> str:
+        """Queue a row built by make_row(); returns its id"""
+        self._ensure_started()
+        self._pending[row["id"]] = row
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            logger.warning("History write queue is full; spooling row to disk")
+            self._overflow.append(row)
+            if self._overflow_task is None or self._overflow_task.done():
+                self._overflow_task = asyncio.create_task(self._spool_overflow())
+        return row["id"]
+
+    async def _spool_overflow(self):
+        """Spool the rows the full queue turned away, all that gathered meanwhile in one write"""
+        while self._overflow:
+            rows, self._overflow = self._overflow, []
+            try:
+                await asyncio.to_thread(self._spool, rows)
+            except Exception as e:
+                logger.error(f"Failed to spool {len(rows)} history rows, they are lost: {str(e)}")
+            finally:
+                for row in rows:
+                    self._pending.pop(row["id"], None)
+
+    @staticmethod
+    def make_row(
+        question: str,
+        answer: str,
+        user_id: Optional[str],
+        is_partial: bool = False,
+        timestamp: Optional[datetime] = None,
+        conversation_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Build a history row with a fresh id, ready for enqueue() or write_now()"""
+        return {
+            "id": str(uuid.uuid4()),
+            "question": question,
+            "answer": answer,
+            "timestamp": timestamp or datetime.now(),
+            "user_id": user_id,
+            "is_partial": is_partial,
+            "conversation_id": conversation_id,
+        }
+
+    async def write_now(self, rows: List[Dict[str, Any]]):
+        """Insert rows from make_row() in one bulk insert, bypassing the queue (spooled on failure)"""
+        if rows:
+            await self._flush(rows)
+
+    def pending_for(self, user_id: str) -> List[QueryHistory]:
+        """Unflushed rows for a user, newest first, as transient QueryHistory objects"""
+        rows = [row for row in self._pending.values() if row["user_id"] == user_id]
+        rows.sort(key=lambda row: (row["timestamp"], row["id"]), reverse=True)
+        return [QueryHistory(**row) for row in rows]
+
+    def detach_conversation(self, conversation_id: str):
+        """Clear conversation_id on queued rows before their conversation is deleted"""
+        # Queued rows are the same dicts as in _pending, so this updates what gets inserted
+        for row in list(self._pending.values()):
+            if row["conversation_id"] == conversation_id:
+                row["conversation_id"] = None
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+
+            # Collect until the batch is full or the flush interval has passed
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            # Nothing may end the loop early: rows queued after this batch would never be written
+            try:
+                await self._flush(batch)
+                if not stopping and time.monotonic() - self._last_spool_replay >= self.spool_retry:
+                    await self._replay_spool()
+            except Exception as e:
+                logger.error(f"History write loop failed on a batch, continuing: {str(e)}")
+
+    async def _flush(self, rows: List[Dict[str, Any]]):
+        started = time.perf_counter()
+        try:
+            ROWS_WRITTEN.inc(len(await self._insert(rows)), result="inserted")
+        except Exception as e:
+            logger.error(f"Failed to write {len(rows)} history rows, spooling to disk: {str(e)}")
+            await asyncio.to_thread(self._spool, rows)
+        finally:
+            FLUSH_DURATION.observe(time.perf_counter() - started)
+            for row in rows:
+                self._pending.pop(row["id"], None)
+
+    async def _insert(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert rows in one transaction, leaving out those whose user was deleted; returns the rows inserted"""
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(QueryHistory), rows)
+            orphaned = set((await db.execute(delete_orphaned_history(row["id"] for row in rows))).scalars())
+            await db.execute(touch_history(row["user_id"] for row in rows))
+            await db.commit()
+        if orphaned:
+            self._drop(len(orphaned))
+            rows = [row for row in rows if row["id"] not in orphaned]
+        for user_id in {row["user_id"] for row in rows}:
+            invalidate_history_count(user_id)
+        await related_index.add_rows(rows)
+        return rows
+
+    def _drop(self, count: int):
+        ROWS_WRITTEN.inc(count, result="dropped")
+        logger.warning(f"Dropped {count} history rows whose user has been deleted")
+
+    def _spool(self, rows: List[Dict[str, Any]]):
+        """Append rows to the spool file; blocking, so call it in a thread"""
+        ROWS_WRITTEN.inc(len(rows), result="spooled")
+        lines = [json.dumps({**row, "timestamp": row["timestamp"].isoformat()}) + "\n" for row in rows]
+        with self._spool_lock, open(self.spool_path, "a", encoding="utf-8") as spool:
+            spool.writelines(lines)
+            spool.flush()
+            os.fsync(spool.fileno())
+
+    def _reject(self, lines: List[str], reason: str):
+        """Set spool lines aside in the .rejected file, where they no longer hold up the replay; blocking"""
+        ROWS_WRITTEN.inc(len(lines), result="rejected")
+        logger.error(f"Moving {len(lines)} history rows to {self.spool_path}.rejected: {reason}")
+        with open(f"{self.spool_path}.rejected", "a", encoding="utf-8") as rejected:
+            for line in lines:
+                rejected.write(line.rstrip("\n") + "\n")
+            rejected.flush()
+            os.fsync(rejected.fileno())
+
+    async def _unwritten(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """The spooled rows still to insert: not in the database yet, and their user not deleted"""
+        async with AsyncSessionLocal() as db:
+            existing = set((await db.execute(
+                select(QueryHistory.id).where(QueryHistory.id.in_([row["id"] for row in rows]))
+            )).scalars())
+            users = set((await db.execute(
+                select(User.id).where(User.id.in_({row["user_id"] for row in rows if row["user_id"] is not None}))
+            )).scalars())
+        unwritten, dropped = [], 0
+        for row in rows:
+            if row["id"] in existing:
+                continue
+            if row["user_id"] is not None and row["user_id"] not in users:
+                dropped += 1
+                continue
+            unwritten.append(row)
+        if dropped:
+            self._drop(dropped)
+        return unwritten
+
+    async def _replay_spool(self):
+        """Insert spooled rows, skipping any that already made it to the database"""
+        self._last_spool_replay = time.monotonic()
+        try:
+            await self._replay()
+        except Exception as e:
+            logger.error(f"History spool replay failed, will retry: {str(e)}")
+
+    def _load_replay(self, replay_path: str) -> Optional[List[Dict[str, Any]]]:
+        """The spooled rows to replay, or None if there are none; blocking, so call it in a thread"""
+        # Move the spool aside first so rows spooled meanwhile go to a fresh file.
+        # A leftover .replay file is from an earlier attempt that failed and is retried first.
+        if not os.path.exists(replay_path):
+            with self._spool_lock:
+                if not os.path.exists(self.spool_path):
+                    return None
+                os.replace(self.spool_path, replay_path)
+
+        rows, lines, unreadable = [], [], []
+        with open(replay_path, encoding="utf-8") as spool:
+            for line in spool:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(_parse_spooled(line))
+                    lines.append(line)
+                except (ValueError, TypeError) as e:
+                    # e.g. a line torn by a crash while it was being spooled
+                    unreadable.append((line, str(e)))
+        if unreadable:
+            self._reject([line for line, _ in unreadable], f"unreadable spool lines ({unreadable[0][1]})")
+            # Rewrite the replay file without them, so a retry doesn't reject them twice
+            with open(f"{replay_path}.tmp", "w", encoding="utf-8") as spool:
+                spool.writelines(lines)
+            os.replace(f"{replay_path}.tmp", replay_path)
+        return rows
+
+    async def _replay(self):
+        replay_path = f"{self.spool_path}.replay"
+        rows = await asyncio.to_thread(self._load_replay, replay_path)
+        if rows is None:
+            return
+
+        replayed = 0
+        for start in range(0, len(rows), self.batch_size):
+            batch = await self._unwritten(rows[start:start + self.batch_size])
+            if not batch:
+                continue
+            try:
+                replayed += len(await self._insert(batch))
+                continue
+            except Exception as e:
+                # The database being down ends the replay, to be retried; anything else is down to the rows
+                if not _rejects_row(e):
+                    raise
+            # One bad row fails its whole batch, so find it and let the rest in
+            for row in batch:
+                if not await self._unwritten([row]):
+                    continue
+                try:
+                    replayed += len(await self._insert([row]))
+                except Exception as e:
+                    if not _rejects_row(e):
+                        raise
+                    line = json.dumps({**row, "timestamp": row["timestamp"].isoformat()})
+                    await asyncio.to_thread(self._reject, [line], str(e))
+
+        os.remove(replay_path)
+        logger.info(f"Replayed {replayed} spooled history rows")
+
+    async def stop(self):
+        """Flush everything still queued and stop the loop (called on application shutdown)"""
+        if self._task is not None and not self._task.done():
+            await self._queue.put(_STOP)
+            await self._task
+            self._task = None
+        # Rows the full queue turned away may still be on their way to the spool
+        if self._overflow_task is not None:
+            await self._overflow_task
+
+history_writer = HistoryWriter(
+    batch_size=settings.HISTORY_WRITE_BATCH_SIZE,
+    flush_interval=settings.HISTORY_WRITE_FLUSH_INTERVAL,
+    max_queue=settings.HISTORY_WRITE_MAX_QUEUE,
+    spool_path=settings.HISTORY_SPOOL_PATH,
+    spool_retry=settings.HISTORY_SPOOL_RETRY_SECONDS,
+)
+
+registry.gauge(
+    "qa_history_rows_pending", "History rows queued but not yet written", collect=lambda: [({}, len(history_writer._pending))]
+)
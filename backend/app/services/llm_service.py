@@ -1,103 +1,635 @@
-import requests
+import asyncio
+import httpx
 import json
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, List, Optional, AsyncIterator, Tuple
+from urllib.parse import urlsplit
 from app.core.config import settings
+from app.core.metrics import registry
+from app.services.answer_cache import answer_cache, make_cache_key
+from app.services.governor import RETRYABLE_STATUS_CODES, backoff_delay, parse_retry_after, upstream_limiter
+from app.services.model_registry import ModelEndpoint, model_registry
+from app.services.prompts import PromptTemplate, prompt_registry
 import logging
 
 logger = logging.getLogger(__name__)
 
+UPSTREAM_DURATION = registry.histogram(
+    "qa_llm_upstream_duration_seconds", "Duration of each Gemini HTTP call (streams until their last chunk)",
+    ["model", "call", "status"]
+)
+UPSTREAM_TOKENS = registry.counter(
+    "qa_llm_tokens_total", "Tokens billed by Gemini, from usageMetadata", ["model", "kind"]
+)
+
+def _usage(usage_metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, int]]:
+    """Gemini's usageMetadata as answer metadata"""
+    if not usage_metadata:
+        return None
+    prompt_tokens = usage_metadata.get("promptTokenCount", 0)
+    completion_tokens = usage_metadata.get("candidatesTokenCount", 0)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": usage_metadata.get("totalTokenCount", prompt_tokens + completion_tokens)
+    }
+    if usage_metadata.get("cachedContentTokenCount"):
+        # The part of prompt_tokens served from a cached context, billed at the cached rate
+        usage["cached_tokens"] = usage_metadata["cachedContentTokenCount"]
+    return usage
+
+def _record_usage(model: str, usage_metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, int]]:
+    """Count a finished response's tokens and return its usage metadata"""
+    usage = _usage(usage_metadata)
+    if usage:
+        UPSTREAM_TOKENS.inc(usage["prompt_tokens"], model=model, kind="prompt")
+        UPSTREAM_TOKENS.inc(usage["completion_tokens"], model=model, kind="completion")
+        if "cached_tokens" in usage:
+            UPSTREAM_TOKENS.inc(usage["cached_tokens"], model=model, kind="cached")
+    return usage
+
+class LLMServiceError(Exception):
+    """Raised when a streamed Gemini response fails"""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        # Set when the failure is transient: seconds the client should wait before trying again
+        self.retry_after = retry_after
+
 class LLMService:
     def __init__(self):
-        self.api_key = settings.GEMINI_API_KEY
-        self.model = "gemini-1.5-flash"  # Using a currently available model
-        self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
+        # Which model (and endpoint) answers is decided per request by the registry
+        self.registry = model_registry
+        self.model = model_registry.default_endpoint.model
+        
+        # The HTTP client is created lazily so it binds to the running event loop
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        
+        # Single-flight: upstream calls in progress, keyed by the answer cache key
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.upstream_requests = 0
+        self.coalesced_requests = 0
+        self.failovers = 0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        
+        # Gemini cachedContents per (endpoint, prompt): (name, or None after a failed create; monotonic expiry)
+        self._cached_contexts: Dict[Tuple[str, str], Tuple[Optional[str], float]] = {}
+        self._cached_context_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared keep-alive client, creating it on first use"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    connect=settings.LLM_CONNECT_TIMEOUT,
+                    read=settings.LLM_READ_TIMEOUT,
+                    write=settings.LLM_WRITE_TIMEOUT,
+                    pool=settings.LLM_POOL_TIMEOUT,
+                ),
+                limits=httpx.Limits(
+                    max_connections=settings.LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+                ),
+                headers={"Content-Type": "application/json"},
+            )
+        return self._client
+    
+    def _get_host_semaphore(self, url: str) -> asyncio.Semaphore:
+        """Limit the number of concurrent upstream calls per host"""
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(settings.LLM_MAX_CONCURRENCY_PER_HOST)
+        return self._host_semaphores[host]
     
-    async def get_response(self, question: str, context: Optional[str] = None) -> Dict[str, Any]:
+    async def aclose(self):
+        """Close the pooled HTTP client (called on application shutdown)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def _template(self, question: str, tier: Optional[str], prompt: Optional[str]) -> PromptTemplate:
+        """The prompt template for a request: the caller's choice, else the routing rules', else the default"""
+        return prompt_registry.get(prompt or self.registry.prompt_for(question, tier))
+    
+    async def _cached_context(self, endpoint: ModelEndpoint, template: PromptTemplate) -> Optional[str]:
+        """
+        Name of a Gemini cachedContent holding the template's instruction for this endpoint, creating it if needed
+        
+        Returns None (send the instruction inline) for templates without
+        `cache_context`, or if the cache couldn't be created; a failed
+        create isn't retried for LLM_CONTEXT_CACHE_RETRY_SECONDS.
         """
-        Get a response from Gemini for the given question using direct API calls
+        if not template.cache_context:
+            return None
+        key = (endpoint.name, template.name)
+        entry = self._cached_contexts.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        
+        lock = self._cached_context_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._cached_contexts.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+            ttl = settings.LLM_CONTEXT_CACHE_TTL_SECONDS
+            name = None
+            try:
+                response = await self._get_client().post(
+                    endpoint.cache_url,
+                    params={"key": endpoint.api_key},
+                    json={"model": f"models/{endpoint.model}", "systemInstruction": template.system_content, "ttl": f"{ttl}s"}
+                )
+                if response.status_code == 200:
+                    name = response.json().get("name")
+                else:
+                    logger.warning(f"Couldn't cache the {template.name} prompt on {endpoint.name}, sending it inline: "
+                                   f"{response.status_code} - {response.text[:200]}")
+            except httpx.HTTPError as e:
+                logger.warning(f"Couldn't cache the {template.name} prompt on {endpoint.name}, sending it inline: {str(e)}")
+            # Replace the cache a little before Gemini expires it, so no call refers to an expired one
+            lifetime = ttl * 0.9 if name else settings.LLM_CONTEXT_CACHE_RETRY_SECONDS
+            self._cached_contexts[key] = (name, time.monotonic() + lifetime)
+            if name:
+                logger.info(f"Cached the {template.name} prompt on {endpoint.name} as {name}")
+            return name
+    
+    async def _endpoint_payload(self, payload: Dict[str, Any], endpoint: ModelEndpoint, template: PromptTemplate) -> Dict[str, Any]:
+        """The payload to send to an endpoint: refers to the cached instruction when there is one"""
+        name = await self._cached_context(endpoint, template)
+        if name is None:
+            return payload
+        request = {key: value for key, value in payload.items() if key != "systemInstruction"}
+        request["cachedContent"] = name
+        return request
+    
+    def _drop_cached_context(self, endpoint: ModelEndpoint, template: PromptTemplate):
+        """Stop using a cached instruction Gemini rejected (e.g. expired or deleted); the next call recreates it"""
+        logger.warning(f"Gemini rejected the cached {template.name} prompt on {endpoint.name}; retrying with it inline")
+        self._cached_contexts.pop((endpoint.name, template.name), None)
+    
+    async def get_response(
+        self,
+        question: str,
+        context: Optional[str] = None,
+        history: Optional[List[Dict[str, Any]]] = None,
+        tier: Optional[str] = None,
+        prompt: Optional[str] = None
+    ) -> Dict[str, Any]:
         """
+        Get a response from Gemini for the given question, serving repeats from the answer cache
+        
+        `history` is the `contents` of earlier conversation turns, oldest first.
+        `tier` is the asking user's tier, which routing rules may match on.
+        `prompt` names the prompt template to use instead of the routed one.
+        """
+        route = self.registry.route(question, tier)
+        template = self._template(question, tier, prompt)
+        payload = template.build_payload(question, context, history)
+        cache_key = make_cache_key(
+            question, context, route[0].model, payload["generationConfig"], history, prompt=template.fingerprint
+        )
+        
+        cached = await answer_cache.get(cache_key)
+        if cached is not None:
+            return {
+                "answer": cached["answer"],
+                "success": True,
+                "metadata": {
+                    "model": cached["model"],
+                    "cache": "hit"
+                }
+            }
+        
+        # Identical prompts already in flight share one upstream call
+        task = self._inflight.get(cache_key) if settings.LLM_COALESCE_REQUESTS else None
+        coalesced = task is not None
+        if coalesced:
+            self.coalesced_requests += 1
+        else:
+            task = asyncio.ensure_future(self._generate_and_cache(cache_key, question, payload, route, template))
+            if settings.LLM_COALESCE_REQUESTS:
+                self._inflight[cache_key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+        
+        # Shield the shared call so one caller disconnecting doesn't cancel it for the others
+        result = dict(await asyncio.shield(task))
+        if result["success"]:
+            result["metadata"] = {
+                **result["metadata"],
+                "cache": "miss" if answer_cache.enabled else "disabled",
+                "coalesced": coalesced
+            }
+        return result
+    
+    async def _generate_and_cache(
+        self,
+        cache_key: str,
+        question: str,
+        payload: Dict[str, Any],
+        route: List[ModelEndpoint],
+        template: PromptTemplate
+    ) -> Dict[str, Any]:
+        """Make the upstream call for a cache miss, failing over along the route, and cache the first model's answer"""
+        self.upstream_requests += 1
+        for position, endpoint in enumerate(route):
+            request = await self._endpoint_payload(payload, endpoint, template)
+            result = await self._generate_hedged(request, endpoint)
+            if not result["success"] and request is not payload and result.get("retry_after") is None:
+                self._drop_cached_context(endpoint, template)
+                result = await self._generate_hedged(payload, endpoint)
+            if result["success"]:
+                result["metadata"]["failover"] = position > 0
+                # The key is built from the route's first model, so a fallback's answer would be
+                # served as that model's for the whole TTL; only the first model's answers are cached
+                if position == 0:
+                    await answer_cache.set(cache_key, question, result["answer"], endpoint.model)
+                return result
+            if position + 1 < len(route):
+                self.failovers += 1
+                logger.warning(f"Model {endpoint.name} failed, failing over to {route[position + 1].name}: {result['error']}")
+        return result
+    
+    async def _timed_generate(self, payload: Dict[str, Any], endpoint: ModelEndpoint) -> Dict[str, Any]:
+        started = time.perf_counter()
+        result = await self._generate(payload, endpoint)
+        if result["success"]:
+            endpoint.observe(time.perf_counter() - started)
+        return result
+    
+    async def _generate_hedged(self, payload: Dict[str, Any], endpoint: ModelEndpoint) -> Dict[str, Any]:
+        """
+        Call an endpoint, hedging if it is slow
+        
+        With LLM_HEDGE_ENABLED, once the call has run longer than the
+        endpoint's observed p95 an identical second call is sent, and
+        whichever succeeds first wins. The outcome is reported as
+        `metadata.hedge`.
+        """
+        p95 = endpoint.p95() if settings.LLM_HEDGE_ENABLED else None
+        if p95 is None:
+            result = await self._timed_generate(payload, endpoint)
+            return self._with_hedge(result, "warming_up" if settings.LLM_HEDGE_ENABLED else "disabled")
+        
+        primary = asyncio.ensure_future(self._timed_generate(payload, endpoint))
+        pending = {primary}
         try:
-            # Create system prompt for better responses
-            system_prompt = """
-            You are an expert AI assistant providing accurate, well-structured answers.
-            
-            When responding to user queries:
-            1. Research the topic thoroughly using your knowledge
-            2. Organize information into clear sections with bullet points when appropriate
-            3. Be concise yet comprehensive
-            4. Format your response to be easy to read and understand
-            5. Include all necessary details relevant to the query
-            6. If the query is travel-related, include visa requirements, passport info, and any advisories
-            
-            Respond in markdown format for better readability.
-            """
+            done, _ = await asyncio.wait(pending, timeout=max(p95, settings.LLM_HEDGE_MIN_DELAY))
+            if done:
+                return self._with_hedge(primary.result(), "not_needed")
             
-            # Build the message content
-            message_content = question
-            if context:
-                message_content = f"Context: {context}\n\nQuestion: {question}"
+            self.hedged_requests += 1
+            hedge = asyncio.ensure_future(self._timed_generate(payload, endpoint))
+            pending.add(hedge)
+            failure = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result["success"]:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return self._with_hedge(result, "hedge_won" if task is hedge else "primary_won")
+                    failure = failure or result
+            return failure
+        finally:
+            # Drop the slower call (or both, if we were cancelled)
+            for task in pending:
+                task.cancel()
+    
+    @staticmethod
+    def _with_hedge(result: Dict[str, Any], hedge: str) -> Dict[str, Any]:
+        if result["success"]:
+            result["metadata"] = {**result["metadata"], "hedge": hedge}
+        return result
+    
+    def stats(self) -> Dict[str, Any]:
+        """Upstream call counters for the admin endpoint"""
+        total = self.upstream_requests + self.coalesced_requests
+        return {
+            "upstream_requests": self.upstream_requests,
+            "coalesced_requests": self.coalesced_requests,
+            "coalesced_ratio": round(self.coalesced_requests / total, 4) if total else 0.0,
+            "in_flight": len(self._inflight),
+            "failovers": self.failovers,
+            "hedged_requests": self.hedged_requests,
+            "hedge_wins": self.hedge_wins,
+            "cached_contexts": {
+                f"{endpoint}/{prompt}": name for (endpoint, prompt), (name, _) in self._cached_contexts.items()
+            },
+            "models": self.registry.stats(),
+            "rate_limit": {
+                "enabled": upstream_limiter.enabled,
+                "backend": upstream_limiter.backend.name,
+                "per_minute": settings.LLM_RATE_LIMIT_PER_MINUTE,
+                "burst": upstream_limiter.capacity
+            }
+        }
+    
+    async def _admit(self, endpoint: ModelEndpoint) -> Optional[LLMServiceError]:
+        """
+        Check the endpoint's circuit breaker and take a token from the upstream rate limiter
+        
+        Returns the error to fail with if the call may not go ahead.
+        """
+        if not endpoint.breaker.allow():
+            return LLMServiceError(
+                f"{endpoint.model} is temporarily unavailable", retry_after=endpoint.breaker.retry_after()
+            )
+        wait = await upstream_limiter.acquire(endpoint.rate_limit_key, max_wait=settings.LLM_RATE_LIMIT_MAX_WAIT)
+        if wait:
+            return LLMServiceError("Gemini rate limit reached", retry_after=wait)
+        return None
+    
+    async def _record_upstream_failure(
+        self,
+        endpoint: ModelEndpoint,
+        status_code: Optional[int],
+        retry_after: Optional[float],
+        attempt: int
+    ):
+        """Count a failed attempt against the breaker; a 429 also slows down every caller"""
+        endpoint.breaker.record_failure()
+        if status_code == 429:
+            await upstream_limiter.penalize(endpoint.rate_limit_key, retry_after or backoff_delay(attempt))
+    
+    async def _generate(self, payload: Dict[str, Any], endpoint: ModelEndpoint) -> Dict[str, Any]:
+        """
+        Call Gemini generateContent with a prepared payload using direct API calls
+        
+        429/5xx responses and transport errors are retried with jittered
+        exponential backoff that honors Retry-After. Failures that are worth
+        retrying later carry a `retry_after` (seconds) in the result.
+        """
+        error_message = ""
+        retry_after = None
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            if attempt:
+                delay = backoff_delay(attempt - 1, retry_after)
+                logger.warning(f"Retrying Gemini call in {delay:.2f}s (attempt {attempt + 1}): {error_message}")
+                await asyncio.sleep(delay)
             
-            # Full prompt combining system instructions and user query
-            full_prompt = f"{system_prompt}\n\nUser Query: {message_content}"
+            rejected = await self._admit(endpoint)
+            if rejected is not None:
+                logger.error(str(rejected))
+                return self._failure(str(rejected), rejected.retry_after)
             
-            # Prepare the API request payload
-            payload = {
-                "contents": [
-                    {
-                        "parts": [
-                            {"text": full_prompt}
-                        ]
+            status_code = None
+            retry_after = None
+            outcome = "cancelled"
+            started = time.perf_counter()
+            try:
+                # Make the API call over the pooled client, passing the API key as a URL parameter
+                async with self._get_host_semaphore(endpoint.generate_url):
+                    started = time.perf_counter()
+                    response = await self._get_client().post(
+                        endpoint.generate_url, params={"key": endpoint.api_key}, json=payload
+                    )
+                outcome = str(response.status_code)
+            except httpx.TimeoutException as e:
+                outcome = "timeout"
+                error_message = f"Timed out querying Gemini: {type(e).__name__}"
+            except httpx.TransportError as e:
+                outcome = "error"
+                error_message = f"Error querying Gemini: {str(e)}"
+            except Exception as e:
+                outcome = "error"
+                error_message = f"Error querying Gemini: {str(e)}"
+                logger.error(error_message)
+                return self._failure(error_message)
+            else:
+                status_code = response.status_code
+                
+                # Check for successful response
+                if status_code == 200:
+                    # A 200 can still carry no usable answer: a body that isn't JSON, no candidates
+                    # (a blocked prompt), or a part without text (a safety block or a function call)
+                    try:
+                        response_data = response.json()
+                        answer_text = response_data["candidates"][0]["content"]["parts"][0]["text"]
+                        if not isinstance(answer_text, str):
+                            raise TypeError(f"answer text is {type(answer_text).__name__}")
+                        usage = _record_usage(endpoint.model, response_data.get("usageMetadata"))
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                        error_message = f"API Error: {status_code} - no usable answer ({type(e).__name__}: {e}): {response.text[:1000]}"
+                        logger.error(error_message)
+                        return self._failure(error_message)
+                    endpoint.breaker.record_success()
+                    metadata = {
+                        "model": endpoint.model,
+                        "route": endpoint.name
                     }
-                ],
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "topK": 40,
-                    "topP": 0.95,
-                    "maxOutputTokens": 1024,
-                }
-            }
+                    if usage:
+                        metadata["usage"] = usage
+                    return {
+                        "answer": answer_text,
+                        "success": True,
+                        "metadata": metadata
+                    }
+                
+                error_message = f"API Error: {status_code} - {response.text}"
+                if status_code not in RETRYABLE_STATUS_CODES:
+                    logger.error(error_message)
+                    return self._failure(error_message)
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            finally:
+                UPSTREAM_DURATION.observe(
+                    time.perf_counter() - started, model=endpoint.model, call="generate", status=outcome
+                )
             
-            # Add the API key as a URL parameter
-            url = f"{self.base_url}?key={self.api_key}"
+            await self._record_upstream_failure(endpoint, status_code, retry_after, attempt)
+        
+        logger.error(f"Giving up on {endpoint.model} after {settings.LLM_MAX_RETRIES + 1} attempts: {error_message}")
+        return self._failure(error_message, retry_after if retry_after is not None else settings.LLM_BACKOFF_BASE)
+    
+    @staticmethod
+    def _failure(error_message: str, retry_after: Optional[float] = None) -> Dict[str, Any]:
+        result = {
+            "answer": "",
+            "success": False,
+            "error": error_message
+        }
+        if retry_after is not None:
+            result["retry_after"] = retry_after
+        return result
+    
+    async def stream_response(
+        self,
+        question: str,
+        context: Optional[str] = None,
+        history: Optional[List[Dict[str, Any]]] = None,
+        tier: Optional[str] = None,
+        prompt: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream a response from Gemini using streamGenerateContent over SSE
+        
+        Yields one dict per upstream chunk with the new ``text``, the
+        ``model`` answering and, when Gemini reports them, the
+        ``finish_reason`` and token ``usage`` so far.
+        Raises LLMServiceError if the upstream call fails. Failures are
+        retried, and then failed over to the next model on the route, like
+        in get_response, but only until the first chunk has been yielded.
+        """
+        route = self.registry.route(question, tier)
+        template = self._template(question, tier, prompt)
+        payload = template.build_payload(question, context, history)
+        
+        for position, endpoint in enumerate(route):
+            request = await self._endpoint_payload(payload, endpoint, template)
+            started = False
+            try:
+                try:
+                    async for chunk in self._stream_endpoint(request, endpoint):
+                        started = True
+                        yield chunk
+                except LLMServiceError as e:
+                    if started or request is payload or e.retry_after is not None:
+                        raise
+                    self._drop_cached_context(endpoint, template)
+                    async for chunk in self._stream_endpoint(payload, endpoint):
+                        started = True
+                        yield chunk
+                return
+            except LLMServiceError as e:
+                if started or position + 1 == len(route):
+                    raise
+                self.failovers += 1
+                logger.warning(f"Model {endpoint.name} failed, failing over to {route[position + 1].name}: {str(e)}")
+    
+    async def _stream_endpoint(self, payload: Dict[str, Any], endpoint: ModelEndpoint) -> AsyncIterator[Dict[str, Any]]:
+        """Stream one endpoint's answer, retrying until the first chunk"""
+        error = None
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            if attempt:
+                delay = backoff_delay(attempt - 1, error.retry_after)
+                logger.warning(f"Retrying Gemini stream in {delay:.2f}s (attempt {attempt + 1}): {error}")
+                await asyncio.sleep(delay)
             
-            # Make the API call
-            headers = {"Content-Type": "application/json"}
-            response = requests.post(url, headers=headers, json=payload)
+            rejected = await self._admit(endpoint)
+            if rejected is not None:
+                logger.error(str(rejected))
+                raise rejected
             
-            # Check for successful response
-            if response.status_code == 200:
-                response_data = response.json()
-
-                # Extract text from the response
-                if "candidates" in response_data and len(response_data["candidates"]) > 0:
-                    if "content" in response_data["candidates"][0]:
-                        content = response_data["candidates"][0]["content"]
-                        if "parts" in content and len(content["parts"]) > 0:
-                            answer_text = content["parts"][0]["text"]
-                            return {
-                                "answer": answer_text,
-                                "success": True,
-                                "metadata": {
-                                    "model": self.model
+            status_code = None
+            started = False
+            outcome = "cancelled"
+            call_started = time.perf_counter()
+            try:
+                async with self._get_host_semaphore(endpoint.stream_url):
+                    call_started = time.perf_counter()
+                    async with self._get_client().stream(
+                        "POST", endpoint.stream_url, params={"key": endpoint.api_key, "alt": "sse"}, json=payload
+                    ) as response:
+                        status_code = response.status_code
+                        outcome = str(status_code)
+                        if status_code != 200:
+                            body = (await response.aread()).decode(errors="replace")
+                            error = LLMServiceError(
+                                f"API Error: {status_code} - {body}",
+                                retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                            )
+                            if status_code not in RETRYABLE_STATUS_CODES:
+                                error.retry_after = None
+                                raise error
+                        else:
+                            usage = None
+                            answered = False
+                            finish_reason = None
+                            async for line in response.aiter_lines():
+                                # SSE frames look like "data: {...}"; skip keep-alives and blank separators
+                                if not line.startswith("data:"):
+                                    continue
+                                try:
+                                    chunk = json.loads(line[len("data:"):].strip())
+                                    if "error" in chunk:
+                                        # Gemini reports failures after the 200 as an error frame
+                                        raise LLMServiceError(f"API Error: {status_code} - {json.dumps(chunk['error'])[:1000]}")
+                                    # Gemini repeats usageMetadata with running totals; the last one is final
+                                    usage = chunk.get("usageMetadata") or usage
+                                    candidates = chunk.get("candidates") or []
+                                    if not candidates:
+                                        continue
+                                    parts = candidates[0].get("content", {}).get("parts") or []
+                                    text = "".join(part.get("text", "") for part in parts)
+                                    finish_reason = candidates[0].get("finishReason") or finish_reason
+                                except (ValueError, TypeError, AttributeError, KeyError) as e:
+                                    # A truncated or garbled frame; raised as an upstream failure so the
+                                    # client gets an error event and what streamed so far is kept as partial
+                                    raise LLMServiceError("Malformed stream chunk from Gemini") from e
+                                started = True
+                                answered = answered or bool(text)
+                                yield {
+                                    "text": text,
+                                    "finish_reason": finish_reason,
+                                    "model": endpoint.model,
+                                    "usage": _usage(usage),
                                 }
-                            }
+                            if not answered:
+                                # Like an unusable 200 in _generate: no candidates (a blocked prompt)
+                                # or no text in them, so there is nothing to record as an answer
+                                raise LLMServiceError(
+                                    f"API Error: {status_code} - no usable answer (stream ended without text, "
+                                    f"finish reason {finish_reason})"
+                                )
+                            if finish_reason is None:
+                                # Gemini's last chunk carries the finish reason; without it the answer was cut off
+                                raise LLMServiceError(f"API Error: {status_code} - stream ended before the answer was finished")
+                            # Only a stream read to the end with an answer counts as a success
+                            endpoint.breaker.record_success()
+                            _record_usage(endpoint.model, usage)
+                            return
+            except LLMServiceError as e:
+                logger.error(str(e))
+                raise
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                outcome = "timeout" if isinstance(e, httpx.TimeoutException) else "error"
+                if isinstance(e, httpx.TimeoutException):
+                    error = LLMServiceError(f"Timed out querying Gemini: {type(e).__name__}")
+                else:
+                    error = LLMServiceError(f"Error querying Gemini: {str(e)}")
+                if started:
+                    # Text has already gone out, so a retry would repeat it
+                    logger.error(str(error))
+                    raise error from e
+            except httpx.HTTPError as e:
+                outcome = "error"
+                error_message = f"Error querying Gemini: {str(e)}"
+                logger.error(error_message)
+                raise LLMServiceError(error_message) from e
+            finally:
+                UPSTREAM_DURATION.observe(
+                    time.perf_counter() - call_started, model=endpoint.model, call="stream", status=outcome
+                )
             
-            # If we get here, something went wrong with the response format
-            error_message = f"API Error: {response.status_code} - {response.text}"
-            logger.error(error_message)
-            return {
-                "answer": "",
-                "success": False,
-                "error": error_message
-            }
-            
-        except Exception as e:
-            error_message = f"Error querying Gemini: {str(e)}"
-            logger.error(error_message)
-            return {
-                "answer": "",
-                "success": False,
-                "error": error_message
-            }
+            await self._record_upstream_failure(endpoint, status_code, error.retry_after, attempt)
+        
+        logger.error(f"Giving up on {endpoint.model} stream after {settings.LLM_MAX_RETRIES + 1} attempts: {error}")
+        if error.retry_after is None:
+            error.retry_after = settings.LLM_BACKOFF_BASE
+        raise error
 
 llm_service = LLMService()
+
+registry.counter(
+    "qa_llm_requests_total", "Answers requested from the LLM service that missed the cache, by how they were served",
+    ["kind"],
+    collect=lambda: [({"kind": "upstream"}, llm_service.upstream_requests), ({"kind": "coalesced"}, llm_service.coalesced_requests)]
+)
+registry.counter(
+    "qa_llm_failovers_total", "Calls moved to the next model on the route", collect=lambda: [({}, llm_service.failovers)]
+)
+registry.counter(
+    "qa_llm_hedges_total", "Hedged calls, and how many the hedge won", ["result"],
+    collect=lambda: [({"result": "sent"}, llm_service.hedged_requests), ({"result": "won"}, llm_service.hedge_wins)]
+)
+registry.gauge(
+    "qa_llm_calls_in_flight", "Distinct upstream answers being generated (coalesced callers share one)",
+    collect=lambda: [({}, len(llm_service._inflight))]
+)
+registry.gauge(
+    "qa_llm_circuit_open", "1 while a model's circuit breaker is open or half-open", ["model"],
+    collect=lambda: [({"model": e.name}, int(e.breaker.state != "closed")) for e in model_registry.endpoints.values()]
+)
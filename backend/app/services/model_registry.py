@@ -0,0 +1,116 @@
+import logging
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.services.governor import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+class ModelEndpoint:
+    """One model on one Gemini-compatible endpoint, with its own breaker and latency window"""
+
+    def __init__(self, name: str, model: str, base_url: str, api_key: str):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key = api_key
+        self.generate_url = f"{base_url}/models/{model}:generateContent"
+        self.stream_url = f"{base_url}/models/{model}:streamGenerateContent"
+        self.cache_url = f"{base_url}/cachedContents"
+        self.rate_limit_key = f"upstream:{name}"
+        self.breaker = CircuitBreaker(settings.LLM_CIRCUIT_FAILURE_THRESHOLD, settings.LLM_CIRCUIT_RESET_SECONDS)
+        # Recent successful call latencies (seconds), for the hedging threshold
+        self.latencies: deque = deque(maxlen=500)
+
+    def observe(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        """Observed p95 latency, or None until enough calls have been seen"""
+        if len(self.latencies) < settings.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {
+            "model": self.model,
+            "base_url": self.base_url,
+            "circuit_breaker": self.breaker.stats(),
+            "latency_samples": len(self.latencies),
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+class ModelRegistry:
+    """
+    The configured model endpoints and the rules for picking one.
+
+    `route()` returns the endpoint chosen for a request followed by the
+    fallbacks to try, in order, if it fails. Rules may also name a prompt
+    template; `prompt_for()` returns it.
+    """
+
+    def __init__(
+        self,
+        endpoints: Dict[str, ModelEndpoint],
+        default: str,
+        routes: List[Dict[str, Any]],
+        fallbacks: List[str]
+    ):
+        if default not in endpoints:
+            raise ValueError(f"LLM_DEFAULT_MODEL {default!r} is not in LLM_MODELS")
+        for name in [rule["model"] for rule in routes if "model" in rule] + list(fallbacks):
+            if name not in endpoints:
+                raise ValueError(f"Unknown model {name!r} in LLM routing settings")
+        self.endpoints = endpoints
+        self.default = default
+        self.routes = routes
+        self.fallbacks = fallbacks
+
+    @property
+    def default_endpoint(self) -> ModelEndpoint:
+        return self.endpoints[self.default]
+
+    def _matches(self, rule: Dict[str, Any], question: str, tier: Optional[str]) -> bool:
+        if "tier" in rule and rule["tier"] != tier:
+            return False
+        if "min_question_chars" in rule and len(question) < rule["min_question_chars"]:
+            return False
+        if "max_question_chars" in rule and len(question) > rule["max_question_chars"]:
+            return False
+        return True
+
+    def route(self, question: str, tier: Optional[str] = None) -> List[ModelEndpoint]:
+        primary = next(
+            (rule["model"] for rule in self.routes if "model" in rule and self._matches(rule, question, tier)),
+            self.default
+        )
+        names = [primary] + [name for name in self.fallbacks if name != primary]
+        return [self.endpoints[name] for name in names]
+
+    def prompt_for(self, question: str, tier: Optional[str] = None) -> Optional[str]:
+        """The prompt template named by the first matching rule that sets one, if any"""
+        return next(
+            (rule["prompt"] for rule in self.routes if "prompt" in rule and self._matches(rule, question, tier)),
+            None
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: endpoint.stats() for name, endpoint in self.endpoints.items()}
+
+def _create_registry() -> ModelRegistry:
+    models = settings.LLM_MODELS or {"default": {"model": settings.GEMINI_MODEL}}
+    endpoints = {
+        name: ModelEndpoint(
+            name,
+            model=config["model"],
+            base_url=config.get("base_url", settings.GEMINI_BASE_URL),
+            api_key=config.get("api_key", settings.GEMINI_API_KEY),
+        )
+        for name, config in models.items()
+    }
+    return ModelRegistry(endpoints, settings.LLM_DEFAULT_MODEL, settings.LLM_ROUTES, settings.LLM_FALLBACK_MODELS)
+
+model_registry = _create_registry()
@@ -0,0 +1,118 @@
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+
+DEFAULT_SYSTEM_INSTRUCTION = """You are an expert AI assistant providing accurate, well-structured answers.
+
+When responding to user queries:
+1. Research the topic thoroughly using your knowledge
+2. Organize information into clear sections with bullet points when appropriate
+3. Be concise yet comprehensive
+4. Format your response to be easy to read and understand
+5. Include all necessary details relevant to the query
+6. If the query is travel-related, include visa requirements, passport info, and any advisories
+
+Respond in markdown format for better readability."""
+
+DEFAULT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "topK": 40,
+    "topP": 0.95,
+    "maxOutputTokens": 1024,
+}
+
+class PromptTemplate:
+    """
+    A named system instruction and user message layout, compiled once.
+
+    The instruction goes to Gemini as `systemInstruction` rather than being
+    pasted in front of every question. It and the generationConfig are built
+    here once and shared by every payload. Only the user turn is formatted
+    per call.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        system_instruction: str,
+        user_template: str = "{question}",
+        context_template: str = "Context: {context}\n\nQuestion: {question}",
+        generation_config: Optional[Dict[str, Any]] = None,
+        cache_context: bool = False
+    ):
+        self.name = name
+        self.system_instruction = system_instruction.strip()
+        self.user_template = user_template
+        self.context_template = context_template
+        self.generation_config = {**DEFAULT_GENERATION_CONFIG, **(generation_config or {})}
+        # Whether to upload the instruction as a Gemini cachedContent and refer to it by name
+        self.cache_context = cache_context
+        self.system_content = {"parts": [{"text": self.system_instruction}]}
+        # Changes whenever what the model is told changes, so cached answers from another prompt aren't reused
+        raw = json.dumps([self.system_instruction, user_template, context_template], separators=(",", ":"))
+        self.fingerprint = hashlib.sha256(raw.encode()).hexdigest()[:16]
+        # Fail at startup, not on the first request, if a template has an unknown placeholder
+        try:
+            user_template.format(question="")
+            context_template.format(question="", context="")
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"Invalid template in prompt {name!r}: {e}") from e
+
+    def user_text(self, question: str, context: Optional[str] = None) -> str:
+        if context:
+            return self.context_template.format(question=question, context=context)
+        return self.user_template.format(question=question)
+
+    def build_payload(
+        self,
+        question: str,
+        context: Optional[str] = None,
+        history: Optional[List[Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        """The generateContent payload for a question, after any prior conversation turns"""
+        return {
+            "systemInstruction": self.system_content,
+            "contents": [
+                *(history or []),
+                {"role": "user", "parts": [{"text": self.user_text(question, context)}]}
+            ],
+            "generationConfig": self.generation_config,
+        }
+
+class PromptRegistry:
+    """The configured prompt templates, by name"""
+
+    def __init__(self, templates: Dict[str, PromptTemplate], default: str):
+        if default not in templates:
+            raise ValueError(f"LLM_PROMPT_TEMPLATE {default!r} is not in LLM_PROMPT_TEMPLATES")
+        self.templates = templates
+        self.default = default
+
+    def get(self, name: Optional[str] = None) -> PromptTemplate:
+        return self.templates[name or self.default]
+
+def _load_template(name: str, config: Dict[str, Any]) -> PromptTemplate:
+    instruction = config.get("system_instruction")
+    if "system_instruction_file" in config:
+        with open(config["system_instruction_file"], encoding="utf-8") as f:
+            instruction = f.read()
+    return PromptTemplate(
+        name,
+        system_instruction=instruction if instruction is not None else DEFAULT_SYSTEM_INSTRUCTION,
+        user_template=config.get("user_template", "{question}"),
+        context_template=config.get("context_template", "Context: {context}\n\nQuestion: {question}"),
+        generation_config=config.get("generation_config"),
+        cache_context=config.get("cache_context", False),
+    )
+
+def _create_registry() -> PromptRegistry:
+    configs = {"default": {}, **settings.LLM_PROMPT_TEMPLATES}
+    templates = {name: _load_template(name, config) for name, config in configs.items()}
+    for rule in settings.LLM_ROUTES:
+        if "prompt" in rule and rule["prompt"] not in templates:
+            raise ValueError(f"Unknown prompt {rule['prompt']!r} in LLM_ROUTES")
+    return PromptRegistry(templates, settings.LLM_PROMPT_TEMPLATE)
+
+prompt_registry = _create_registry()
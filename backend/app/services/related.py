@@ -0,0 +1,664 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.db.database import AsyncSessionLocal, QueryHistory, QueryHistoryArchive, SessionLocal
+from app.services.embeddings import create_embedder
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are kept from appending at once
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+RELATED_LOOKUPS = registry.counter(
+    "qa_related_lookups_total", "Related-question lookups by kind (related, answer) and result", ["kind", "result"]
+)
+
+# Per-row files of a generation, appended in this order; a row is complete once it is in the last one
+_ID_DTYPE = np.dtype("S36")
+_COLUMNS = (("vectors", None), ("ids", _ID_DTYPE), ("owners", np.dtype(np.int64)), ("lists", np.dtype(np.int32)))
+_SCAN_CHUNK = 65536
+# Up to this many rows, a search limited to one user compares every row of theirs
+_OWNER_SCAN_ROWS = 8192
+# k-means is trained on a sample of this many rows per list
+_TRAIN_SAMPLE_PER_LIST = 64
+
+def owner_key(user_id: Optional[str]) -> int:
+    """A 64-bit key for a user id, stored per row so searches can be limited to one user (0 for no user)"""
+    if not user_id:
+        return 0
+    return int.from_bytes(hashlib.blake2b(user_id.encode(), digest_size=8).digest(), "little", signed=True) or 1
+
+class _FileLock:
+    """An exclusive lock on a file, shared by every process using the index"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if fcntl is not None:
+            self._file = open(self.path, "a+")
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                self._file.close()
+                self._file = None
+                self._thread_lock.release()
+                return False
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()  # closing drops the flock
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class _Column:
+    """An in-memory copy of a small per-row file, grown in place as rows are appended"""
+
+    def __init__(self, dtype):
+        self._data = np.empty(1024, dtype)
+        self.size = 0
+
+    def extend(self, values: np.ndarray):
+        needed = self.size + len(values)
+        if needed > len(self._data):
+            grown = np.empty(max(needed, 2 * len(self._data)), self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:needed] = values
+        self.size = needed
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[:self.size]
+
+class _Snapshot:
+    """What one search sees: the rows of a generation at the time it started"""
+
+    def __init__(self, vectors, ids, owners, tail_lists, rows, sorted_rows, centroids, offsets):
+        self.vectors = vectors
+        self.ids = ids
+        self.owners = owners
+        self.tail_lists = tail_lists
+        self.rows = rows
+        self.sorted_rows = sorted_rows
+        self.centroids = centroids
+        self.offsets = offsets
+
+class _Generation:
+    """
+    One build of the index, in a directory of its own.
+
+    The first `sorted_rows` rows are grouped by k-means list (so a list is
+    one contiguous slice of `vectors.bin`, located by `offsets.npy`); rows
+    added since are appended after them with the list they were assigned
+    to, or -1 before the generation has lists. Vectors and ids are
+    memory-mapped, so every worker shares one copy in the page cache;
+    owners and tail list numbers are small enough to keep in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        self.fingerprint = self.meta["fingerprint"]
+        self.sorted_rows = self.meta["sorted_rows"]
+        self.complete = self.meta["complete"]
+        self.centroids = self.offsets = None
+        if self.meta["lists"]:
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.rows = 0
+        self._vectors = np.empty((0, self.dim), np.float32)
+        self._ids = np.empty(0, _ID_DTYPE)
+        self._owners = _Column(np.int64)
+        self._tail_lists = _Column(np.int32)
+
+    @staticmethod
+    def create(path: str, fingerprint: str, dim: int, complete: bool,
+               sorted_rows: int = 0, centroids: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None):
+        """Write an empty generation directory (rows are appended with append_rows)"""
+        os.makedirs(path)
+        if centroids is not None:
+            np.save(os.path.join(path, "centroids.npy"), centroids)
+            np.save(os.path.join(path, "offsets.npy"), offsets)
+        for name, _ in _COLUMNS:
+            open(os.path.join(path, f"{name}.bin"), "wb").close()
+        _write_meta(path, {
+            "fingerprint": fingerprint,
+            "dim": dim,
+            "sorted_rows": sorted_rows,
+            "lists": 0 if centroids is None else len(centroids),
+            "complete": complete,
+            "built_at": time.time(),
+        })
+
+    def _row_bytes(self, name: str) -> int:
+        return self.dim * 4 if name == "vectors" else dict(_COLUMNS)[name].itemsize
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.bin")
+
+    def stored_rows(self) -> int:
+        return min(os.path.getsize(self.file(name)) // self._row_bytes(name) for name, _ in _COLUMNS)
+
+    def repair(self) -> int:
+        """Cut off a partly appended row left by a crashed writer (call with the index lock held)"""
+        rows = self.stored_rows()
+        for name, _ in _COLUMNS:
+            size = rows * self._row_bytes(name)
+            if os.path.getsize(self.file(name)) != size:
+                os.truncate(self.file(name), size)
+        return rows
+
+    def refresh(self):
+        """Map rows that other processes (or this one) have appended since the last refresh"""
+        rows = self.stored_rows()
+        if rows <= self.rows:
+            return
+        owners = np.fromfile(self.file("owners"), dtype=np.int64, count=rows - self.rows, offset=self.rows * 8)
+        self._owners.extend(owners)
+        tail_start = max(self.rows, self.sorted_rows)
+        if rows > tail_start:
+            self._tail_lists.extend(
+                np.fromfile(self.file("lists"), dtype=np.int32, count=rows - tail_start, offset=tail_start * 4)
+            )
+        self._vectors = np.memmap(self.file("vectors"), dtype=np.float32, mode="r", shape=(rows, self.dim))
+        self._ids = np.memmap(self.file("ids"), dtype=_ID_DTYPE, mode="r", shape=(rows,))
+        self.rows = rows
+
+    def snapshot(self) -> _Snapshot:
+        return _Snapshot(
+            self._vectors, self._ids, self._owners.values, self._tail_lists.values,
+            self.rows, self.sorted_rows, self.centroids, self.offsets,
+        )
+
+    def assign(self, vectors: np.ndarray) -> np.ndarray:
+        """The list each vector belongs in (-1 while the generation has no lists)"""
+        if self.centroids is None:
+            return np.full(len(vectors), -1, np.int32)
+        return _nearest(vectors, self.centroids)
+
+    def append_rows(self, vectors: np.ndarray, ids: np.ndarray, owners: np.ndarray, lists: np.ndarray):
+        """Append rows to the files (call with the index lock held, after repair())"""
+        for name, values in (("vectors", vectors), ("ids", ids), ("owners", owners), ("lists", lists)):
+            with open(self.file(name), "ab") as f:
+                f.write(np.ascontiguousarray(values).tobytes())
+
+def _write_meta(path: str, meta: Dict[str, Any]):
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the most similar centroid for each vector"""
+    assignment = np.empty(len(vectors), np.int32)
+    for start in range(0, len(vectors), _SCAN_CHUNK // 4):
+        chunk = np.asarray(vectors[start:start + _SCAN_CHUNK // 4])
+        assignment[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignment
+
+def _kmeans(sample: np.ndarray, lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Spherical k-means: unit-length centroids that maximize cosine similarity to their members"""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(sample, centroids)
+        counts = np.bincount(assignment, minlength=lists)
+        filled = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(sample[np.argsort(assignment, kind="stable")], starts, axis=0)
+        # Lists nobody joined restart from random rows
+        sums[~filled] = sample[rng.choice(len(sample), int((~filled).sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+def _top(scores: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The k best (scores, rows), best first"""
+    if len(scores) > k:
+        best = np.argpartition(scores, -k)[-k:]
+        scores, rows = scores[best], rows[best]
+    order = np.argsort(-scores, kind="stable")
+    return scores[order], rows[order]
+
+class VectorIndex:
+    """
+    Embeddings of every history question, for finding similar past questions.
+
+    The index lives in memory-mapped files under RELATED_INDEX_PATH that all
+    workers share: each worker appends the rows it inserts (under a file
+    lock) and maps what the others appended on its next search. Searches
+    are exact until there are RELATED_INDEX_MIN_TRAIN_ROWS rows; after that
+    the rows are grouped into k-means lists and a search only scans the
+    RELATED_INDEX_PROBES lists closest to the question (an IVF index).
+    Once as many rows have been appended as a quarter of those grouped,
+    one worker regroups everything in the background into a new generation
+    directory and switches `CURRENT` over to it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ready = False
+        self.rebuilding = False
+        self._embedder = None
+        self._embedder_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._generation: Optional[_Generation] = None
+        self._lock = _FileLock(os.path.join(path, "lock"))
+        self._build_lock = _FileLock(os.path.join(path, "build.lock"))
+
+    @property
+    def embedder(self):
+        with self._embedder_lock:
+            if self._embedder is None:
+                self._embedder = create_embedder()
+            return self._embedder
+
+    def _current(self) -> Optional[_Generation]:
+        """The generation CURRENT points to, with rows appended so far mapped"""
+        for attempt in range(3):
+            try:
+                with open(os.path.join(self.path, "CURRENT"), encoding="utf-8") as f:
+                    name = f.read().strip()
+            except FileNotFoundError:
+                return None
+            try:
+                with self._state_lock:
+                    if self._generation is None or self._generation.name != name:
+                        self._generation = _Generation(os.path.join(self.path, name))
+                    self._generation.refresh()
+                    return self._generation
+            except FileNotFoundError:
+                # Replaced and deleted by a rebuild between reading CURRENT and opening it; read it again
+                if attempt == 2:
+                    raise
+
+    def _switch_to(self, generation_path: str):
+        """Point CURRENT at a generation (call with the index lock held)"""
+        tmp = os.path.join(self.path, "CURRENT.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(os.path.basename(generation_path))
+        os.replace(tmp, os.path.join(self.path, "CURRENT"))
+
+    def _new_generation_path(self) -> str:
+        return os.path.join(self.path, f"gen-{int(time.time())}-{uuid.uuid4().hex[:8]}")
+
+    # -- opening ---------------------------------------------------------
+
+    def start(self):
+        """Open the index in a background thread, filling it from the database if it is new or stale"""
+        if settings.RELATED_INDEX_ENABLED:
+            threading.Thread(target=self._open, name="related-index", daemon=True).start()
+
+    def _open(self):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            embedder = self.embedder
+            with self._lock:
+                generation = self._current()
+                if generation is None or generation.fingerprint != embedder.fingerprint:
+                    # Nothing usable yet: start an empty generation so new rows have somewhere to go
+                    path = self._new_generation_path()
+                    _Generation.create(path, embedder.fingerprint, embedder.dim, complete=False)
+                    self._switch_to(path)
+                    generation = self._current()
+            self.ready = True
+            if not generation.complete:
+                self.rebuild(from_database=True)
+        except Exception:
+            logger.exception("Couldn't open the related-questions index")
+
+    # -- writing ---------------------------------------------------------
+
+    def add(self, rows: Sequence[Tuple[str, Optional[str], str]]):
+        """Index (id, user_id, question) rows; blocking, see add_rows()"""
+        if not self.ready or not rows:
+            return
+        vectors = self.embedder.embed([question for _, _, question in rows])
+        ids = np.array([row_id for row_id, _, _ in rows], dtype=_ID_DTYPE)
+        owners = np.array([owner_key(user_id) for _, user_id, _ in rows], dtype=np.int64)
+        with self._lock:
+            generation = self._current()
+            if generation is None or generation.fingerprint != self.embedder.fingerprint:
+                return  # another embedder's index; the worker that opened it will fill it
+            generation.repair()
+            generation.append_rows(vectors, ids, owners, generation.assign(vectors))
+            generation.refresh()
+        appended = generation.rows - generation.sorted_rows
+        if (
+            generation.complete and not self.rebuilding
+            and appended >= max(settings.RELATED_INDEX_MIN_TRAIN_ROWS, generation.sorted_rows // 4)
+        ):
+            self.rebuild_in_background()
+
+    async def add_rows(self, rows: List[Dict[str, Any]]):
+        """Index newly inserted history rows; never raises (a failure only leaves them out of the index)"""
+        if not settings.RELATED_INDEX_ENABLED or not self.ready or not rows:
+            return
+        try:
+            await asyncio.to_thread(self.add, [(row["id"], row["user_id"], row["question"]) for row in rows])
+        except Exception as e:
+            logger.error(f"Failed to add {len(rows)} questions to the related-questions index: {str(e)}")
+
+    # -- rebuilding ------------------------------------------------------
+
+    def rebuild(self, from_database: bool = False) -> bool:
+        """
+        Regroup the index into k-means lists in a new generation; blocking.
+
+        With from_database (or when the current generation was never
+        filled) every question is embedded again from QueryHistory, which
+        also drops deleted rows. Returns False if another worker is already
+        rebuilding.
+        """
+        if not self._build_lock.acquire(blocking=False):
+            return False
+        self.rebuilding = True
+        started = time.perf_counter()
+        try:
+            embedder = self.embedder
+            with self._lock:
+                live = self._current()
+                self._remove_other_generations()
+                snapshot_name, snapshot_rows = live.name, live.rows
+            if from_database or not live.complete:
+                source = self._load_from_database(embedder)
+            else:
+                source = live
+            built = self._build_lists(source, embedder)
+            with self._lock:
+                # Carry over rows appended while we were building (ones read from the database
+                # as well may end up in twice, which searches tolerate)
+                latest = self._current()
+                start = snapshot_rows if latest.name == snapshot_name else 0
+                if latest.rows > start:
+                    self._copy_rows(latest, start, latest.rows, built)
+                self._switch_to(built.path)
+                self._current()
+                self._remove_other_generations()
+            logger.info(
+                f"Rebuilt the related-questions index: {built.meta['sorted_rows']} rows in "
+                f"{built.meta['lists']} lists in {time.perf_counter() - started:.1f}s"
+            )
+            return True
+        except Exception:
+            logger.exception("Failed to rebuild the related-questions index")
+            return False
+        finally:
+            self.rebuilding = False
+            self._build_lock.release()
+
+    def rebuild_in_background(self, from_database: bool = False):
+        threading.Thread(
+            target=self.rebuild, kwargs={"from_database": from_database}, name="related-index-rebuild", daemon=True
+        ).start()
+
+    def _remove_other_generations(self):
+        """Delete generations other than the current one (call with both locks held)"""
+        current = self._generation.name if self._generation is not None else None
+        for name in os.listdir(self.path):
+            if name.startswith("gen-") and name != current:
+                # Other workers may still have the old files mapped; that keeps them readable until they move on
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def _load_from_database(self, embedder, batch_size: int = 5000) -> _Generation:
+        """Embed every history question, archived ones first, into a new generation without lists"""
+        path = self._new_generation_path()
+        _Generation.create(path, embedder.fingerprint, embedder.dim, complete=False)
+        generation = _Generation(path)
+        queries = [
+            select(model.id, model.user_id, model.question).order_by(model.timestamp)
+            for model in (QueryHistoryArchive, QueryHistory)
+        ]
+        with SessionLocal() as db:
+            batches = (
+                batch for query in queries
+                for batch in db.execute(query.execution_options(yield_per=batch_size)).partitions()
+            )
+            for batch in batches:
+                vectors = embedder.embed([row.question for row in batch])
+                generation.append_rows(
+                    vectors,
+                    np.array([row.id for row in batch], dtype=_ID_DTYPE),
+                    np.array([owner_key(row.user_id) for row in batch], dtype=np.int64),
+                    np.full(len(batch), -1, np.int32),
+                )
+        generation.refresh()
+        return generation
+
+    def _build_lists(self, source: _Generation, embedder) -> _Generation:
+        """Copy the source's rows into a new complete generation, grouped by list once there are enough"""
+        rows = source.rows
+        path = self._new_generation_path()
+        snapshot = source.snapshot()
+        if rows < settings.RELATED_INDEX_MIN_TRAIN_ROWS:
+            _Generation.create(path, embedder.fingerprint, embedder.dim, complete=True)
+            built = _Generation(path)
+            self._copy_rows(source, 0, rows, built)
+            return built
+
+        lists = settings.RELATED_INDEX_LISTS or int(rows ** 0.5)
+        lists = max(1, min(lists, rows))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(rows, min(rows, lists * _TRAIN_SAMPLE_PER_LIST), replace=False))
+        centroids = _kmeans(np.asarray(snapshot.vectors[sample_rows]), lists)
+        assignment = _nearest(snapshot.vectors[:rows], centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=lists))]).astype(np.int64)
+
+        _Generation.create(
+            path, embedder.fingerprint, embedder.dim, complete=True,
+            sorted_rows=rows, centroids=centroids, offsets=offsets,
+        )
+        built = _Generation(path)
+        for start in range(0, rows, _SCAN_CHUNK):
+            # Gather in file order for the page cache's sake, then put the chunk back in list order
+            wanted = order[start:start + _SCAN_CHUNK]
+            position = np.argsort(wanted)
+            chunk = wanted[position]
+            back = np.empty_like(position)
+            back[position] = np.arange(len(position))
+            built.append_rows(
+                np.asarray(snapshot.vectors[chunk])[back],
+                np.asarray(snapshot.ids[chunk])[back],
+                snapshot.owners[chunk][back],
+                assignment[chunk][back],
+            )
+        built.refresh()
+        return built
+
+    @staticmethod
+    def _copy_rows(source: _Generation, start: int, end: int, target: _Generation):
+        """Append source rows [start, end) to the target, assigned to the target's lists"""
+        snapshot = source.snapshot()
+        for chunk_start in range(start, end, _SCAN_CHUNK):
+            chunk = slice(chunk_start, min(end, chunk_start + _SCAN_CHUNK))
+            vectors = np.asarray(snapshot.vectors[chunk])
+            target.append_rows(vectors, np.asarray(snapshot.ids[chunk]), snapshot.owners[chunk], target.assign(vectors))
+        target.refresh()
+
+    # -- searching -------------------------------------------------------
+
+    def search(self, question: str, k: int = 10, user_id: Optional[str] = None,
+               probes: Optional[int] = None) -> List[Tuple[str, float]]:
+        """The ids of up to k indexed questions most similar to this one, with their cosine similarity"""
+        if not self.ready:
+            return []
+        return self.search_vector(self.embedder.embed([question])[0], k, user_id, probes)
+
+    def search_vector(self, vector: np.ndarray, k: int = 10, user_id: Optional[str] = None,
+                      probes: Optional[int] = None) -> List[Tuple[str, float]]:
+        generation = self._current()
+        if generation is None:
+            return []
+        snapshot = generation.snapshot()
+        if snapshot.rows == 0:
+            return []
+        # Rebuilds can index a row twice, so ask for a few extra and drop repeats
+        wanted = k + 8
+
+        probes = probes or settings.RELATED_INDEX_PROBES
+        if user_id is not None:
+            owner = owner_key(user_id)
+            rows = np.flatnonzero(snapshot.owners == owner)
+            if snapshot.centroids is None or len(rows) <= _OWNER_SCAN_ROWS:
+                # Most users' rows are few enough to compare them all
+                scores = np.asarray(snapshot.vectors[rows]) @ vector
+                scores, rows = _top(scores, rows, wanted)
+            else:
+                # Gathering a heavy user's rows from all over the file costs more than scanning the probed lists
+                scores, rows = self._probe(snapshot, vector, wanted, probes, owner)
+        elif snapshot.centroids is None:
+            scores, rows = self._scan(snapshot, vector, wanted)
+        else:
+            scores, rows = self._probe(snapshot, vector, wanted, probes)
+
+        results, seen = [], set()
+        for score, row in zip(scores, rows):
+            row_id = snapshot.ids[row].decode()
+            if row_id not in seen:
+                seen.add(row_id)
+                results.append((row_id, float(score)))
+                if len(results) == k:
+                    break
+        return results
+
+    @staticmethod
+    def _scan(snapshot: _Snapshot, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        best_scores, best_rows = [], []
+        for start in range(0, snapshot.rows, _SCAN_CHUNK):
+            scores = np.asarray(snapshot.vectors[start:start + _SCAN_CHUNK]) @ vector
+            scores, rows = _top(scores, np.arange(start, start + len(scores)), k)
+            best_scores.append(scores)
+            best_rows.append(rows)
+        return _top(np.concatenate(best_scores), np.concatenate(best_rows), k)
+
+    @staticmethod
+    def _probe(snapshot: _Snapshot, vector: np.ndarray, k: int, probes: int,
+               owner: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        lists = len(snapshot.centroids)
+        probed = np.argpartition(snapshot.centroids @ vector, -min(probes, lists))[-min(probes, lists):]
+        score_parts, row_parts = [], []
+        for list_number in probed:
+            start, end = snapshot.offsets[list_number], snapshot.offsets[list_number + 1]
+            rows = np.arange(start, end)
+            if owner is not None:
+                rows = rows[snapshot.owners[start:end] == owner]
+            if len(rows):
+                vectors = snapshot.vectors[start:end] if owner is None else snapshot.vectors[rows]
+                score_parts.append(np.asarray(vectors) @ vector)
+                row_parts.append(rows)
+        # Rows appended since the lists were built: those in a probed list, plus any with no list
+        wanted = np.zeros(lists + 1, bool)
+        wanted[probed] = True
+        wanted[-1] = True
+        tail = snapshot.sorted_rows + np.flatnonzero(wanted[snapshot.tail_lists])
+        if owner is not None:
+            tail = tail[snapshot.owners[tail] == owner]
+        if len(tail):
+            score_parts.append(np.asarray(snapshot.vectors[tail]) @ vector)
+            row_parts.append(tail)
+        if not score_parts:
+            return np.empty(0, np.float32), np.empty(0, np.int64)
+        return _top(np.concatenate(score_parts), np.concatenate(row_parts), k)
+
+    async def related(self, question: str, k: int = 10, user_id: Optional[str] = None) -> List[Tuple[str, float]]:
+        """search() in a thread; [] until the index has been opened"""
+        if not settings.RELATED_INDEX_ENABLED or not self.ready:
+            return []
+        return await asyncio.to_thread(self.search, question, k, user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        generation = self._current() if self.ready else None
+        if generation is None:
+            return {"enabled": settings.RELATED_INDEX_ENABLED, "ready": False, "rebuilding": self.rebuilding}
+        return {
+            "enabled": settings.RELATED_INDEX_ENABLED,
+            "ready": True,
+            "rebuilding": self.rebuilding,
+            "generation": generation.name,
+            "embedder": generation.fingerprint,
+            "complete": generation.complete,
+            "rows": generation.rows,
+            "rows_in_lists": generation.sorted_rows,
+            "lists": 0 if generation.centroids is None else len(generation.centroids),
+            "probes": settings.RELATED_INDEX_PROBES,
+        }
+
+related_index = VectorIndex(settings.RELATED_INDEX_PATH)
+
+registry.gauge(
+    "qa_related_index_rows", "Questions in the related-questions index",
+    collect=lambda: [({}, related_index._generation.rows if related_index._generation is not None else 0)]
+)
+
+async def find_reusable_answer(question: str, user_id: str) -> Optional[Dict[str, Any]]:
+    """
+    A past answer to a question at least RELATED_ANSWER_THRESHOLD similar to
+    this one, as {"history_id", "question", "answer", "similarity"}, or None.
+    Only complete answers are reused; RELATED_ANSWER_SCOPE decides whether
+    other users' answers count.
+    """
+    threshold = settings.RELATED_ANSWER_THRESHOLD
+    if threshold <= 0:
+        return None
+    owner = user_id if settings.RELATED_ANSWER_SCOPE == "user" else None
+    try:
+        matches = [(row_id, score) for row_id, score in await related_index.related(question, 5, owner) if score >= threshold]
+        if not matches:
+            RELATED_LOOKUPS.inc(kind="answer", result="miss")
+            return None
+        rows = {}
+        async with AsyncSessionLocal() as db:
+            # Matches are mostly recent, so the archive is only read for ids qa_llm doesn't have
+            for model in (QueryHistory, QueryHistoryArchive):
+                missing = [row_id for row_id, _ in matches if row_id not in rows]
+                if not missing:
+                    break
+                rows.update((row.id, row) for row in await db.execute(
+                    select(model.id, model.question, model.answer)
+                    # Rows from before is_partial existed have it NULL; they are complete answers
+                    .where(model.id.in_(missing), model.is_partial.isnot(True))
+                ))
+    except Exception as e:
+        # Not finding a past answer just means asking the LLM
+        logger.error(f"Related-answer lookup failed: {str(e)}")
+        return None
+    for row_id, score in matches:
+        if row_id in rows:
+            RELATED_LOOKUPS.inc(kind="answer", result="hit")
+            row = rows[row_id]
+            return {"history_id": row.id, "question": row.question, "answer": row.answer, "similarity": score}
+    RELATED_LOOKUPS.inc(kind="answer", result="miss")
+    return None
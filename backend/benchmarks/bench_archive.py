@@ -0,0 +1,184 @@
+"""
+History compaction: storage per row and /history latency before and after archiving.
+
+    python -m benchmarks.bench_archive --rows 50000 --users 10 --answer-chars 2000
+
+Seeds --rows history items for --users users, with timestamps spread over
+the last --days days, and measures:
+
+- bytes per row on disk (after VACUUM), in total and per table with its
+  indexes and the full-text index, when every row is in qa_llm
+- p50/p95 latency of /history for one user: the first page (full answers
+  and previews) and a deep page, by cursor and by legacy offset
+- how fast the compaction job moves rows older than --archive-after-days
+  into the compressed archive, with each codec available
+
+then the same storage and latency numbers once the rows are archived.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.bench_payload import answer_text
+from benchmarks.common import ServerThread
+
+PASSWORD = "benchmark-password"
+
+def percentile_ms(values, p: float) -> float:
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000, 2)
+
+def storage(path: str, rows: int) -> dict:
+    """Bytes per row for the whole file and for each table, its indexes counted with it"""
+    connection = sqlite3.connect(path)
+    connection.execute("VACUUM")
+    # VACUUM may renumber qa_llm's rowids, which the full-text index is keyed by
+    connection.execute("INSERT INTO qa_llm_fts(qa_llm_fts) VALUES ('rebuild')")
+    connection.commit()
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    pages = connection.execute("PRAGMA page_count").fetchone()[0] - connection.execute("PRAGMA freelist_count").fetchone()[0]
+    total = pages * page_size
+    result = {"file_mb": round(total / 2**20, 1), "bytes_per_row": round(total / rows)}
+    try:
+        sizes = dict(connection.execute(
+            "SELECT coalesce(m.tbl_name, s.name), sum(s.pgsize) FROM dbstat s "
+            "LEFT JOIN sqlite_master m ON m.name = s.name GROUP BY 1"
+        ).fetchall())
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat table
+        sizes = {}
+    search = sum(size for name, size in sizes.items() if name.startswith("qa_llm_fts"))
+    for name, size in (("qa_llm", sizes.get("qa_llm")), ("qa_llm_fts", search), ("qa_llm_archive", sizes.get("qa_llm_archive"))):
+        if size:
+            result[f"{name}_mb"] = round(size / 2**20, 1)
+    connection.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--answer-chars", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--archive-after-days", type=int, default=30)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="qa-bench-")
+    database = os.path.join(workdir, "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{database}"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["HISTORY_SPOOL_PATH"] = os.path.join(workdir, "history_spool.jsonl")
+    os.environ["RELATED_INDEX_PATH"] = os.path.join(workdir, "related_index")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from app.core.config import settings
+    from app.db import compression
+    from app.db.database import QueryHistory, QueryHistoryArchive, SessionLocal, User
+    from app.services.archive import HistoryArchiver
+    from app.services.history import encode_cursor
+    from main import app
+
+    rng = random.Random(args.seed)
+    results = {"rows": args.rows, "users": args.users}
+
+    def report(key: str, row: dict):
+        results[key] = row
+        print(json.dumps({"measure": key, **row}))
+
+    with ServerThread(app) as api, httpx.Client(base_url=f"{api.url}/api/v1", timeout=600) as client:
+        accounts = []
+        for _ in range(args.users):
+            name = f"bench_{uuid.uuid4().hex[:10]}"
+            client.post("/auth/register", json={"email": f"{name}@example.com", "username": name, "password": PASSWORD}).raise_for_status()
+            accounts.append(name)
+        token = client.post("/auth/login", data={"username": accounts[0], "password": PASSWORD}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        now = datetime.datetime.now()
+        spread = args.days * 86400 / args.rows
+        db = SessionLocal()
+        user_ids = [db.query(User.id).filter(User.username == name).scalar() for name in accounts]
+        for start in range(0, args.rows, 5000):
+            db.bulk_insert_mappings(QueryHistory, [
+                {"id": str(uuid.uuid4()), "question": f"What do I need for a visa to country {i}?",
+                 "answer": answer_text(rng, args.answer_chars), "timestamp": now - datetime.timedelta(seconds=i * spread),
+                 "user_id": user_ids[i % args.users]}
+                for i in range(start, min(args.rows, start + 5000))
+            ])
+        db.commit()
+        # A row 90% of the way down the user's history, for the deep-page requests
+        user_rows = db.query(QueryHistory).filter(QueryHistory.user_id == user_ids[0]).count()
+        deep = db.query(QueryHistory).filter(QueryHistory.user_id == user_ids[0]).order_by(
+            QueryHistory.timestamp.desc(), QueryHistory.id.desc()
+        ).offset(int(user_rows * 0.9)).first()
+        deep_cursor, deep_skip = encode_cursor(deep), int(user_rows * 0.9) + 1
+        db.close()
+
+        def latency(label: str) -> dict:
+            measured = {}
+            for name, params in (
+                ("first_page", {"limit": 20}),
+                ("first_page_preview", {"limit": 20, "view": "preview"}),
+                ("deep_page_cursor", {"limit": 20, "cursor": deep_cursor}),
+                ("deep_page_offset", {"limit": 20, "skip": deep_skip}),
+            ):
+                timings = []
+                for _ in range(args.requests):
+                    started = time.perf_counter()
+                    response = client.get("/history", params=params, headers=headers)
+                    timings.append(time.perf_counter() - started)
+                    response.raise_for_status()
+                measured[name] = {"p50_ms": percentile_ms(timings, 50), "p95_ms": percentile_ms(timings, 95)}
+            report(f"history_{label}", measured)
+            return response.json()
+
+        report("storage_before", storage(database, args.rows))
+        before = latency("before")
+
+        codecs = ["zlib"] + (["zstd"] if compression.zstandard is not None else [])
+        for codec in codecs:
+            # Every codec archives the same rows from the same starting point
+            settings.HISTORY_ARCHIVE_CODEC = codec
+            archiver = HistoryArchiver(args.archive_after_days, 0, 3600, settings.HISTORY_ARCHIVE_BATCH_SIZE)
+            if codec != codecs[0]:
+                db = SessionLocal()
+                restored = [
+                    {"id": row.id, "question": row.question, "answer": row.answer, "timestamp": row.timestamp,
+                     "user_id": row.user_id, "is_partial": row.is_partial}
+                    for row in db.query(QueryHistoryArchive).all()
+                ]
+                db.query(QueryHistoryArchive).delete()
+                db.bulk_insert_mappings(QueryHistory, restored)
+                db.commit()
+                db.close()
+            run = archiver.run_once()
+            report(f"compaction_{codec}", {
+                "archived": run["archived"], "seconds": run["seconds"],
+                "rows_per_s": round(run["archived"] / max(run["seconds"], 1e-9)),
+            })
+            report(f"storage_after_{codec}", storage(database, args.rows))
+
+        after = latency("after")
+        # Archived rows read back exactly as they were written
+        assert after["items"] == before["items"], "deep page changed after archiving"
+
+    if args.output:
+        from benchmarks.common import save_results
+        save_results(args.output, "bench_archive", vars(args), results)
+    return results
+
+if __name__ == "__main__":
+    main()
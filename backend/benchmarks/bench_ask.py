@@ -0,0 +1,109 @@
+"""
+Concurrent /ask throughput against a local fake Gemini server.
+
+    python -m benchmarks.bench_ask --latency-ms 500 --concurrency 1 8 32 64
+
+With a blocking upstream client throughput stays flat at roughly
+1 / latency regardless of concurrency; with the pooled async client it
+scales with concurrency until the pool/per-host limits are reached.
+
+Add --fail-rate to have the fake server answer that fraction of calls with
+a 429 (and --retry-after), to exercise retries, backoff and the circuit
+breaker; each level then also reports how many 429s were injected.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import ServerThread, free_port, summarize
+from benchmarks.fake_gemini import create_app as create_fake_gemini
+
+async def register_and_login(client: httpx.AsyncClient) -> str:
+    name = f"bench_{uuid.uuid4().hex[:8]}"
+    password = "benchmark-password"
+    response = await client.post(
+        "/api/v1/auth/register",
+        json={"email": f"{name}@example.com", "username": name, "password": password},
+    )
+    response.raise_for_status()
+    response = await client.post("/api/v1/auth/login", data={"username": name, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+async def run_level(client: httpx.AsyncClient, token: str, concurrency: int, total: int):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal errors
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            response = await client.post(
+                "/api/v1/ask",
+                json={"question": f"Benchmark question {i}?"},
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = summarize(latencies, time.perf_counter() - started)
+    result.update({"concurrency": concurrency, "errors": errors})
+    return result
+
+async def main_async(app_url: str, levels, requests_per_level: int, fake_app=None):
+    limits = httpx.Limits(max_connections=max(levels) * 2)
+    async with httpx.AsyncClient(base_url=app_url, timeout=120, limits=limits) as client:
+        token = await register_and_login(client)
+        results = []
+        for level in levels:
+            injected_before = fake_app.state.failure_count if fake_app else 0
+            result = await run_level(client, token, level, max(requests_per_level, level))
+            if fake_app is not None and fake_app.state.fail_rate:
+                result["injected_429s"] = fake_app.state.failure_count - injected_before
+            print(json.dumps(result))
+            results.append(result)
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="fake upstream latency")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of upstream calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s")
+    args = parser.parse_args()
+
+    fake_app = create_fake_gemini(args.latency_ms, args.fail_rate, args.retry_after)
+    fake = ServerThread(fake_app, port=free_port())
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+
+    # Point the app at the fake upstream and a throwaway SQLite database before importing it
+    os.environ["GEMINI_BASE_URL"] = f"{fake.url}/v1beta"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ.setdefault("USER_QUOTA_PER_MINUTE", "0")  # one user sends every request
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import app
+
+    with fake, ServerThread(app) as api:
+        asyncio.run(main_async(api.url, args.concurrency, args.requests, fake_app))
+
+if __name__ == "__main__":
+    main()
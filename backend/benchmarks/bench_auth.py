@@ -0,0 +1,64 @@
+"""
+Per-request cost of get_current_user with and without the user cache.
+
+    python -m benchmarks.bench_auth --iterations 5000
+
+Calls the dependency directly (no HTTP) against a throwaway SQLite
+database and reports p50/p99 in microseconds for each mode.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{db_path}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from app.core.config import settings
+    from app.core import security
+    from app.db.database import AsyncSessionLocal, User, init_db
+
+    init_db()
+
+    async def run():
+        async with AsyncSessionLocal() as db:
+            user = User(id=str(uuid.uuid4()), email=f"{uuid.uuid4().hex[:8]}@example.com",
+                        username=uuid.uuid4().hex[:8], hashed_password="x")
+            db.add(user)
+            await db.commit()
+            token = security.create_access_token({"sub": user.id})
+
+            results = {}
+            for enabled in (False, True):
+                settings.AUTH_CACHE_ENABLED = enabled
+                security._user_cache.clear()
+                timings = []
+                for _ in range(args.iterations):
+                    started = time.perf_counter()
+                    await security.get_current_user(token=token, db=db)
+                    timings.append(time.perf_counter() - started)
+                timings.sort()
+                results["cached" if enabled else "uncached"] = {
+                    "p50_us": round(percentile(timings, 50) * 1e6, 1),
+                    "p99_us": round(percentile(timings, 99) * 1e6, 1),
+                }
+            return results
+
+    print(json.dumps(asyncio.run(run()), indent=2))
+
+if __name__ == "__main__":
+    main()
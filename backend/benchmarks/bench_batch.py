@@ -0,0 +1,96 @@
+"""
+Answering N questions: one /ask per question vs. a single /ask/batch.
+
+    python -m benchmarks.bench_batch --latency-ms 500 --questions 200 --concurrency 20
+
+The /ask run sends the questions over --concurrency client connections;
+the batch run sends them all in one request and lets the server fan out
+(bounded by BATCH_MAX_CONCURRENCY, set to --concurrency here). Both use
+distinct questions per run so the answer cache doesn't help either side.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.bench_ask import register_and_login
+from benchmarks.common import ServerThread, free_port
+from benchmarks.fake_gemini import create_app as create_fake_gemini
+
+async def run_single(client: httpx.AsyncClient, token: str, questions, concurrency: int):
+    queue = asyncio.Queue()
+    for question in questions:
+        queue.put_nowait(question)
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while True:
+            try:
+                question = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            response = await client.post(
+                "/api/v1/ask", json={"question": question}, headers={"Authorization": f"Bearer {token}"}
+            )
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"mode": "ask", "elapsed_s": round(time.perf_counter() - started, 3), "errors": errors}
+
+async def run_batch(client: httpx.AsyncClient, token: str, questions):
+    started = time.perf_counter()
+    response = await client.post(
+        "/api/v1/ask/batch",
+        json={"questions": [{"question": question} for question in questions]},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    response.raise_for_status()
+    return {"mode": "batch", "elapsed_s": round(time.perf_counter() - started, 3), "errors": response.json()["failed"]}
+
+async def main_async(app_url: str, total: int, concurrency: int):
+    limits = httpx.Limits(max_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=app_url, timeout=600, limits=limits) as client:
+        token = await register_and_login(client)
+        for mode in ("ask", "batch"):
+            questions = [f"{mode} benchmark question {uuid.uuid4().hex[:8]}?" for _ in range(total)]
+            if mode == "ask":
+                result = await run_single(client, token, questions, concurrency)
+            else:
+                result = await run_batch(client, token, questions)
+            result.update({"questions": total, "throughput_qps": round(total / result["elapsed_s"], 2)})
+            print(json.dumps(result))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="fake upstream latency")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    fake = ServerThread(create_fake_gemini(args.latency_ms), port=free_port())
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+
+    # Point the app at the fake upstream and a throwaway SQLite database before importing it
+    os.environ["GEMINI_BASE_URL"] = f"{fake.url}/v1beta"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ.setdefault("USER_QUOTA_PER_MINUTE", "0")  # one user sends every request
+    os.environ["BATCH_MAX_CONCURRENCY"] = str(args.concurrency)
+    os.environ["BATCH_MAX_ITEMS"] = str(max(args.questions, 500))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import app
+
+    with fake, ServerThread(app) as api:
+        asyncio.run(main_async(api.url, args.questions, args.concurrency))
+
+if __name__ == "__main__":
+    main()
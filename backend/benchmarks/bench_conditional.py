@@ -0,0 +1,150 @@
+"""
+Steady-state polling cost of /history and /auth/me, with and without If-None-Match.
+
+    python -m benchmarks.bench_conditional --rows 500 --answer-chars 2000 --clients 16 --polls 100
+
+--clients clients each poll an unchanged resource --polls times, the way
+the frontend refreshes the history list. Each client either re-downloads
+the resource every time or sends the ETag it got first as If-None-Match.
+For each endpoint and mode it reports throughput, p50/p95 latency, bytes
+on the wire per poll, and SQL statements per poll, both in total and
+against qa_llm.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+from sqlalchemy import event
+
+from benchmarks.bench_ask import register_and_login
+from benchmarks.bench_payload import answer_text
+from benchmarks.common import ServerThread, summarize
+
+ENDPOINTS = {
+    "history_full": ("/api/v1/history", {"limit": 20}),
+    "history_preview": ("/api/v1/history", {"limit": 20, "view": "preview"}),
+    "me": ("/api/v1/auth/me", {}),
+}
+
+class StatementCounter:
+    """Counts the SQL statements the app runs, and how many of them read qa_llm"""
+
+    def __init__(self, engine):
+        self.total = self.history = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, connection, cursor, statement, parameters, context, executemany):
+        self.total += 1
+        if "qa_llm" in statement:
+            self.history += 1
+
+async def run_mode(client: httpx.AsyncClient, headers: dict, endpoint: str, conditional: bool, args, counter) -> dict:
+    path, params = ENDPOINTS[endpoint]
+    first = await client.get(path, params=params, headers=headers)
+    first.raise_for_status()
+    etag = first.headers["etag"]
+    latencies, wire_bytes, statuses = [], [], {}
+    statements, history_statements = counter.total, counter.history
+
+    async def poller():
+        poll_headers = {**headers, "If-None-Match": etag} if conditional else headers
+        for _ in range(args.polls):
+            started = time.perf_counter()
+            response = await client.get(path, params=params, headers=poll_headers)
+            latencies.append(time.perf_counter() - started)
+            wire_bytes.append(int(response.headers.get("content-length", len(response.content))))
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(poller() for _ in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    polls = len(latencies)
+    summary = summarize(latencies, elapsed)
+    return {
+        "endpoint": endpoint,
+        "mode": "if-none-match" if conditional else "unconditional",
+        "encoding": args.accept_encoding,
+        "throughput_rps": summary["throughput_rps"],
+        "p50_ms": summary["p50_ms"],
+        "p95_ms": summary["p95_ms"],
+        "bytes_per_poll": round(sum(wire_bytes) / polls),
+        "statements_per_poll": round((counter.total - statements) / polls, 2),
+        "qa_llm_statements_per_poll": round((counter.history - history_statements) / polls, 2),
+        "statuses": statuses,
+    }
+
+async def main_async(app_url: str, args, counter) -> list:
+    limits = httpx.Limits(max_connections=args.clients * 2)
+    async with httpx.AsyncClient(base_url=app_url, timeout=600, limits=limits) as client:
+        token = await register_and_login(client)
+        # Always sent, since httpx asks for gzip by default
+        headers = {"Authorization": f"Bearer {token}", "Accept-Encoding": args.accept_encoding}
+        me = (await client.get("/api/v1/auth/me", headers=headers)).json()
+        seed_history(me["id"], args)
+
+        results = []
+        for endpoint in ENDPOINTS:
+            for conditional in (False, True):
+                result = await run_mode(client, headers, endpoint, conditional, args, counter)
+                print(json.dumps(result))
+                results.append(result)
+        return results
+
+def seed_history(user_id: str, args):
+    from app.db.database import QueryHistory, SessionLocal
+    from app.services.history import touch_history
+
+    rng = random.Random(args.seed)
+    now = datetime.datetime.utcnow()
+    db = SessionLocal()
+    db.bulk_insert_mappings(QueryHistory, [
+        {"id": str(uuid.uuid4()), "question": f"What do I need for a visa to country {i}?",
+         "answer": answer_text(rng, args.answer_chars), "timestamp": now - datetime.timedelta(minutes=i),
+         "user_id": user_id}
+        for i in range(args.rows)
+    ])
+    db.execute(touch_history([user_id]))
+    db.commit()
+    db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=500, help="history rows of the polling user")
+    parser.add_argument("--answer-chars", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--polls", type=int, default=100, help="polls per client")
+    parser.add_argument("--accept-encoding", default="identity", help='e.g. "gzip" or "br"')
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="qa-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["HISTORY_SPOOL_PATH"] = os.path.join(workdir, "history_spool.jsonl")
+    os.environ["RELATED_INDEX_PATH"] = os.path.join(workdir, "related_index")
+    os.environ.setdefault("USER_QUOTA_PER_MINUTE", "0")  # one user sends every request
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app.db.database import get_async_engine
+    from main import app
+
+    with ServerThread(app) as api:
+        counter = StatementCounter(get_async_engine().sync_engine)
+        results = asyncio.run(main_async(api.url, args, counter))
+
+    if args.output:
+        from benchmarks.common import save_results
+        save_results(args.output, "bench_conditional", vars(args), results)
+    return results
+
+if __name__ == "__main__":
+    main()
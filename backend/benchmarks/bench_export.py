@@ -0,0 +1,151 @@
+"""
+Getting a whole history out: paging /history vs. streaming /history/export, and importing it back.
+
+    python -m benchmarks.bench_export --rows 20000 --answer-chars 2000
+
+Seeds one user with --rows history items, then downloads all of them:
+
+- page by page through /history with the legacy offset (`skip`), as
+  clients had to before, and with the cursor, both at the 100-row limit
+  and with the total count each page
+- as one /history/export stream in NDJSON, CSV and gzipped NDJSON
+
+For each it reports requests made, wall time and bytes received. For the
+export it also reports the peak Python memory allocated while streaming it
+(tracemalloc, in a separate run since tracing slows everything down).
+Finally the NDJSON file is imported into a second user through
+/history/import, plain and gzipped.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import httpx
+
+from benchmarks.bench_payload import answer_text
+from benchmarks.common import ServerThread
+
+PASSWORD = "benchmark-password"
+
+def register(client: httpx.Client) -> tuple:
+    name = f"bench_{uuid.uuid4().hex[:10]}"
+    client.post("/auth/register", json={"email": f"{name}@example.com", "username": name, "password": PASSWORD}).raise_for_status()
+    token = client.post("/auth/login", data={"username": name, "password": PASSWORD}).json()["access_token"]
+    return name, {"Authorization": f"Bearer {token}"}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--answer-chars", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="qa-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["HISTORY_SPOOL_PATH"] = os.path.join(workdir, "history_spool.jsonl")
+    os.environ["RELATED_INDEX_PATH"] = os.path.join(workdir, "related_index")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from app.db.database import QueryHistory, SessionLocal, User
+    from main import app
+
+    rng = random.Random(args.seed)
+    results = []
+
+    def report(row: dict):
+        results.append(row)
+        print(json.dumps(row))
+
+    with ServerThread(app) as api, httpx.Client(base_url=f"{api.url}/api/v1", timeout=600) as client:
+        name, headers = register(client)
+        now = datetime.datetime.now()
+        db = SessionLocal()
+        user_id = db.query(User.id).filter(User.username == name).scalar()
+        for start in range(0, args.rows, 5000):
+            db.bulk_insert_mappings(QueryHistory, [
+                {"id": str(uuid.uuid4()), "question": f"What do I need for a visa to country {i}?",
+                 "answer": answer_text(rng, args.answer_chars), "timestamp": now - datetime.timedelta(seconds=i),
+                 "user_id": user_id}
+                for i in range(start, min(args.rows, start + 5000))
+            ])
+        db.commit()
+        db.close()
+
+        for method in ("offset", "cursor"):
+            started = time.perf_counter()
+            requests = received = items = 0
+            params = {"limit": 100}
+            while True:
+                response = client.get("/history", params=params, headers=headers)
+                response.raise_for_status()
+                requests += 1
+                received += response.num_bytes_downloaded
+                page = response.json()
+                items += len(page["items"])
+                if method == "offset":
+                    if len(page["items"]) < 100:
+                        break
+                    params = {"limit": 100, "skip": items}
+                else:
+                    if not page["next_cursor"]:
+                        break
+                    params = {"limit": 100, "cursor": page["next_cursor"]}
+            report({"method": f"history_{method}", "items": items, "requests": requests,
+                    "seconds": round(time.perf_counter() - started, 2), "bytes": received})
+
+        exported = b""
+        for format, compressed in (("ndjson", False), ("csv", False), ("ndjson", True)):
+            params = {"format": format, "gzip": str(compressed).lower()}
+            for traced in (False, True):
+                if traced:
+                    tracemalloc.start()
+                started = time.perf_counter()
+                received = 0
+                body = []
+                with client.stream("GET", "/history/export", params=params, headers=headers) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_raw():
+                        received += len(chunk)
+                        if format == "ndjson" and not traced:
+                            body.append(chunk)
+                elapsed = time.perf_counter() - started
+                if traced:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                else:
+                    seconds, data = elapsed, b"".join(body)
+            lines = (gzip.decompress(data) if compressed else data).count(b"\n") if format == "ndjson" else None
+            if format == "ndjson" and not compressed:
+                exported = data
+            report({"method": f"export_{format}" + ("_gzip" if compressed else ""), "items": lines, "requests": 1,
+                    "seconds": round(seconds, 2), "bytes": received, "peak_python_mb": round(peak / 2**20, 1)})
+
+        for compressed in (False, True):
+            _, import_headers = register(client)
+            body = gzip.compress(exported, 4) if compressed else exported
+            started = time.perf_counter()
+            response = client.post("/history/import", content=body, headers=import_headers)
+            response.raise_for_status()
+            elapsed = time.perf_counter() - started
+            report({"method": "import" + ("_gzip" if compressed else ""), **response.json(),
+                    "seconds": round(elapsed, 2), "rows_per_s": round(response.json()["imported"] / elapsed),
+                    "bytes": len(body)})
+
+    if args.output:
+        from benchmarks.common import save_results
+        save_results(args.output, "bench_export", vars(args), results)
+    return results
+
+if __name__ == "__main__":
+    main()
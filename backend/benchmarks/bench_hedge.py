@@ -0,0 +1,86 @@
+"""
+Tail latency of /ask with and without hedged requests.
+
+    python -m benchmarks.bench_hedge --latency-ms 200 --slow-rate 0.05 --slow-ms 3000
+
+The fake server answers --slow-rate of calls after --slow-ms instead of
+--latency-ms. Both runs send the same number of distinct questions; with
+hedging on, a call still running after the observed p95 is re-sent and the
+first answer wins, which cuts p99 at the cost of a few extra upstream calls.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.bench_ask import register_and_login
+from benchmarks.common import ServerThread, free_port, summarize
+from benchmarks.fake_gemini import create_app as create_fake_gemini
+
+async def run(client: httpx.AsyncClient, token: str, total: int, concurrency: int):
+    latencies = []
+    hedges = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(
+                "/api/v1/ask",
+                json={"question": f"Hedge benchmark {uuid.uuid4().hex}?"},
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            latencies.append(time.perf_counter() - started)
+            hedge = response.json().get("metadata", {}).get("hedge", "error")
+            hedges[hedge] = hedges.get(hedge, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    result = summarize(latencies, time.perf_counter() - started)
+    result["hedge_outcomes"] = hedges
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-ms", type=float, default=3000.0)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    fake_app = create_fake_gemini(args.latency_ms, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    fake = ServerThread(fake_app, port=free_port())
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+
+    # Point the app at the fake upstream and a throwaway SQLite database before importing it
+    os.environ["GEMINI_BASE_URL"] = f"{fake.url}/v1beta"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ.setdefault("USER_QUOTA_PER_MINUTE", "0")  # one user sends every request
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import app
+    from app.core.config import settings
+
+    async def main_async(app_url: str):
+        async with httpx.AsyncClient(base_url=app_url, timeout=120) as client:
+            token = await register_and_login(client)
+            for hedging in (False, True):
+                # Read per call, so it can be flipped between runs; the p95 window carries over
+                settings.LLM_HEDGE_ENABLED = hedging
+                calls_before = fake_app.state.request_count
+                result = await run(client, token, args.requests, args.concurrency)
+                result.update({"hedging": hedging, "upstream_calls": fake_app.state.request_count - calls_before})
+                print(json.dumps(result))
+
+    with fake, ServerThread(app) as api:
+        asyncio.run(main_async(api.url))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+/history page latency by depth: offset pagination vs. keyset cursors.
+
+    python -m benchmarks.bench_history_depth --rows 100000
+
+Seeds one user with --rows entries in a throwaway SQLite database and
+times fetching a 20-row page at increasing depths. Offset pages get
+slower the deeper they are; cursor pages stay flat.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite file")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{db_path}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from app.db.database import AsyncSessionLocal, QueryHistory, SessionLocal, User, init_db
+    from app.services.history import encode_cursor, fetch_history_page
+
+    init_db()
+    user_id = str(uuid.uuid4())
+    now = datetime.datetime.utcnow()
+    db = SessionLocal()
+    db.add(User(id=user_id, email=f"{user_id[:8]}@example.com", username=user_id[:8], hashed_password="x"))
+    for start in range(0, args.rows, 10000):
+        db.bulk_insert_mappings(QueryHistory, [
+            {"id": str(uuid.uuid4()), "question": f"Question {i}?", "answer": "Answer",
+             "timestamp": now - datetime.timedelta(seconds=i), "user_id": user_id}
+            for i in range(start, min(start + 10000, args.rows))
+        ])
+    db.commit()
+
+    depths = [d for d in (0, 100, 1000, 10000, 50000, args.rows - args.page_size) if d < args.rows]
+
+    async def run():
+        results = []
+        async with AsyncSessionLocal() as session:
+            for depth in depths:
+                # The cursor for a depth is the row just before it, as a client paging from the top would hold
+                cursor = None
+                if depth:
+                    anchor, _ = await fetch_history_page(session, user_id, 1, skip=depth - 1)
+                    cursor = encode_cursor(anchor[0])
+
+                row = {"depth": depth}
+                for mode in ("offset", "cursor"):
+                    timings = []
+                    for _ in range(args.repeat):
+                        started = time.perf_counter()
+                        if mode == "offset":
+                            await fetch_history_page(session, user_id, args.page_size, skip=depth)
+                        else:
+                            await fetch_history_page(session, user_id, args.page_size, cursor=cursor)
+                        timings.append(time.perf_counter() - started)
+                    timings.sort()
+                    row[f"{mode}_p50_ms"] = round(timings[len(timings) // 2] * 1000, 3)
+                results.append(row)
+                print(json.dumps(row))
+        return results
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Queued /ask jobs vs. synchronous /ask against a local fake Gemini server.
+
+    python -m benchmarks.bench_jobs --latency-ms 2000 --questions 64 --clients 64 --workers 64
+
+--clients concurrent clients ask --questions questions between them, first
+with /ask, which holds each HTTP connection for the whole Gemini call, then
+with POST /ask/jobs followed by polling GET /ask/jobs/{id} every
+--poll-ms. For each mode it reports how long the client's request was
+held (the /ask latency, or the submit latency), the time until each answer
+was available, the total wall time, and how many HTTP requests were made.
+--workers sets ASK_JOB_WORKERS for the queue.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.bench_ask import register_and_login
+from benchmarks.common import ServerThread, free_port, summarize
+from benchmarks.fake_gemini import create_app as create_fake_gemini
+
+async def run_mode(client: httpx.AsyncClient, token: str, mode: str, questions: int, clients: int, poll: float) -> dict:
+    headers = {"Authorization": f"Bearer {token}"}
+    held, answered = [], []
+    requests = errors = 0
+    queue = asyncio.Queue()
+    for i in range(questions):
+        queue.put_nowait(i)
+    started = time.perf_counter()
+
+    async def ask(i: int):
+        nonlocal requests, errors
+        body = {"question": f"Benchmark {mode} question {i}?"}
+        sent = time.perf_counter()
+        response = await client.post("/api/v1/ask" if mode == "sync" else "/api/v1/ask/jobs", json=body, headers=headers)
+        requests += 1
+        held.append(time.perf_counter() - sent)
+        if mode == "sync":
+            if response.status_code != 200:
+                errors += 1
+            answered.append(time.perf_counter() - sent)
+            return
+        if response.status_code != 202:
+            errors += 1
+            return
+        job_id = response.json()["id"]
+        while True:
+            await asyncio.sleep(poll)
+            job = (await client.get(f"/api/v1/ask/jobs/{job_id}", headers=headers)).json()
+            requests += 1
+            if job["status"] in ("done", "failed"):
+                if job["status"] == "failed":
+                    errors += 1
+                answered.append(time.perf_counter() - sent)
+                return
+
+    async def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await ask(i)
+
+    # Synchronous clients wait for each answer before asking the next question;
+    # queued ones submit everything, then poll
+    if mode == "sync":
+        await asyncio.gather(*(worker() for _ in range(clients)))
+    else:
+        await asyncio.gather(*(ask(i) for i in range(questions)))
+    elapsed = time.perf_counter() - started
+    request_held = summarize(held, elapsed)
+    return {
+        "mode": mode,
+        "questions": questions,
+        "seconds": round(elapsed, 2),
+        "http_requests": requests,
+        "errors": errors,
+        "request_held_p50_ms": request_held["p50_ms"],
+        "request_held_p95_ms": request_held["p95_ms"],
+        "answered_p50_ms": summarize(answered, elapsed)["p50_ms"],
+        "answered_p95_ms": summarize(answered, elapsed)["p95_ms"],
+    }
+
+async def main_async(app_url: str, args) -> list:
+    limits = httpx.Limits(max_connections=max(args.clients, args.questions) * 2)
+    async with httpx.AsyncClient(base_url=app_url, timeout=600, limits=limits) as client:
+        token = await register_and_login(client)
+        results = []
+        for mode in ("sync", "queued"):
+            result = await run_mode(client, token, mode, args.questions, args.clients, args.poll_ms / 1000)
+            print(json.dumps(result))
+            results.append(result)
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=2000.0, help="fake upstream latency")
+    parser.add_argument("--questions", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=32, help="concurrent synchronous clients")
+    parser.add_argument("--workers", type=int, default=16, help="ASK_JOB_WORKERS")
+    parser.add_argument("--poll-ms", type=float, default=250.0)
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+    if args.workers < 1:
+        # With no workers in this process nothing would answer the queued jobs
+        parser.error("--workers must be at least 1")
+
+    fake = ServerThread(create_fake_gemini(args.latency_ms), port=free_port())
+    workdir = tempfile.mkdtemp(prefix="qa-bench-")
+
+    # Point the app at the fake upstream and a throwaway SQLite database before importing it
+    os.environ["GEMINI_BASE_URL"] = f"{fake.url}/v1beta"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["HISTORY_SPOOL_PATH"] = os.path.join(workdir, "history_spool.jsonl")
+    os.environ["RELATED_INDEX_PATH"] = os.path.join(workdir, "related_index")
+    os.environ["ASK_JOB_WORKERS"] = str(args.workers)
+    os.environ["ASK_JOB_MAX_PENDING_PER_USER"] = str(args.questions)
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    os.environ.setdefault("USER_QUOTA_PER_MINUTE", "0")  # one user sends every request
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import app
+
+    with fake, ServerThread(app) as api:
+        results = asyncio.run(main_async(api.url, args))
+
+    if args.output:
+        from benchmarks.common import save_results
+        save_results(args.output, "bench_jobs", vars(args), results)
+    return results
+
+if __name__ == "__main__":
+    main()
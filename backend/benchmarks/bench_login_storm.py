@@ -0,0 +1,94 @@
+"""
+Latency of a light endpoint while a burst of logins is being processed.
+
+    python -m benchmarks.bench_login_storm --logins 200 --concurrency 50
+
+Measures the health check latency while idle and again during a login
+storm. With bcrypt running on the event loop the storm latency grows
+with the backlog of hashes; with the dedicated pool it stays flat.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import ServerThread, summarize
+
+async def probe(client: httpx.AsyncClient, stop: asyncio.Event, interval: float = 0.01):
+    """Hit the health check at a fixed rate until stopped"""
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.get("/api/v1/")
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+    return latencies
+
+async def main_async(app_url: str, logins: int, concurrency: int, idle_seconds: float):
+    async with httpx.AsyncClient(base_url=app_url, timeout=120) as client:
+        name = f"bench_{uuid.uuid4().hex[:8]}"
+        password = "benchmark-password"
+        response = await client.post(
+            "/api/v1/auth/register",
+            json={"email": f"{name}@example.com", "username": name, "password": password},
+        )
+        response.raise_for_status()
+
+        # Baseline: health check latency with nothing else running
+        stop = asyncio.Event()
+        idle = asyncio.create_task(probe(client, stop))
+        await asyncio.sleep(idle_seconds)
+        stop.set()
+        idle_latencies = await idle
+
+        # Storm: concurrent logins while the probe keeps running
+        semaphore = asyncio.Semaphore(concurrency)
+        login_latencies = []
+        statuses = {}
+
+        async def login():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/api/v1/auth/login", data={"username": name, "password": password})
+                login_latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        stop = asyncio.Event()
+        storm_probe = asyncio.create_task(probe(client, stop))
+        started = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        storm_latencies = await storm_probe
+
+        return {
+            "health_idle": summarize(idle_latencies, idle_seconds),
+            "health_during_storm": summarize(storm_latencies, elapsed),
+            "logins": {**summarize(login_latencies, elapsed), "statuses": statuses},
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--idle-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import app
+
+    with ServerThread(app) as api:
+        result = asyncio.run(main_async(api.url, args.logins, args.concurrency, args.idle_seconds))
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
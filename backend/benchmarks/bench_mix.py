@@ -0,0 +1,220 @@
+"""
+Mixed register/login/ask/history load against the real app, a throwaway
+SQLite database and a local fake Gemini server.
+
+    python -m benchmarks.bench_mix --workload mixed --concurrency 8 32 --duration 20
+    python -m benchmarks.bench_mix --mix ask=8,history=2 --latency-ms 300 --fail-rate 0.05
+
+Each concurrency level runs closed-loop workers for --duration seconds
+(after --warmup seconds that aren't measured). Every request picks an
+operation at random by the mix's weights; --seed makes the sequence
+repeatable. Each level reports throughput and p50/p95/p99 latency, overall
+and per operation, plus the app's event-loop lag.
+
+Results are written as JSON (see --output) along with the git commit they
+were measured on; compare two runs with `python -m benchmarks.compare`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List, Tuple
+
+import httpx
+
+from benchmarks.common import LoopLagProbe, ServerThread, free_port, git_metadata, save_results, summarize
+from benchmarks.fake_gemini import create_app as create_fake_gemini
+
+OPERATIONS = ("register", "login", "ask", "history")
+
+# Named operation weights
+WORKLOADS = {
+    "mixed": {"register": 1, "login": 4, "ask": 10, "history": 5},
+    "ask-heavy": {"ask": 18, "history": 2},
+    "read-heavy": {"login": 1, "ask": 2, "history": 17},
+    "signup": {"register": 5, "login": 5},
+}
+
+PASSWORD = "benchmark-password"
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Parse "ask=8,history=2" into operation weights"""
+    weights = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {name!r}; expected one of {', '.join(OPERATIONS)}")
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid weight for {name}: {weight!r}")
+    if not any(weight > 0 for weight in weights.values()):
+        raise argparse.ArgumentTypeError("At least one operation needs a positive weight")
+    return weights
+
+class Workload:
+    """Picks operations and runs them against the API, recording per-operation latencies"""
+
+    def __init__(self, client: httpx.AsyncClient, weights: Dict[str, float], repeat_rate: float, seed: int):
+        self.client = client
+        self.operations = [name for name, weight in weights.items() if weight > 0]
+        self.weights = [weights[name] for name in self.operations]
+        self.repeat_rate = repeat_rate
+        self.random = random.Random(seed)
+        self.users: List[Tuple[str, str]] = []  # (username, token)
+        # A few popular questions that repeat, so the answer cache sees realistic hits
+        self.popular = [f"What are the visa requirements for country {i}?" for i in range(20)]
+
+    async def create_users(self, count: int):
+        async def create():
+            name = f"bench_{uuid.uuid4().hex[:10]}"
+            await self._register(name)
+            self.users.append((name, await self._login(name)))
+
+        await asyncio.gather(*(create() for _ in range(count)))
+
+    async def _register(self, name: str) -> httpx.Response:
+        response = await self.client.post(
+            "/api/v1/auth/register",
+            json={"email": f"{name}@example.com", "username": name, "password": PASSWORD},
+        )
+        response.raise_for_status()
+        return response
+
+    async def _login(self, name: str) -> str:
+        response = await self.client.post("/api/v1/auth/login", data={"username": name, "password": PASSWORD})
+        response.raise_for_status()
+        return response.json()["access_token"]
+
+    def _question(self) -> str:
+        if self.random.random() < self.repeat_rate:
+            return self.random.choice(self.popular)
+        return f"Benchmark question {uuid.uuid4().hex}?"
+
+    async def run_one(self) -> Tuple[str, float, int]:
+        """Run one randomly chosen operation; returns (operation, seconds, status code)"""
+        operation = self.random.choices(self.operations, self.weights)[0]
+        name, token = self.random.choice(self.users)
+        headers = {"Authorization": f"Bearer {token}"}
+        started = time.perf_counter()
+        if operation == "register":
+            name = f"bench_{uuid.uuid4().hex[:10]}"
+            response = await self.client.post(
+                "/api/v1/auth/register",
+                json={"email": f"{name}@example.com", "username": name, "password": PASSWORD},
+            )
+        elif operation == "login":
+            response = await self.client.post("/api/v1/auth/login", data={"username": name, "password": PASSWORD})
+        elif operation == "ask":
+            response = await self.client.post("/api/v1/ask", json={"question": self._question()}, headers=headers)
+        else:
+            response = await self.client.get("/api/v1/history", params={"limit": 10}, headers=headers)
+        return operation, time.perf_counter() - started, response.status_code
+
+async def run_level(workload: Workload, concurrency: int, duration: float, warmup: float, loop) -> dict:
+    samples: Dict[str, List[float]] = {name: [] for name in workload.operations}
+    statuses: Dict[str, Dict[str, int]] = {name: {} for name in workload.operations}
+    measure_from = time.perf_counter() + warmup
+    deadline = measure_from + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            operation, seconds, status_code = await workload.run_one()
+            if time.perf_counter() - seconds >= measure_from:
+                samples[operation].append(seconds)
+                counts = statuses[operation]
+                counts[str(status_code)] = counts.get(str(status_code), 0) + 1
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    await asyncio.sleep(warmup)
+    probe = LoopLagProbe(loop).start() if loop is not None else None
+    await asyncio.gather(*workers)
+    elapsed = time.perf_counter() - measure_from
+
+    operations = {}
+    for name in workload.operations:
+        result = summarize(samples[name], elapsed)
+        result["errors"] = sum(count for code, count in statuses[name].items() if not code.startswith("2"))
+        result["status_codes"] = statuses[name]
+        operations[name] = result
+    overall = summarize([seconds for values in samples.values() for seconds in values], elapsed)
+    overall["errors"] = sum(result["errors"] for result in operations.values())
+    return {
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 2),
+        "overall": overall,
+        "operations": operations,
+        "event_loop_lag": probe.stop() if probe else None,
+    }
+
+async def main_async(app_url: str, args, weights: Dict[str, float], loop, fake_app) -> list:
+    limits = httpx.Limits(max_connections=max(args.concurrency) * 2)
+    async with httpx.AsyncClient(base_url=app_url, timeout=120, limits=limits) as client:
+        workload = Workload(client, weights, args.repeat_rate, args.seed)
+        await workload.create_users(args.users)
+        results = []
+        for level in args.concurrency:
+            calls_before = fake_app.state.request_count
+            injected_before = fake_app.state.failure_count
+            result = await run_level(workload, level, args.duration, args.warmup, loop)
+            result["upstream_calls"] = fake_app.state.request_count - calls_before
+            result["injected_failures"] = fake_app.state.failure_count - injected_before
+            print(json.dumps(result))
+            results.append(result)
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed", help="named operation mix")
+    parser.add_argument("--mix", type=parse_mix, help="custom operation weights, e.g. ask=8,history=2 (overrides --workload)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds per concurrency level")
+    parser.add_argument("--warmup", type=float, default=3.0, help="unmeasured seconds before each level")
+    parser.add_argument("--users", type=int, default=20, help="users created up front and shared by the workers")
+    parser.add_argument("--repeat-rate", type=float, default=0.2, help="fraction of questions drawn from a small popular set")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="fake upstream latency")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of upstream calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of upstream calls that take --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=0.0)
+    parser.add_argument("--bcrypt-rounds", type=int, help="override BCRYPT_ROUNDS (register/login cost)")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/mix-<workload>-<commit>-<time>.json)")
+    args = parser.parse_args()
+    weights = args.mix or WORKLOADS[args.workload]
+
+    fake_app = create_fake_gemini(args.latency_ms, args.fail_rate, args.retry_after, args.slow_rate, args.slow_ms)
+    fake = ServerThread(fake_app, port=free_port())
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+
+    # Point the app at the fake upstream and a throwaway SQLite database before importing it
+    os.environ["GEMINI_BASE_URL"] = f"{fake.url}/v1beta"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["HISTORY_SPOOL_PATH"] = os.path.join(os.path.dirname(db_path), "history_spool.jsonl")
+    os.environ.setdefault("USER_QUOTA_PER_MINUTE", "0")  # a few users send every request
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import app
+
+    with fake, ServerThread(app) as api:
+        results = asyncio.run(main_async(api.url, args, weights, api.loop, fake_app))
+
+    output = args.output
+    if output is None:
+        commit = (git_metadata()["commit"] or "nogit")[:10]
+        name = args.workload if args.mix is None else "custom"
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                              f"mix-{name}-{commit}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    run_args = {**vars(args), "mix": weights}
+    print(f"Saved {save_results(output, 'bench_mix', run_args, results)}")
+
+if __name__ == "__main__":
+    main()
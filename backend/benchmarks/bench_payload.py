@@ -0,0 +1,127 @@
+"""
+/history page size on the wire and server-side encoding time.
+
+    python -m benchmarks.bench_payload --rows 100 --answer-chars 4000
+
+Seeds one user with --rows history items whose answers are about
+--answer-chars characters of markdown-like text, then fetches a
+--page-size page repeatedly in each view (full answers, previews) and with
+each content encoding the server offers (identity, gzip, and br if the
+brotli package is installed). Reports bytes on the wire, the decoded JSON
+size, and the median serialize/compress stages from Server-Timing along
+with the client-side latency.
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import ServerThread
+
+PASSWORD = "benchmark-password"
+
+WORDS = (
+    "visa passport application embassy consulate travel document requirement entry permit residence "
+    "stay days fee processing time appointment biometric photo proof funds accommodation itinerary "
+    "insurance return ticket invitation letter employer bank statement valid months border officer "
+    "the a of to and in for with on at by from your you must should can will may not be is are"
+).split()
+
+def answer_text(rng: random.Random, chars: int) -> str:
+    """Markdown-ish prose: headings, bullets and sentences from a small travel vocabulary"""
+    parts = ["## Answer\n\n"]
+    length = len(parts[0])
+    while length < chars:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + "."
+        line = f"- {sentence}\n" if rng.random() < 0.5 else f"{sentence} "
+        if rng.random() < 0.05:
+            line = f"\n### {rng.choice(WORDS).capitalize()}\n\n"
+        parts.append(line)
+        length += len(line)
+    return "".join(parts)[:chars]
+
+def stage_ms(server_timing: str, name: str) -> float:
+    for entry in server_timing.split(","):
+        label, _, duration = entry.strip().partition(";dur=")
+        if label == name:
+            return float(duration)
+    return 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--answer-chars", type=int, default=4000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["GEMINI_API_KEY"] = "fake-key"
+    os.environ["HISTORY_SPOOL_PATH"] = os.path.join(os.path.dirname(db_path), "history_spool.jsonl")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from app.db.database import QueryHistory, SessionLocal, User
+    from main import app
+
+    encodings = ["identity", "gzip"] + (["br"] if importlib.util.find_spec("brotli") else [])
+    rng = random.Random(args.seed)
+
+    with ServerThread(app) as api, httpx.Client(base_url=f"{api.url}/api/v1", timeout=60) as client:
+        name = f"bench_{uuid.uuid4().hex[:10]}"
+        client.post("/auth/register", json={"email": f"{name}@example.com", "username": name, "password": PASSWORD}).raise_for_status()
+        token = client.post("/auth/login", data={"username": name, "password": PASSWORD}).json()["access_token"]
+
+        now = datetime.datetime.utcnow()
+        db = SessionLocal()
+        user_id = db.query(User.id).filter(User.username == name).scalar()
+        db.bulk_insert_mappings(QueryHistory, [
+            {"id": str(uuid.uuid4()), "question": f"What do I need for a visa to country {i}?",
+             "answer": answer_text(rng, args.answer_chars), "timestamp": now - datetime.timedelta(seconds=i),
+             "user_id": user_id}
+            for i in range(args.rows)
+        ])
+        db.commit()
+        db.close()
+
+        results = []
+        for view in ("full", "preview"):
+            for encoding in encodings:
+                headers = {"Authorization": f"Bearer {token}", "Accept-Encoding": encoding}
+                params = {"limit": args.page_size, "view": view, "include_total": "false"}
+                latencies, serialize, compress = [], [], []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    response = client.get("/history", params=params, headers=headers)
+                    latencies.append(time.perf_counter() - started)
+                    response.raise_for_status()
+                    timing = response.headers.get("server-timing", "")
+                    serialize.append(stage_ms(timing, "serialize"))
+                    compress.append(stage_ms(timing, "compress"))
+                row = {
+                    "view": view,
+                    "encoding": response.headers.get("content-encoding", "identity"),
+                    "items": len(response.json()["items"]),
+                    "wire_bytes": response.num_bytes_downloaded,
+                    "json_bytes": len(response.content),
+                    "serialize_p50_ms": round(statistics.median(serialize), 3),
+                    "compress_p50_ms": round(statistics.median(compress), 3),
+                    "latency_p50_ms": round(statistics.median(latencies) * 1000, 2),
+                }
+                results.append(row)
+                print(json.dumps(row))
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Related-questions index: build time, recall and latency at scale.
+
+    python -m benchmarks.bench_related --rows 1000000 --users 20000
+
+Generates --rows synthetic travel questions (templates filled from country,
+topic and traveller vocabularies, so many are near-duplicates of others)
+spread over --users users, loads them into a throwaway index and groups it
+into k-means lists, as a rebuild does. Then, for --queries questions
+(reworded copies of stored ones plus unseen ones), it reports:
+
+- recall@k of the list (IVF) search against an exact scan of every row,
+  at several probe counts, with p50/p95 latency for each
+- latency of an exact scan, and of a search limited to one user's rows
+- how fast new rows are appended in --insert-batch sized batches
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+COUNTRIES = (
+    "Kenya Uganda Tanzania Rwanda Ethiopia Nigeria Ghana Egypt Morocco Ireland France Germany Spain Italy "
+    "Japan China India Canada Mexico Brazil Australia Norway Sweden Poland Turkey Qatar Dubai Thailand Vietnam "
+    "Indonesia Chile Peru Argentina Portugal Greece Austria Belgium Netherlands Denmark Finland"
+).split()
+TOPICS = [
+    "visa requirements", "passport validity", "work permit", "student visa", "tourist visa", "transit visa",
+    "visa fees", "processing time", "travel insurance", "vaccination requirements", "customs allowance",
+    "driving licence", "residence permit", "business visa", "visa on arrival", "border crossing",
+    "entry requirements", "overstay penalties", "visa extension", "family reunion visa",
+]
+TEMPLATES = [
+    "What are the {topic} for {country}?",
+    "{topic} for {country} citizens travelling to {other}",
+    "How do I get {topic} in {country}?",
+    "Do I need {topic} to visit {country} from {other}?",
+    "What is the {topic} for {country} in {year}?",
+    "{country} {topic}",
+    "Can a {who} apply for {topic} in {country}?",
+]
+WHO = ["student", "retiree", "freelancer", "nurse", "engineer", "child", "family", "tourist"]
+
+def make_question(rng: random.Random) -> str:
+    return rng.choice(TEMPLATES).format(
+        topic=rng.choice(TOPICS), country=rng.choice(COUNTRIES), other=rng.choice(COUNTRIES),
+        year=rng.randint(2018, 2026), who=rng.choice(WHO),
+    )
+
+def reword(rng: random.Random, question: str) -> str:
+    """The same question as a user might retype it: different case, a word dropped, no punctuation"""
+    words = question.rstrip("?").split()
+    if len(words) > 3:
+        del words[rng.randrange(len(words))]
+    return " ".join(words).lower()
+
+def percentile_ms(values, p: float) -> float:
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--probes", default="1,4,8,16,32,64")
+    parser.add_argument("--lists", type=int, default=0, help="k-means lists; 0 picks ~sqrt(rows) like the app")
+    parser.add_argument("--insert-batch", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="qa-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["RELATED_INDEX_PATH"] = os.path.join(workdir, "related_index")
+    os.environ["RELATED_INDEX_LISTS"] = str(args.lists)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from app.core.config import settings
+    from app.db.database import init_db
+    from app.services.related import VectorIndex
+
+    init_db()
+    rng = random.Random(args.seed)
+    users = [str(uuid.uuid4()) for _ in range(args.users)]
+    # A few heavy users and a long tail, like real traffic
+    user_weights = [1 / rank for rank in range(1, len(users) + 1)]
+    questions = [make_question(rng) for _ in range(args.rows)]
+    owners = rng.choices(users, user_weights, k=args.rows)
+
+    index = VectorIndex(settings.RELATED_INDEX_PATH)
+    index._open()
+    results = {"rows": args.rows, "users": args.users}
+
+    # Bulk load without the automatic regrouping, then group once, as a rebuild would
+    minimum = settings.RELATED_INDEX_MIN_TRAIN_ROWS
+    settings.RELATED_INDEX_MIN_TRAIN_ROWS = args.rows + 1
+    started = time.perf_counter()
+    for start in range(0, args.rows, 50_000):
+        index.add([(str(uuid.uuid4()), owners[i], questions[i]) for i in range(start, min(args.rows, start + 50_000))])
+    results["load_s"] = round(time.perf_counter() - started, 1)
+    settings.RELATED_INDEX_MIN_TRAIN_ROWS = min(minimum, args.rows)
+    started = time.perf_counter()
+    index.rebuild()
+    results["build_lists_s"] = round(time.perf_counter() - started, 1)
+    results["index"] = index.stats()
+    print(json.dumps({"load_s": results["load_s"], "build_lists_s": results["build_lists_s"], **results["index"]}))
+
+    # Half reworded stored questions, half new ones
+    queries = [reword(rng, rng.choice(questions)) if i % 2 == 0 else make_question(rng) for i in range(args.queries)]
+    vectors = index.embedder.embed(queries)
+    everything = 1 << 30
+
+    exact, exact_latency = [], []
+    for vector in vectors:
+        started = time.perf_counter()
+        exact.append(index.search_vector(vector, args.k, probes=everything))
+        exact_latency.append(time.perf_counter() - started)
+    results["exact"] = {"p50_ms": percentile_ms(exact_latency, 50), "p95_ms": percentile_ms(exact_latency, 95)}
+    print(json.dumps({"search": "exact", **results["exact"]}))
+
+    results["ivf"] = []
+    for probes in [int(value) for value in args.probes.split(",")]:
+        recalls, latency = [], []
+        for vector, truth in zip(vectors, exact):
+            started = time.perf_counter()
+            found = index.search_vector(vector, args.k, probes=probes)
+            latency.append(time.perf_counter() - started)
+            # Ties at the cut-off score count as found, since either row is an equally good answer
+            cutoff = truth[-1][1] - 1e-6 if truth else 1.0
+            hits = sum(1 for _, score in found if score >= cutoff)
+            recalls.append(min(hits, len(truth)) / max(1, len(truth)))
+        row = {
+            "search": "ivf", "probes": probes, f"recall@{args.k}": round(statistics.fmean(recalls), 4),
+            "p50_ms": percentile_ms(latency, 50), "p95_ms": percentile_ms(latency, 95),
+        }
+        results["ivf"].append(row)
+        print(json.dumps(row))
+
+    # Per-user search: a heavy user and typical ones
+    latency = []
+    for i, vector in enumerate(vectors):
+        user_id = users[0] if i % 10 == 0 else rng.choice(users)
+        started = time.perf_counter()
+        index.search_vector(vector, args.k, user_id=user_id)
+        latency.append(time.perf_counter() - started)
+    results["per_user"] = {"p50_ms": percentile_ms(latency, 50), "p95_ms": percentile_ms(latency, 95)}
+    print(json.dumps({"search": "per_user", **results["per_user"]}))
+
+    embed_started = time.perf_counter()
+    index.embedder.embed(queries)
+    results["embed_ms_per_question"] = round((time.perf_counter() - embed_started) / len(queries) * 1000, 3)
+
+    # Appends as the history writer does them: embed, lock, append, refresh
+    batches = 50
+    started = time.perf_counter()
+    for _ in range(batches):
+        index.add([(str(uuid.uuid4()), rng.choice(users), make_question(rng)) for _ in range(args.insert_batch)])
+    elapsed = time.perf_counter() - started
+    results["insert"] = {
+        "batch": args.insert_batch,
+        "rows_per_s": round(batches * args.insert_batch / elapsed),
+        "ms_per_batch": round(elapsed / batches * 1000, 2),
+    }
+    print(json.dumps({"embed_ms_per_question": results["embed_ms_per_question"], "insert": results["insert"]}))
+
+    if args.output:
+        from benchmarks.common import save_results
+        save_results(args.output, "bench_related", vars(args), results)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+History search latency: LIKE scan vs. the full-text index.
+
+    python -m benchmarks.bench_search --users 20 --rows 5000
+
+Seeds --users users with --rows entries each (Zipf-distributed words from a
+made-up vocabulary) in a throwaway SQLite database, then times common,
+rare, multi-word, prefix and missing terms through a `LIKE '%term%'` scan
+of the user's rows and through search_history, which uses the FTS5 index.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+def make_vocabulary(rng, size):
+    """Pronounceable made-up words, so LIKE substrings and FTS tokens agree"""
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ze", "da", "po", "ri"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(syllables, k=rng.randint(2, 4))))
+    return sorted(words)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite file")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=5000, help="history rows per user")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{db_path}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from sqlalchemy import or_, select
+
+    from app.db.database import AsyncSessionLocal, QueryHistory, SessionLocal, User, init_db
+    from app.db.search import search_history
+
+    init_db()
+    rng = random.Random(42)
+    vocabulary = make_vocabulary(rng, 5000)
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    now = datetime.datetime.utcnow()
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+    db = SessionLocal()
+    for user_id in user_ids:
+        db.add(User(id=user_id, email=f"{user_id[:8]}@example.com", username=user_id[:8], hashed_password="x"))
+        db.bulk_insert_mappings(QueryHistory, [
+            {"id": str(uuid.uuid4()),
+             "question": " ".join(rng.choices(vocabulary, weights, k=8)) + "?",
+             "answer": " ".join(rng.choices(vocabulary, weights, k=120)),
+             "timestamp": now - datetime.timedelta(seconds=i), "user_id": user_id}
+            for i in range(args.rows)
+        ])
+    db.commit()
+
+    user_id = user_ids[0]
+    terms = [
+        vocabulary[0],                        # in most rows
+        vocabulary[2000],                     # a handful of rows
+        f"{vocabulary[10]} {vocabulary[500]}",
+        vocabulary[3000][:4],                 # prefix
+        "notaword",
+    ]
+
+    async def like_scan(session, term):
+        conditions = []
+        for word in term.split():
+            pattern = f"%{word}%"
+            conditions.append(or_(QueryHistory.question.ilike(pattern), QueryHistory.answer.ilike(pattern)))
+        query = select(QueryHistory).where(QueryHistory.user_id == user_id, *conditions)
+        return (await session.execute(query.order_by(QueryHistory.timestamp.desc()).limit(20))).scalars().all()
+
+    async def run():
+        async with AsyncSessionLocal() as session:
+            for term in terms:
+                row = {"query": term}
+                for mode in ("like", "fts"):
+                    timings = []
+                    for _ in range(args.repeat):
+                        started = time.perf_counter()
+                        if mode == "like":
+                            await like_scan(session, term)
+                        else:
+                            await search_history(session, user_id, term, 20)
+                        timings.append(time.perf_counter() - started)
+                    timings.sort()
+                    row[f"{mode}_p50_ms"] = round(timings[len(timings) // 2] * 1000, 3)
+                print(json.dumps(row))
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Cold-start time of the app, for a first deployment and for restarts.
+
+    python -m benchmarks.bench_startup --workers 4 --rounds 5
+    python -m benchmarks.bench_startup --repo /tmp/qa-before   # another checkout, e.g. a git worktree
+
+Each round starts --workers fresh Python processes at once, like a
+multi-worker server coming up, all against the same database. Every worker
+imports main.py and runs the app's startup (lifespan), reporting how long
+each took and how many SQL statements it sent. The "fresh" scenario starts
+from an empty SQLite database; "restart" reuses one that is already set up.
+Workers that crash during startup (e.g. racing each other to create the
+same table) are counted as failed.
+
+To see what a change gains, run it here and against a worktree of the
+previous commit (`git worktree add /tmp/qa-before HEAD~1`) and compare.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Runs in each worker process, from the backend directory of the checkout being measured
+WORKER = r"""
+import asyncio, json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, os.getcwd())
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = {"import": 0, "startup": 0}
+phase = "import"
+def count(*args, **kwargs):
+    statements[phase] += 1
+event.listen(Engine, "before_cursor_execute", count)
+import main
+imported = time.perf_counter()
+phase = "startup"
+async def start():
+    async with main.app.router.lifespan_context(main.app):
+        return time.perf_counter()
+ready = asyncio.run(start())
+print(json.dumps({
+    "import_s": imported - started,
+    "startup_s": ready - imported,
+    "total_s": ready - started,
+    "statements_import": statements["import"],
+    "statements_startup": statements["startup"],
+}))
+"""
+
+def run_round(backend_dir: str, database_url: str, workers: int) -> list:
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "GEMINI_API_KEY": "fake-key",
+        "HISTORY_SPOOL_PATH": os.path.join(tempfile.mkdtemp(prefix="qa-bench-"), "spool.jsonl"),
+        "LOG_LEVEL": "WARNING",
+    }
+    processes = [
+        subprocess.Popen([sys.executable, "-c", WORKER], cwd=backend_dir, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        for _ in range(workers)
+    ]
+    results = []
+    for process in processes:
+        stdout, stderr = process.communicate(timeout=300)
+        if process.returncode != 0:
+            errors = [line for line in stderr.splitlines() if "Error" in line]
+            results.append({"failed": True, "error": errors[-1] if errors else stderr[-500:]})
+        else:
+            results.append(json.loads(stdout.strip().splitlines()[-1]))
+    return results
+
+def summarize_scenario(rounds: list) -> dict:
+    all_workers = [worker for round_results in rounds for worker in round_results]
+    workers = [worker for worker in all_workers if not worker.get("failed")]
+    failures = [worker["error"] for worker in all_workers if worker.get("failed")]
+    if not workers:
+        return {"workers_failed": len(failures), "errors": sorted(set(failures))}
+    slowest = [max(worker["total_s"] for worker in round_results if not worker.get("failed"))
+               for round_results in rounds if any(not worker.get("failed") for worker in round_results)]
+
+    def median_ms(key: str) -> float:
+        return round(statistics.median(worker[key] for worker in workers) * 1000, 1)
+
+    return {
+        "workers_measured": len(workers),
+        "workers_failed": len(failures),
+        "median_import_ms": median_ms("import_s"),
+        "median_startup_ms": median_ms("startup_s"),
+        "median_total_ms": median_ms("total_s"),
+        "median_slowest_worker_ms": round(statistics.median(slowest) * 1000, 1),
+        "statements_per_worker": round(statistics.fmean(
+            worker["statements_import"] + worker["statements_startup"] for worker in workers
+        ), 1),
+        "errors": sorted(set(failures)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="processes started at once per round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--repo", default=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                        help="checkout to measure (default: this one)")
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+    backend_dir = os.path.join(args.repo, "backend")
+
+    results = {}
+    fresh_rounds = []
+    for _ in range(args.rounds):
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='qa-bench-'), 'fresh.db')}"
+        fresh_rounds.append(run_round(backend_dir, database_url, args.workers))
+    results["fresh"] = summarize_scenario(fresh_rounds)
+
+    database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='qa-bench-'), 'existing.db')}"
+    run_round(backend_dir, database_url, 1)  # set the database up once
+    results["restart"] = summarize_scenario([run_round(backend_dir, database_url, args.workers) for _ in range(args.rounds)])
+
+    for scenario, summary in results.items():
+        print(json.dumps({"scenario": scenario, "repo": args.repo, **summary}))
+    if args.output:
+        from benchmarks.common import save_results
+        save_results(args.output, "bench_startup", vars(args), results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Shared helpers for the benchmark scripts"""
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+
+class _LoopCapture:
+    """ASGI wrapper that remembers the event loop the server runs the app on"""
+
+    def __init__(self, app):
+        self.app = app
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def __call__(self, scope, receive, send):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        await self.app(scope, receive, send)
+
+class ServerThread:
+    """Run an ASGI app under uvicorn in a background thread"""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port or free_port()
+        self.app = app
+        self._app = _LoopCapture(app)
+        self.server = uvicorn.Server(
+            uvicorn.Config(self._app, host=self.host, port=self.port, log_level="warning", lifespan="on")
+        )
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        """The server's event loop (set once the lifespan has started)"""
+        return self._app.loop
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+class LoopLagProbe:
+    """
+    Measures how late the server's event loop wakes up from a short sleep
+
+    Anything that blocks the loop (CPU work, sync I/O) delays every request
+    on it by the same amount, so this is the best single sign of blocking.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = 0.01):
+        self.loop = loop
+        self.interval = interval
+        self.samples: List[float] = []
+        self._running = False
+        self._future = None
+
+    async def _run(self):
+        while self._running:
+            started = self.loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, self.loop.time() - started - self.interval))
+
+    def start(self):
+        self.samples = []
+        self._running = True
+        self._future = asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+        return self
+
+    def stop(self) -> Dict[str, float]:
+        """Stop probing and return lag percentiles in milliseconds"""
+        self._running = False
+        self._future.result(timeout=5)
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"samples": 0}
+
+        def pct(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000, 2)
+
+        return {
+            "samples": len(ordered),
+            "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+            "p50_ms": pct(50),
+            "p99_ms": pct(99),
+            "max_ms": round(ordered[-1] * 1000, 2),
+        }
+
+def git_metadata() -> Dict[str, Any]:
+    """Commit the benchmark ran against, and whether the tree had local changes"""
+    def git(*args) -> Optional[str]:
+        try:
+            result = subprocess.run(["git", *args], capture_output=True, text=True, timeout=30,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+        except (OSError, subprocess.SubprocessError):
+            return None
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    commit = git("rev-parse", "HEAD")
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {
+        "commit": commit,
+        "subject": git("log", "-1", "--format=%s") if commit else None,
+        "dirty": bool(status) if status is not None else None,
+    }
+
+def save_results(path: str, benchmark: str, args: Dict[str, Any], results: Any) -> str:
+    """Write results as JSON along with the commit, environment and arguments they came from"""
+    document = {
+        "benchmark": benchmark,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git": git_metadata(),
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "args": args,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as output:
+        json.dump(document, output, indent=2)
+    return path
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    """Throughput and latency percentiles (milliseconds) for a run"""
+    ordered = sorted(latencies)
+    if not ordered:
+        return {"requests": 0, "throughput_rps": 0.0}
+
+    def pct(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {
+        "requests": len(ordered),
+        "throughput_rps": round(len(ordered) / elapsed, 2),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+        "p50_ms": round(pct(50), 2),
+        "p95_ms": round(pct(95), 2),
+        "p99_ms": round(pct(99), 2),
+    }
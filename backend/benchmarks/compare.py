@@ -0,0 +1,80 @@
+"""
+Compare two bench_mix result files, e.g. from before and after a change.
+
+    python -m benchmarks.compare benchmarks/results/mix-mixed-<old>.json benchmarks/results/mix-mixed-<new>.json
+
+Prints throughput, latency percentiles and event-loop lag side by side
+for every concurrency level and operation in both runs. Changes beyond
+--threshold percent in the wrong direction are marked as regressions,
+and the exit status is 1 if there are any.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, Optional, Tuple
+
+# Metric -> whether higher is better
+METRICS = {"throughput_rps": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as results:
+        return json.load(results)
+
+def label(document: dict) -> str:
+    git = document.get("git") or {}
+    commit = (git.get("commit") or "unknown")[:10]
+    return f"{commit}{' (dirty)' if git.get('dirty') else ''}"
+
+def rows(document: dict) -> Dict[Tuple[int, str], dict]:
+    """Flatten results into {(concurrency, operation): summary}, with "overall" and "loop_lag" rows"""
+    flattened = {}
+    for level in document["results"]:
+        concurrency = level["concurrency"]
+        flattened[(concurrency, "overall")] = level["overall"]
+        for operation, summary in level["operations"].items():
+            flattened[(concurrency, operation)] = summary
+        if level.get("event_loop_lag"):
+            lag = level["event_loop_lag"]
+            flattened[(concurrency, "loop_lag")] = {"p50_ms": lag.get("p50_ms"), "p99_ms": lag.get("p99_ms")}
+    return flattened
+
+def change(old: Optional[float], new: Optional[float]) -> Optional[float]:
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) / old * 100
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    print(f"baseline  {label(baseline)}  {args.baseline}")
+    print(f"candidate {label(candidate)}  {args.candidate}\n")
+    if baseline.get("args", {}).get("mix") != candidate.get("args", {}).get("mix"):
+        print("warning: the runs used different operation mixes\n")
+
+    old_rows, new_rows = rows(baseline), rows(candidate)
+    regressions = 0
+    print(f"{'level':>5}  {'operation':<9}  {'metric':<14}  {'baseline':>10}  {'candidate':>10}  {'change':>8}")
+    for key in sorted(set(old_rows) & set(new_rows)):
+        concurrency, operation = key
+        for metric, higher_is_better in METRICS.items():
+            old, new = old_rows[key].get(metric), new_rows[key].get(metric)
+            if old is None and new is None:
+                continue
+            delta = change(old, new)
+            flag = ""
+            if delta is not None and (delta < -args.threshold if higher_is_better else delta > args.threshold):
+                flag = "  REGRESSION"
+                regressions += 1
+            delta_text = f"{delta:+.1f}%" if delta is not None else "n/a"
+            print(f"{concurrency:>5}  {operation:<9}  {metric:<14}  {old!s:>10}  {new!s:>10}  {delta_text:>8}{flag}")
+
+    print(f"\n{regressions} regression(s) beyond {args.threshold:g}%")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Local stand-in for the Gemini generateContent/streamGenerateContent API used by the benchmarks.
+
+Run standalone with:
+    python -m benchmarks.fake_gemini --port 8001 --latency-ms 500 --fail-rate 0.2
+
+Failures are 429 RESOURCE_EXHAUSTED responses with a Retry-After header,
+injected at random (`--fail-rate`) or for the next N calls (`app.state.fail_next`).
+Models named in `app.state.down_models` answer 503. `--slow-rate` of calls
+(or the next `app.state.slow_next`) take `--slow-ms` instead of the normal
+latency, to give a latency tail. `POST /v1beta/cachedContents` stores a
+system instruction that later calls can refer to as `cachedContent`; its
+tokens are reported as `cachedContentTokenCount`.
+"""
+import argparse
+import asyncio
+import json
+import random
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+
+ANSWER_TEXT = "## Answer\n\n- This is a canned response from the fake Gemini server.\n"
+STREAM_CHUNKS = 8
+
+def _chars(*contents: dict) -> int:
+    return sum(len(part.get("text", "")) for content in contents for part in content.get("parts", []))
+
+def usage_metadata(payload: dict, answer: str, cached: dict = None) -> dict:
+    """Token counts shaped like Gemini's usageMetadata, estimated at ~4 characters per token"""
+    prompt_chars = _chars(*payload.get("contents", []), payload.get("systemInstruction") or {})
+    cached_tokens = _chars(cached) // 4 if cached else 0
+    prompt_tokens = prompt_chars // 4 + 1 + cached_tokens
+    answer_tokens = len(answer) // 4 + 1
+    usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": answer_tokens, "totalTokenCount": prompt_tokens + answer_tokens}
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    return usage
+
+def create_app(
+    latency_ms: float = 500.0,
+    fail_rate: float = 0.0,
+    retry_after: float = 1.0,
+    slow_rate: float = 0.0,
+    slow_ms: float = 0.0
+) -> FastAPI:
+    """Build a fake Gemini app that answers every request after `latency_ms`, failing `fail_rate` of them"""
+    app = FastAPI(title="Fake Gemini")
+    app.state.latency_ms = latency_ms
+    app.state.slow_rate = slow_rate
+    app.state.slow_ms = slow_ms
+    app.state.slow_next = 0
+    app.state.down_models = set()
+    app.state.model_counts = {}
+    app.state.fail_rate = fail_rate
+    app.state.fail_next = 0
+    app.state.fail_status = 429
+    app.state.retry_after = retry_after
+    app.state.request_count = 0
+    app.state.failure_count = 0
+    app.state.last_payload = None
+    app.state.cached_contents = {}
+
+    def injected_failure():
+        """A quota error for this call, if one is due"""
+        if app.state.fail_next > 0:
+            app.state.fail_next -= 1
+        elif random.random() >= app.state.fail_rate:
+            return None
+        app.state.failure_count += 1
+        return JSONResponse(
+            status_code=app.state.fail_status,
+            content={"error": {"code": app.state.fail_status, "message": "Injected failure", "status": "RESOURCE_EXHAUSTED"}},
+            headers={"Retry-After": str(app.state.retry_after)},
+        )
+
+    @app.post("/v1beta/cachedContents")
+    async def create_cached_content(body: dict):
+        name = f"cachedContents/{len(app.state.cached_contents) + 1}"
+        app.state.cached_contents[name] = body.get("systemInstruction") or {}
+        return {"name": name, "model": body.get("model"), "ttl": body.get("ttl")}
+
+    @app.post("/v1beta/models/{model_action}")
+    async def generate_content(model_action: str, payload: dict):
+        model, _, action = model_action.partition(":")
+        app.state.last_payload = payload
+        if action not in ("generateContent", "streamGenerateContent"):
+            raise HTTPException(status_code=404, detail=f"Unknown action: {action}")
+        app.state.request_count += 1
+        app.state.model_counts[model] = app.state.model_counts.get(model, 0) + 1
+        if model in app.state.down_models:
+            return JSONResponse(status_code=503, content={"error": {"code": 503, "status": "UNAVAILABLE"}})
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+        cached = None
+        if "cachedContent" in payload:
+            cached = app.state.cached_contents.get(payload["cachedContent"])
+            if cached is None:
+                return JSONResponse(status_code=403, content={"error": {"code": 403, "status": "PERMISSION_DENIED", "message": "CachedContent not found"}})
+        if action == "streamGenerateContent":
+            return StreamingResponse(stream_chunks(model, payload, cached), media_type="text/event-stream")
+        slow = app.state.slow_next > 0 or random.random() < app.state.slow_rate
+        app.state.slow_next = max(0, app.state.slow_next - 1)
+        await asyncio.sleep((app.state.slow_ms if slow else app.state.latency_ms) / 1000)
+        return {
+            "candidates": [
+                {"content": {"parts": [{"text": ANSWER_TEXT}], "role": "model"}, "finishReason": "STOP"}
+            ],
+            "usageMetadata": usage_metadata(payload, ANSWER_TEXT, cached),
+            "modelVersion": model,
+        }
+
+    async def stream_chunks(model: str, payload: dict, cached: dict = None):
+        # Spread the latency across the chunks, like a real token stream
+        step = len(ANSWER_TEXT) // STREAM_CHUNKS + 1
+        for i in range(0, len(ANSWER_TEXT), step):
+            await asyncio.sleep(app.state.latency_ms / 1000 / STREAM_CHUNKS)
+            last = i + step >= len(ANSWER_TEXT)
+            candidate = {"content": {"parts": [{"text": ANSWER_TEXT[i:i + step]}], "role": "model"}}
+            if last:
+                candidate["finishReason"] = "STOP"
+            usage = usage_metadata(payload, ANSWER_TEXT[:i + step], cached)
+            yield f"data: {json.dumps({'candidates': [candidate], 'usageMetadata': usage, 'modelVersion': model})}\r\n\r\n"
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a fake Gemini API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=500.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of calls that take --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.latency_ms, args.fail_rate, args.retry_after, args.slow_rate, args.slow_ms), host=args.host, port=args.port, log_level="warning")
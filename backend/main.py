@@ -1,9 +1,44 @@
 # main.py
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.api.endpoints import qa, auth
+from app.api.endpoints import qa, auth, admin, conversations, metrics
+from app.api.middleware import CompressionMiddleware, RequestMetricsMiddleware
+from app.api.responses import TimedJSONResponse
 from app.core.config import settings
-from app.db.database import init_db
+from app.core.metrics import configure_logging
+from app.db.database import dispose_engines, init_db
+from app.services.archive import history_archiver
+from app.services.ask_jobs import ask_workers
+from app.services.deletion import user_deleter
+from app.services.llm_service import llm_service
+from app.services.history_writer import history_writer
+from app.services.related import related_index
+
+configure_logging(settings.LOG_LEVEL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema checks are blocking DDL, so they run in a thread; after the first startup they are one query
+    await asyncio.to_thread(init_db)
+    await history_writer.start()
+    # Opens (and if need be fills) the related-questions index in the background
+    related_index.start()
+    # Moves old history to the compressed archive and applies retention, if configured
+    await history_archiver.start()
+    # Resumes account deletions left unfinished by a restart
+    await user_deleter.start()
+    # Answers queued /ask jobs (ASK_JOB_WORKERS=0 leaves them to worker.py processes)
+    await ask_workers.start()
+    yield
+    # Flush queued history, then release pooled upstream and database connections
+    await ask_workers.stop()
+    await user_deleter.stop()
+    await history_archiver.stop()
+    await history_writer.stop()
+    await llm_service.aclose()
+    await dispose_engines()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -13,8 +48,19 @@ app = FastAPI(
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     docs_url=f"{settings.API_V1_STR}/docs",
     redoc_url=f"{settings.API_V1_STR}/redoc",
+    lifespan=lifespan,
+    default_response_class=TimedJSONResponse,
 )
 
+# Compress JSON and text responses for clients that accept it
+if settings.COMPRESSION_ENABLED:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.COMPRESSION_MIN_SIZE,
+        gzip_level=settings.COMPRESSION_GZIP_LEVEL,
+        brotli_quality=settings.COMPRESSION_BROTLI_QUALITY,
+    )
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -22,14 +68,19 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Server-Timing"],
 )
 
-# Initialize database
-init_db()
+# Request ids and latency metrics; added last so it wraps everything else
+app.add_middleware(RequestMetricsMiddleware)
 
 # Include routers
 app.include_router(auth.router, prefix=f"{settings.API_V1_STR}/auth")
 app.include_router(qa.router, prefix=settings.API_V1_STR)
+app.include_router(admin.router, prefix=f"{settings.API_V1_STR}/admin")
+app.include_router(conversations.router, prefix=f"{settings.API_V1_STR}/conversations")
+if settings.METRICS_ENABLED:
+    app.include_router(metrics.router)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,43 @@
+# worker.py
+"""
+Answer queued /ask jobs without serving HTTP, so workers scale apart from the API:
+
+    ASK_JOB_WORKERS=16 python worker.py
+
+Run the API with ASK_JOB_WORKERS=0 to leave every job to these processes.
+"""
+import asyncio
+import logging
+import signal
+from app.core.config import settings
+from app.core.metrics import configure_logging
+from app.db.database import dispose_engines, init_db
+from app.services.ask_jobs import ask_workers
+from app.services.llm_service import llm_service
+from app.services.related import related_index
+
+configure_logging(settings.LOG_LEVEL)
+logger = logging.getLogger(__name__)
+
+async def main():
+    if ask_workers.concurrency <= 0:
+        raise SystemExit("ASK_JOB_WORKERS must be at least 1 to run a worker")
+    await asyncio.to_thread(init_db)
+    # Answers are added to the related-questions index, and may be reused from it
+    related_index.start()
+    await ask_workers.start()
+    logger.info(f"Ask worker {ask_workers.worker_id} running {ask_workers.concurrency} jobs at a time")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+
+    # Finish or hand back running jobs, then release pooled connections
+    await ask_workers.stop()
+    await llm_service.aclose()
+    await dispose_engines()
+
+if __name__ == "__main__":
+    asyncio.run(main())